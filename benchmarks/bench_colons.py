@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2024, Gonzalo Alvarez
+"""Measures parse_colons on generated --with-colons keyrings of growing size.
+
+    python -m benchmarks.bench_colons 1000 5000 10000 20000
+"""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import sys
+import time
+import random
+
+from secureenclave.gpg import parse_colons
+
+
+def generate_keyring(count, seed=0):
+    rnd = random.Random(seed)
+    lines = []
+    for idx in range(count):
+        fpr = '{:040X}'.format(rnd.getrandbits(160))
+        sub_fpr = '{:040X}'.format(rnd.getrandbits(160))
+        lines.append(f'pub:u:4096:1:{fpr[-16:]}:1700000000:::u:::scESC::::::23::0:')
+        lines.append(f'fpr:::::::::{fpr}:')
+        lines.append(f'grp:::::::::{fpr}:')
+        for uid in range(1 + idx % 3):
+            lines.append(f'uid:u::::1700000000::{fpr}::User {idx}\\x3a{uid} <user{idx}.{uid}@example.com>::::::::::0:')
+        lines.append(f'sub:u:4096:1:{sub_fpr[-16:]}:1700000000:1800000000:::::e::::::23:')
+        lines.append(f'fpr:::::::::{sub_fpr}:')
+        lines.append(f'grp:::::::::{sub_fpr}:')
+    return '\n'.join(lines)
+
+
+def main(sizes):
+    print(f'{"keys":>8} {"seconds":>10} {"us/key":>8}')
+    for size in sizes:
+        raw = generate_keyring(size)
+        start = time.perf_counter()
+        keys = parse_colons(raw)
+        elapsed = time.perf_counter() - start
+        assert len(keys) == size
+        print(f'{size:>8} {elapsed:>10.4f} {elapsed / size * 1e6:>8.2f}')
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [1000, 5000, 10000, 20000, 40000])
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2024, Gonzalo Alvarez
+"""End to end benchmarks against real local gpg in a throwaway enclave home.
+
+    python -m benchmarks.suite -o results.json
+    python -m benchmarks.suite --quick --only keys,crypto --compare results.json
+
+Nothing touches the user's data dir: XDG_DATA_HOME points to a temporary directory for the
+whole run, keys are generated there without passphrase and smart cards are simulated.
+"""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import sys
+import json
+import gzip
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+
+from loguru import logger
+from pathlib import Path
+
+__benchmarks__ = ('startup', 'keys', 'crypto', 'compression', 'agent', 'card', 'cardpool')
+__regression__ = 1.25
+
+__key_params__ = """%no-protection
+Key-Type: eddsa
+Key-Curve: ed25519
+Key-Usage: sign
+Subkey-Type: ecdh
+Subkey-Curve: cv25519
+Subkey-Usage: encrypt
+Name-Real: Bench {idx}
+Name-Email: bench{idx}@example.com
+Expire-Date: 0
+%commit
+"""
+
+
+def measure(function, repeat):
+    """Runs function repeat times and returns the samples in seconds"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def record(results, name, samples, **params):
+    entry = {'name': name, 'params': params, 'samples': samples, 'median': statistics.median(samples), 'min': min(samples)}
+    if 'bytes' in params:
+        entry['mib_per_s'] = params['bytes'] / entry['median'] / 1048576 if entry['median'] > 0 else None
+    results.append(entry)
+    details = ' '.join(f'{k}={v}' for k, v in params.items())
+    rate = f' {entry["mib_per_s"]:.1f} MiB/s' if entry.get('mib_per_s') else ''
+    print(f'{name:<28} {details:<32} median {entry["median"] * 1000:9.2f} ms{rate}', file=sys.stderr)
+
+
+def new_home(root, name):
+    """A fresh enclave home, selected through XDG_DATA_HOME so every code path picks it up"""
+    from secureenclave.secureenclave import enclave_home
+    os.environ['XDG_DATA_HOME'] = root.joinpath(name).as_posix()
+    home = enclave_home()
+    home.mkdir(parents=True, exist_ok=True)
+    return home
+
+
+def generate_keys(gpg, count):
+    params = ''.join(__key_params__.format(idx=idx) for idx in range(count))
+    subprocess.run([gpg.getbin(), '--quiet', '--batch', '--generate-key'], input=params.encode('utf-8'),
+                   env=gpg.getenv(), capture_output=True, check=True)
+
+
+def kill_agent(gpg):
+    subprocess.run(['gpgconf', '--kill', 'all'], env=gpg.getenv(), capture_output=True)
+
+
+def bench_startup(results, root, args):
+    """CLI cold start in a fresh interpreter, for a command that needs nothing and one that reads the keyring"""
+    new_home(root, 'startup')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([Path(__file__).resolve().parent.parent.as_posix(), os.environ.get('PYTHONPATH', '')]))
+    for command in (['--help'], ['key', 'list']):
+        run = lambda: subprocess.run([sys.executable, '-m', 'secureenclave.cli'] + command, env=env,
+                                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        run()
+        record(results, 'cli_cold_start', measure(run, args.repeat), command=' '.join(command))
+
+
+def bench_keys(results, root, args):
+    """Gpg.get_keys with no index, with the index on disk and with it in memory"""
+    from secureenclave.gpg import Gpg
+    for size in args.keyring_sizes:
+        home = new_home(root, f'keys-{size}')
+        gpg = Gpg(home)
+        generate_keys(gpg, size)
+        def cold():
+            gpg.key_index_path.unlink(missing_ok=True)
+            Gpg(home).get_keys()
+        record(results, 'get_keys_cold', measure(cold, args.repeat), keys=size)
+        record(results, 'get_keys_index', measure(lambda: Gpg(home).get_keys(), args.repeat), keys=size)
+        record(results, 'get_keys_memory', measure(gpg.get_keys, args.repeat), keys=size)
+        kill_agent(gpg)
+
+
+def bench_crypto(results, root, args):
+    """Encrypt and decrypt throughput through gpg and through envelope mode"""
+    from secureenclave.secureenclave import SecureEnclave, Needs
+    from secureenclave import envelope
+    new_home(root, 'crypto')
+    secure_enclave = SecureEnclave(Needs.NOTHING)
+    generate_keys(secure_enclave.gpg, 1)
+    recipient = secure_enclave.gpg.get_keys()[0].fingerprint
+    for size in args.payload_sizes:
+        payload = os.urandom(size)
+        modes = {'gpg': (lambda: secure_enclave.encrypt_stream(payload, recipient), secure_enclave.decrypt_stream),
+                 'envelope': (lambda: envelope.encrypt(secure_enclave, payload, [recipient]), secure_enclave.decrypt_stream)}
+        for mode, (encrypt, decrypt) in modes.items():
+            sealed = b''.join(encrypt())
+            assert b''.join(decrypt(sealed)) == payload
+            record(results, 'encrypt', measure(lambda: b''.join(encrypt()), args.repeat), mode=mode, bytes=size)
+            record(results, 'decrypt', measure(lambda: b''.join(decrypt(sealed)), args.repeat), mode=mode, bytes=size)
+    kill_agent(secure_enclave.gpg)
+
+
+def corpus(size):
+    """Text, already compressed, random and text with a compressed payload, all of about size bytes"""
+    generator = random.Random(size)
+    words = ['secure', 'enclave', 'key', 'card', 'agent', 'config', 'value', 'true', 'false', 'null']
+    lines, total = [], 0
+    while total < size:
+        line = f'{total:08d} {generator.choice(words)}={generator.randrange(1 << 20)} {" ".join(generator.choices(words, k=6))}\n'
+        lines.append(line)
+        total += len(line)
+    text = ''.join(lines).encode('utf-8')[:size]
+    return {'text': text, 'gzip': gzip.compress(text * 8)[:size], 'random': generator.randbytes(size),
+            'mixed': text[:size // 4] + generator.randbytes(size - size // 4)}
+
+
+def bench_compression(results, root, args):
+    """Output size and time of the old armored ZLIB 6 output against binary output with compression picked per input"""
+    from secureenclave.secureenclave import SecureEnclave, Needs
+    new_home(root, 'compression')
+    secure_enclave = SecureEnclave(Needs.NOTHING)
+    generate_keys(secure_enclave.gpg, 1)
+    recipient = secure_enclave.gpg.get_keys()[0].fingerprint
+    modes = {'armor-zlib6': (True, 'default'), 'binary-auto': (False, 'auto')}
+    for kind, payload in corpus(args.payload_sizes[-1] // 4).items():
+        for mode, (armor, compression) in modes.items():
+            encrypt = lambda: b''.join(secure_enclave.encrypt_stream(payload, recipient, armor, compression))
+            sealed = encrypt()
+            assert b''.join(secure_enclave.decrypt_stream(sealed)) == payload
+            record(results, 'encrypt_corpus', measure(encrypt, args.repeat), mode=mode, corpus=kind, bytes=len(payload))
+            results[-1]['output_bytes'] = len(sealed)
+            record(results, 'decrypt_corpus', measure(lambda: b''.join(secure_enclave.decrypt_stream(sealed)), args.repeat),
+                   mode=mode, corpus=kind, bytes=len(payload))
+            print(f'{"":<28} output {len(sealed)} bytes, {len(sealed) / len(payload):.1%} of the input', file=sys.stderr)
+    kill_agent(secure_enclave.gpg)
+
+
+def bench_agent(results, root, args):
+    """gpg-agent start and stop, and start when a running agent is reused"""
+    from secureenclave.gpg import Gpg
+    from secureenclave.gpgagent import GpgAgent
+    gpg = Gpg(new_home(root, 'agent'))
+    try:
+        agent = GpgAgent(gpg)
+    except Exception as e:
+        print(f'Skipping agent benchmarks: {e}', file=sys.stderr)
+        return
+    starts, stops = [], []
+    for _ in range(args.repeat):
+        starts += measure(lambda: agent.start(reuse=False), 1)
+        stops += measure(agent.stop, 1)
+    record(results, 'agent_start', starts)
+    record(results, 'agent_stop', stops)
+    agent.start(reuse=False)
+    record(results, 'agent_start_reuse', measure(agent.start, args.repeat))
+    agent.stop()
+
+
+def bench_card(results, root, args):
+    """Time from a simulated card being plugged in until SmartCard notices it"""
+    from secureenclave.gpg import Gpg
+    from secureenclave.smartcard import SmartCard, SimulatedDevice, SimulatedDeviceSource
+    gpg = Gpg(new_home(root, 'card'))
+    samples = []
+    for idx in range(args.repeat):
+        source = SimulatedDeviceSource()
+        device = SimulatedDevice('bench', idx)
+        inserted = []
+        def plug():
+            time.sleep(0.01)
+            inserted.append(time.perf_counter())
+            source.insert(device)
+        plugger = threading.Thread(target=plug)
+        plugger.start()
+        SmartCard(gpg, source=source).wait_for_it(timeout=5)
+        samples.append(time.perf_counter() - inserted[0])
+        plugger.join()
+    record(results, 'card_detect', samples)
+
+
+def bench_cardpool(results, root, args):
+    """Decryptions spread over simulated cards holding the same key, 20ms each"""
+    from secureenclave.cardpool import CardPool, SimulatedCard, SimulatedCardBackend
+    key = 'A' * 40
+    operations = 16 if args.quick else 64
+    for cards in (1, 2, 4):
+        pool = CardPool(SimulatedCardBackend([SimulatedCard(f'card{idx}', {key}, 0.02) for idx in range(cards)]))
+        pool.refresh()
+        record(results, 'cardpool_decrypt', measure(lambda: pool.map(key, pool.decrypt, [b'x'] * operations), args.repeat),
+               cards=cards, operations=operations)
+
+
+def compare(results, baseline_path):
+    """Prints the change against a previous run and returns False when something got slower than __regression__"""
+    key = lambda x: (x['name'], json.dumps(x['params'], sort_keys=True))
+    baseline = {key(x): x for x in json.loads(Path(baseline_path).read_text())['results']}
+    ok = True
+    for result in results:
+        if (previous := baseline.get(key(result))) is None or previous['median'] <= 0:
+            continue
+        ratio = result['median'] / previous['median']
+        flag = 'REGRESSION' if ratio > __regression__ else ''
+        ok = ok and not flag
+        print(f'{result["name"]:<28} {json.dumps(result["params"]):<40} x{ratio:5.2f} {flag}', file=sys.stderr)
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.suite', description=__doc__.splitlines()[0])
+    parser.add_argument('-o', '--output', help='Write the results as JSON to this file instead of stdout')
+    parser.add_argument('--only', default=','.join(__benchmarks__), help='Comma separated benchmarks to run')
+    parser.add_argument('--repeat', type=int, default=5, help='Samples per measurement')
+    parser.add_argument('--quick', action='store_true', help='Smaller keyrings and payloads, 3 samples')
+    parser.add_argument('--compare', metavar='BASELINE', help='Compare medians with a previous JSON result and exit 1 on regressions')
+    args = parser.parse_args(argv)
+    args.keyring_sizes = [1, 10] if args.quick else [1, 10, 50, 200]
+    args.payload_sizes = [1024, 1024 * 1024] if args.quick else [1024, 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024]
+    args.repeat = 3 if args.quick else args.repeat
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+    if not shutil.which('gpg'):
+        parser.error('gpg is not installed')
+
+    results = []
+    root = Path(tempfile.mkdtemp(prefix='secureenclave-bench-'))
+    xdg_data_home = os.environ.get('XDG_DATA_HOME')
+    try:
+        for name in args.only.split(','):
+            if name not in __benchmarks__:
+                parser.error(f'Unknown benchmark [{name}]')
+            globals()[f'bench_{name}'](results, root, args)
+    finally:
+        for home in root.glob('*/SecureEnclave/gpg'):
+            subprocess.run(['gpgconf', '--kill', 'all'], env=dict(os.environ, GNUPGHOME=home.as_posix()), capture_output=True)
+        shutil.rmtree(root, ignore_errors=True)
+        if xdg_data_home is None:
+            os.environ.pop('XDG_DATA_HOME', None)
+        else:
+            os.environ['XDG_DATA_HOME'] = xdg_data_home
+
+    gpg_version = subprocess.run(['gpg', '--version'], capture_output=True).stdout.decode('utf-8', 'replace').splitlines()[0]
+    report = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'python': platform.python_version(), 'platform': platform.platform(),
+                       'cpus': os.cpu_count(), 'gpg': gpg_version}, 'results': results}
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare and not compare(results, args.compare):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2024, Gonzalo Alvarez
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import asyncio
+import time
+
+from loguru import logger
+from pathlib import Path
+from typing import List, Optional, Union
+
+from . import compression as compression_
+from . import envelope
+from . import runner
+from . import trace
+from .gpg import parse_colons, __list_args__, __list_timeout__
+from .gpgagent import __agent_start_timeout__
+from .secureenclave import SecureEnclave, Needs, __card_fetch_args__, __card_status_args__, __card_timeout__, __gpg_fetch_key__
+from .smartcard import __poll_max__, __poll_min__
+
+# asyncio counterpart of SecureEnclave for services that run an event loop. gpg runs in asyncio subprocesses, at most
+# max_processes at a time per instance, and a cancelled or timed out call kills its gpg process before it returns.
+# Keyring paths, the key index, agent bookkeeping and card parsing are shared with the blocking SecureEnclave.
+
+
+class AsyncRunner(object):
+    """runner.run on asyncio subprocesses"""
+    def __init__(self, max_processes: int = runner.__max_processes__):
+        self.max_processes = max(1, max_processes)
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    @property
+    def slots(self) -> asyncio.Semaphore:
+        # Created on first use so it belongs to the running loop
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_processes)
+        return self._slots
+
+    async def run(self, argv: List[str], env=None, input: Optional[bytes] = None, timeout: Optional[float] = None,
+                  check: bool = False, name: Optional[str] = None) -> runner.Completed:
+        async with self.slots:
+            with trace.span(name or trace.gpg_span_name(argv), command=trace.command_line(argv)) as span:
+                process = await asyncio.create_subprocess_exec(*argv, env=env, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                                                               stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL)
+                try:
+                    stdout, stderr = await asyncio.wait_for(process.communicate(input), timeout)
+                except asyncio.TimeoutError:
+                    await _kill(process)
+                    span.set(timeout=timeout)
+                    raise runner._timeout_error(argv, timeout)
+                except BaseException:
+                    # Cancelled: the child must not outlive the call
+                    await _kill(process)
+                    raise
+                span.set(exit_code=process.returncode, bytes_in=len(input or b''), bytes_out=len(stdout))
+        if check and process.returncode != 0:
+            raise runner.RunnerError(argv, process.returncode, stderr)
+        return runner.Completed(argv, process.returncode, stdout, stderr)
+
+
+async def _blocking(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+
+async def _kill(process):
+    if process.returncode is None:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+        await asyncio.shield(process.wait())
+        logger.debug(f'Killed [{process.pid}]')
+
+
+class AsyncSecureEnclave(object):
+    """SecureEnclave for asyncio. Use it with async with, which starts the agent and probes the card as needs says"""
+    def __init__(self, needs=Needs.KEYRING, max_processes: int = runner.__max_processes__):
+        self.secure_enclave = SecureEnclave(needs)
+        self.needs = needs
+        self.gpg = self.secure_enclave.gpg
+        self.runner = AsyncRunner(max_processes)
+        self._key_lock: Optional[asyncio.Lock] = None
+
+    async def __aenter__(self):
+        if Needs.AGENT in self.needs:
+            await self.start_agent()
+        if Needs.CARD in self.needs and await self.is_card_installed():
+            key_index = await self.key_index()
+            card_pub = getattr(self.secure_enclave, 'card_pub', None)
+            if not (card_pub and key_index.has_pub(card_pub)):
+                logger.info('A card is installed. Retrieving remote key id from card')
+                await self.run(__card_fetch_args__, input=__gpg_fetch_key__.encode('utf-8'), timeout=__card_timeout__)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.secure_enclave.__exit__(exc_type, exc_val, exc_tb)
+
+    async def run(self, args: List[str], input: Optional[bytes] = None, timeout: Optional[float] = None, check: bool = False) -> runner.Completed:
+        return await self.runner.run([self.gpg.getbin()] + args, self.gpg.getenv(), input, timeout, check)
+
+    async def start_agent(self):
+        agent = self.secure_enclave.gpg_agent
+        # The agent is probed over a blocking Assuan socket, that goes to the executor
+        if pid := await _blocking(agent.find_running):
+            logger.debug(f'Reusing running gpg-agent [{pid}]')
+            agent.gpg_agent_pid = pid
+            agent.touch()
+        else:
+            await self.runner.run(agent.daemon_command(), self.gpg.getenv(), timeout=__agent_start_timeout__, name='gpg-agent --daemon')
+            await _blocking(agent.started)
+        agent.hold(self.secure_enclave.agent_idle_timeout)
+        self.secure_enclave.agent_started = True
+
+    async def is_card_installed(self) -> bool:
+        try:
+            result = await self.run(__card_status_args__, timeout=__card_timeout__)
+        except TimeoutError as e:
+            logger.debug(f'Card failed to be recognized: {e}')
+            return False
+        return self.secure_enclave.card_found(result)
+
+    async def wait_for_card(self, timeout: Optional[float] = None):
+        """SmartCard.wait_for_it without blocking the loop: polls with backoff until a card is there and scdaemon sees it.
+        USB enumeration and the scdaemon probe block, they run in the executor"""
+        smartcard = self.secure_enclave.smartcard
+        with trace.span('card wait', timeout=timeout) as span:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            delay = __poll_min__
+            devices = await _blocking(smartcard.source.devices)
+            while not devices or not await _blocking(smartcard.is_ready):
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise TimeoutError('Timed out waiting for a smart card' if not devices else 'Timed out waiting for scdaemon to pick up the card')
+                await asyncio.sleep(delay if deadline is None else max(0, min(delay, deadline - time.monotonic())))
+                delay = min(delay * 2, __poll_max__)
+                devices = devices or await _blocking(smartcard.source.devices)
+            span.set(devices=len(devices))
+            return devices
+
+    async def key_index(self):
+        if (key_index := self.gpg.cached_key_index()) is not None:
+            return key_index
+        if self._key_lock is None:
+            self._key_lock = asyncio.Lock()
+        async with self._key_lock:
+            # Somebody else may have listed the keys while this call waited for the lock
+            if (key_index := self.gpg.cached_key_index()) is not None:
+                return key_index
+            result = await self.run(__list_args__, timeout=__list_timeout__, check=True)
+            return self.gpg.update_key_index(parse_colons(result.text))
+
+    async def get_keys(self):
+        with trace.span('get_keys') as span:
+            keys = (await self.key_index()).keys()
+            span.set(keys=len(keys))
+        return keys
+
+    def _encrypt_args(self, recipients, armor, compression_args):
+        if not recipients:
+            raise Exception('No recipient to encrypt to')
+        recipients = [recipients] if isinstance(recipients, str) else list(recipients)
+        return self.secure_enclave._encrypt_args(recipients, armor, compression_args)
+
+    async def encrypt(self, data: bytes, recipients: Union[str, List[str]], armor: bool = False, compression: str = 'auto') -> bytes:
+        compression_args = compression_.gpg_args(compression, data[:compression_.__sample_size__])
+        result = await self.run(['--quiet', '--batch'] + self._encrypt_args(recipients, armor, compression_args), input=data, check=True)
+        return result.stdout
+
+    async def encrypt_file(self, input, output, recipients: Union[str, List[str]], armor: bool = False, compression: str = 'auto'):
+        compression_args = compression_.gpg_args_for_file(compression, input)
+        await self.run(['--quiet', '--batch', '--yes'] + self._encrypt_args(recipients, armor, compression_args) +
+                       ['-o', Path(output).as_posix(), Path(input).as_posix()], check=True)
+
+    async def decrypt(self, data: bytes) -> bytes:
+        if envelope.is_envelope(data):
+            return await self._decrypt_envelope(data)
+        return (await self.run(['--quiet', '--batch', '--decrypt'], input=data, check=True)).stdout
+
+    async def decrypt_file(self, input, output):
+        if envelope.is_envelope_file(input):
+            Path(output).write_bytes(await self._decrypt_envelope(Path(input).read_bytes()))
+            return
+        await self.run(['--quiet', '--batch', '--yes', '--decrypt', '-o', Path(output).as_posix(), Path(input).as_posix()], check=True)
+
+    async def _decrypt_envelope(self, data: bytes) -> bytes:
+        # gpg unwraps the data key here, the AES-GCM chunks are CPU work and go to the default executor
+        _, _, wrapped = envelope.read_header(envelope._Reader(data).read)
+        key = (await self.run(['--quiet', '--batch', '--decrypt'], input=wrapped, check=True)).stdout
+        if len(key) != envelope.__key_size__:
+            raise envelope.EnvelopeError('Wrapped data key has the wrong size')
+        return await _blocking(lambda: b''.join(envelope.decrypt(None, data, key=key)))
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2024, Gonzalo Alvarez
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import socket
+import hashlib
+import threading
+
+from loguru import logger
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from . import trace
+
+__zbase32__: str = 'ybndrfg8ejkmcpqxot1uwisza345h769'
+__max_line__: int = 1000
+
+
+class AssuanError(Exception):
+    def __init__(self, code, message):
+        super().__init__(f'{message} ({code})')
+        self.code = code
+        self.message = message
+
+
+def agent_socket_path(gpg_home) -> Path:
+    """Locates S.gpg-agent the way gnupg does, under /run/user when it exists"""
+    home = os.path.abspath(gpg_home).rstrip('/')
+    default = os.path.abspath(os.path.expanduser('~/.gnupg'))
+    for base in ('/run/user', '/var/run/user'):
+        rundir = os.path.join(base, str(os.getuid()))
+        if os.path.isdir(rundir):
+            if home == default:
+                return Path(rundir, 'gnupg', 'S.gpg-agent')
+            bits = int.from_bytes(hashlib.sha1(home.encode('utf-8')).digest()[:15], 'big')
+            suffix = ''.join(__zbase32__[(bits >> (115 - 5 * idx)) & 31] for idx in range(24))
+            return Path(rundir, 'gnupg', f'd.{suffix}', 'S.gpg-agent')
+    return Path(home, 'S.gpg-agent')
+
+
+def escape(data: bytes) -> bytes:
+    return data.replace(b'%', b'%25').replace(b'\r', b'%0D').replace(b'\n', b'%0A')
+
+
+def unescape(data: bytes) -> bytes:
+    if b'%' not in data:
+        return data
+    chunks = data.split(b'%')
+    return chunks[0] + b''.join(bytes([int(x[:2], 16)]) + x[2:] for x in chunks[1:])
+
+
+class AssuanClient(object):
+    """Minimal Assuan client keeping one connection open to gpg-agent"""
+    def __init__(self, socket_path, timeout: Optional[float] = 10):
+        self.socket_path = Path(socket_path)
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path.as_posix())
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+        self._response()
+        logger.debug(f'Connected to agent at [{self.socket_path}]')
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.sendall(b'BYE\n')
+            except OSError:
+                pass
+            self.reader.close()
+            self.sock.close()
+        self.sock = self.reader = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _readline(self) -> bytes:
+        line = self.reader.readline(__max_line__ + 2)
+        if not line:
+            raise ConnectionError('Agent closed the connection')
+        return line.rstrip(b'\r\n')
+
+    def _response(self, inquire: Optional[Callable[[str], bytes]] = None) -> Tuple[bytes, List[Tuple[str, str]]]:
+        data = []
+        status = []
+        while True:
+            line = self._readline()
+            if line == b'OK' or line.startswith(b'OK '):
+                return b''.join(data), status
+            if line.startswith(b'ERR '):
+                code, _, message = line[4:].decode('utf-8', 'replace').partition(' ')
+                raise AssuanError(int(code), message)
+            if line.startswith(b'D '):
+                data.append(unescape(line[2:]))
+            elif line.startswith(b'S '):
+                keyword, _, args = line[2:].decode('utf-8', 'replace').partition(' ')
+                status.append((keyword, args))
+            elif line.startswith(b'INQUIRE '):
+                keyword = line[8:].decode('utf-8', 'replace').split(' ')[0]
+                if inquire is None:
+                    self.sock.sendall(b'CAN\n')
+                    continue
+                payload = escape(inquire(keyword))
+                for offset in range(0, len(payload), __max_line__ - 10):
+                    self.sock.sendall(b'D ' + payload[offset:offset + __max_line__ - 10] + b'\n')
+                self.sock.sendall(b'END\n')
+
+    def transact(self, command: str, inquire: Optional[Callable[[str], bytes]] = None) -> Tuple[bytes, List[Tuple[str, str]]]:
+        """Sends one command and returns its data and status lines, reconnecting once if the agent went away"""
+        name = 'assuan ' + ' '.join(command.split(' ')[:2 if command.startswith(('SCD', 'GETINFO')) else 1])
+        with self.lock, trace.span(name, command=command) as span:
+            for attempt in (1, 2):
+                if self.sock is None:
+                    self.connect()
+                try:
+                    self.sock.sendall(escape(command.encode('utf-8')) + b'\n')
+                    data, status = self._response(inquire)
+                    span.set(bytes_out=len(data), attempts=attempt)
+                    return data, status
+                except (ConnectionError, BrokenPipeError) as e:
+                    self.close()
+                    if attempt == 2:
+                        raise e
+                except OSError:
+                    # A timeout leaves the reply pending and the next command would read it, start over instead
+                    self.close()
+                    raise
+            raise ConnectionError('Unreachable')
+
+    def getinfo(self, what: str) -> str:
+        data, _ = self.transact(f'GETINFO {what}')
+        return data.decode('utf-8', 'replace')
+
+    def getinfo_pid(self) -> int:
+        return int(self.getinfo('pid'))
+
+    def getinfo_version(self) -> str:
+        return self.getinfo('version')
+
+    def scd_reader_list(self) -> List[str]:
+        data, _ = self.transact('SCD GETINFO reader_list')
+        return [x for x in data.decode('utf-8', 'replace').split('\n') if x]
+
+    def scd_serialno(self, demand: Optional[str] = None) -> Optional[str]:
+        _, status = self.transact('SCD SERIALNO' + (f' --demand={demand}' if demand else ''))
+        return next((args.split(' ')[0] for keyword, args in status if keyword == 'SERIALNO'), None)
+
+    def scd_card_list(self) -> List[str]:
+        """Serials of every card scdaemon can reach. Needs gnupg 2.3, older ones answer with an error"""
+        _, status = self.transact('SCD GETINFO card_list')
+        return [args.split(' ')[0] for keyword, args in status if keyword == 'SERIALNO']
+
+    def scd_key_fprs(self) -> List[str]:
+        """Fingerprints of the keys in the current card, by slot"""
+        _, status = self.transact('SCD GETATTR KEY-FPR')
+        return [args.split(' ')[1].upper() for keyword, args in status if keyword == 'KEY-FPR' and len(args.split(' ')) > 1]
+
+    def scd_learn(self) -> Dict[str, List[str]]:
+        _, status = self.transact('SCD LEARN --force')
+        learned: Dict[str, List[str]] = {}
+        for keyword, args in status:
+            learned.setdefault(keyword, []).append(args)
+        return learned
+
+    def havekey(self, *keygrips: str) -> bool:
+        try:
+            self.transact('HAVEKEY ' + ' '.join(keygrips))
+            return True
+        except AssuanError:
+            return False
+
+    def killagent(self):
+        self.transact('KILLAGENT')
+        self.close()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2024, Gonzalo Alvarez
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import glob
+import time
+import hashlib
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from loguru import logger
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+__default_workers__ = min(8, os.cpu_count() or 1)
+__hash_block__ = 1024 * 1024
+
+
+@dataclass
+class BatchResult:
+    input: Path
+    output: Path
+    ok: bool
+    elapsed: float
+    size: int
+    error: Optional[str] = None
+
+
+def glob_root(pattern: str) -> Path:
+    """The leading directories of a glob, before the first part with wildcards"""
+    parts = Path(pattern).parts
+    fixed = next((idx for idx, part in enumerate(parts) if glob.has_magic(part)), len(parts))
+    return Path(*parts[:fixed]) if fixed else Path('.')
+
+
+def expand_inputs(patterns: Iterable[str]) -> List[Tuple[Path, Path]]:
+    """Expands files, globs and directories into (file, relative name) pairs. Names are relative to the directory
+    given, the glob root or, for files named one by one, their common parent, so the output mirrors the input tree"""
+    found: List[Tuple[Path, Optional[Path]]] = []
+    seen = set()
+    for pattern in patterns:
+        magic = glob.has_magic(pattern)
+        matches = glob.glob(pattern, recursive=True) if magic else [pattern]
+        if not matches:
+            logger.warning(f'Nothing matches [{pattern}]')
+        for match in sorted(matches):
+            path = Path(match)
+            if path.is_dir():
+                root = glob_root(pattern) if magic else path
+                entries = [(x, x.relative_to(root)) for x in sorted(path.rglob('*')) if x.is_file()]
+            elif path.is_file():
+                # Files named on their own are placed once the common parent of all of them is known
+                entries = [(path, path.relative_to(glob_root(pattern)) if magic else None)]
+            else:
+                logger.warning(f'Skipping [{path}], it is not a file or a directory')
+                entries = []
+            for entry, relative in entries:
+                if entry.resolve() not in seen:
+                    seen.add(entry.resolve())
+                    found.append((entry, relative))
+    loose = [x.resolve().parent for x, relative in found if relative is None]
+    parent = Path(os.path.commonpath(loose)) if loose else None
+    return [(x, relative if relative is not None else x.resolve().relative_to(parent)) for x, relative in found]
+
+
+def plan_outputs(inputs: List[Tuple[Path, Path]], output: str, rename: Callable[[Path], Path]) -> List[Tuple[Path, Path]]:
+    """Maps every input to its output file inside the output directory. Two inputs landing on the same output fail
+    before anything is written"""
+    outdir = Path(output)
+    jobs = [(source, outdir.joinpath(rename(relative))) for source, relative in inputs]
+    targets: Dict[Path, Path] = {}
+    for source, target in jobs:
+        if (other := targets.setdefault(target, source)) is not source:
+            raise Exception(f'[{other}] and [{source}] would both be written to [{target}]')
+    return jobs
+
+
+def hash_file(path: Path, algorithm: str = 'sha256') -> str:
+    """Hex digest of a file, read in blocks so big files do not end up in memory"""
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as source:
+        while block := source.read(__hash_block__):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_files(paths: Iterable[Path], workers: int = __default_workers__, algorithm: str = 'sha256') -> Dict[Path, str]:
+    """Hashes files in parallel. hashlib releases the GIL on big updates, so threads are enough"""
+    paths = list(paths)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return dict(zip(paths, pool.map(lambda x: hash_file(x, algorithm), paths)))
+
+
+def run_batch(operation: Callable[[Path, Path], Tuple[bool, Optional[str]]], jobs: List[Tuple[Path, Path]],
+              workers: int = __default_workers__) -> List[BatchResult]:
+    """Runs operation(input, output) over all the jobs with a bounded pool of workers"""
+    def worker(job):
+        source, target = job
+        start = time.perf_counter()
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            ok, error = operation(source, target)
+        except Exception as e:
+            ok, error = False, str(e)
+        return BatchResult(source, target, ok, time.perf_counter() - start, source.stat().st_size, error)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(worker, jobs))
+
+
+def report(results: List[BatchResult], elapsed: float):
+    for result in results:
+        if result.ok:
+            logger.info(f'{result.input} -> {result.output} ({result.size} bytes, {result.elapsed:.3f}s)')
+        else:
+            logger.error(f'{result.input} failed: {result.error}')
+    done = [x for x in results if x.ok]
+    total = sum(x.size for x in done)
+    rate = total / elapsed if elapsed > 0 else 0.0
+    logger.info(f'{len(done)}/{len(results)} files, {total} bytes in {elapsed:.3f}s '
+                f'({len(done) / elapsed if elapsed > 0 else 0.0:.1f} files/s, {rate / 1048576:.2f} MiB/s)')
+    return len(done) == len(results)
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2024, Gonzalo Alvarez
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import time
+import hashlib
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from loguru import logger
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Set
+
+from . import trace
+from .assuan import AssuanError
+from .runner import RunnerError
+from .smartcard import SimulatedDevice, SimulatedDeviceSource
+
+# Several cards can hold the same key material, like a YubiKey and its backups. The pool keeps which keys every
+# attached card holds, by card serial, and sends each operation to the least busy healthy card holding the key it
+# needs. A card runs one operation at a time. When a card goes away in the middle of an operation it is marked
+# unhealthy and the operation is retried on another card holding the key. A monitor thread rescans the cards when
+# the device source reports a change and pings idle cards every __health_interval__ seconds.
+#
+# Backends do the card work: cards() -> {serial: key fingerprints}, ping(serial), decrypt(serial, data) and
+# sign(serial, data, key). They raise CardRemovedError when the card is not there, anything else is the operation
+# failing and is not retried. A backend whose concurrent is False runs one operation at a time across all cards.
+#
+# AgentCardBackend is such a backend. There is one gpg-agent and one scdaemon, and gpg picks the card for an
+# operation by keygrip, not by the serial selected with SERIALNO --demand on our own connection. With it the pool
+# tracks which cards are there and fails over when one goes away, it does not run cards in parallel. Only backends
+# that drive every card on its own, like SimulatedCardBackend, get the throughput of several cards.
+#
+# SecureEnclave does not go through the pool for its own card work yet: gpg picks the card for decrypt and sign as
+# before. The pool backs card pool and callers that use it directly.
+__card_capacity__: int = 1
+__health_interval__: float = 5
+__failover_retries__: int = 2
+
+
+class CardError(Exception):
+    pass
+
+
+class CardRemovedError(CardError):
+    pass
+
+
+@dataclass
+class Card:
+    serial: str
+    keys: FrozenSet[str]
+    healthy: bool = True
+    busy: int = 0
+    operations: int = 0
+    failures: int = 0
+    last_error: Optional[str] = None
+
+
+class CardPool(object):
+    """Schedules card operations over every attached card that holds the key"""
+    def __init__(self, backend, source=None, health_interval: float = __health_interval__, retries: int = __failover_retries__):
+        self.backend = backend
+        self.source = source
+        self.health_interval = health_interval
+        self.retries = retries
+        self.cards: Dict[str, Card] = {}
+        self.condition = threading.Condition()
+        self._monitor: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    def __enter__(self):
+        self.refresh()
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def refresh(self) -> List[Card]:
+        """Rescans the cards, adding new ones and dropping the ones that are gone"""
+        with trace.span('card pool refresh') as span:
+            found = {serial: frozenset(x.upper() for x in keys) for serial, keys in self.backend.cards().items()}
+            span.set(cards=len(found))
+        with self.condition:
+            for serial in set(self.cards) - set(found):
+                logger.info(f'Card [{serial}] removed from the pool')
+                del self.cards[serial]
+            for serial, keys in found.items():
+                if (card := self.cards.get(serial)) is None:
+                    logger.info(f'Card [{serial}] added to the pool with {len(keys)} keys')
+                    self.cards[serial] = Card(serial, keys)
+                else:
+                    card.keys = keys
+                    card.healthy = True
+            self.condition.notify_all()
+            return list(self.cards.values())
+
+    def check_health(self) -> List[Card]:
+        """Pings the idle cards. Busy cards just proved they work. Returns the unhealthy ones"""
+        with self.condition:
+            idle = [x for x in self.cards.values() if not x.busy]
+        for card in idle:
+            try:
+                alive = self.backend.ping(card.serial)
+            except CardError:
+                alive = False
+            with self.condition:
+                if card.healthy != alive:
+                    logger.info(f'Card [{card.serial}] is {"back" if alive else "not answering"}')
+                card.healthy = alive
+                self.condition.notify_all()
+        with self.condition:
+            return [x for x in self.cards.values() if not x.healthy]
+
+    def holders(self, key: str) -> List[Card]:
+        with self.condition:
+            return [x for x in self.cards.values() if key.upper() in x.keys]
+
+    def _pick(self, key: str) -> Optional[Card]:
+        ready = [x for x in self.cards.values() if x.healthy and x.busy < __card_capacity__ and key in x.keys]
+        return min(ready, key=lambda x: (x.busy, x.operations)) if ready else None
+
+    @contextmanager
+    def acquire(self, key: str, timeout: Optional[float] = None):
+        """Waits for a free healthy card holding key and keeps it busy while the block runs"""
+        key = key.upper()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while (card := self._pick(key)) is None:
+                if not any(key in x.keys and x.healthy for x in self.cards.values()):
+                    raise CardError(f'No healthy card in the pool holds key [{key}]')
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f'Timed out waiting for a card holding key [{key}]')
+                self.condition.wait(remaining)
+            card.busy += 1
+        try:
+            yield card
+        finally:
+            with self.condition:
+                card.busy -= 1
+                self.condition.notify_all()
+
+    def submit(self, key: str, operation: Callable[[str], bytes], timeout: Optional[float] = None, name: str = 'card operation'):
+        """Runs operation(serial) on a card holding key, moving to another card when the one in use goes away"""
+        for attempt in range(1, self.retries + 2):
+            with self.acquire(key, timeout) as card:
+                try:
+                    with trace.span(name, serial=card.serial, attempts=attempt):
+                        result = operation(card.serial)
+                except CardRemovedError as e:
+                    with self.condition:
+                        card.healthy = False
+                        card.failures += 1
+                        card.last_error = str(e)
+                    logger.warning(f'Card [{card.serial}] failed: {e}')
+                    if attempt > self.retries:
+                        raise
+                    continue
+                with self.condition:
+                    card.operations += 1
+                return result
+
+    def decrypt(self, key: str, data: bytes, timeout: Optional[float] = None) -> bytes:
+        return self.submit(key, lambda serial: self.backend.decrypt(serial, data), timeout, 'card decrypt')
+
+    def sign(self, key: str, data: bytes, timeout: Optional[float] = None) -> bytes:
+        return self.submit(key, lambda serial: self.backend.sign(serial, data, key), timeout, 'card sign')
+
+    def map(self, key: str, function: Callable[[str, bytes], bytes], items: Iterable[bytes], workers: Optional[int] = None) -> List[bytes]:
+        """function(key, item) for every item, as many at a time as there are cards holding key when the backend
+        runs cards concurrently, one at a time otherwise"""
+        items = list(items)
+        if getattr(self.backend, 'concurrent', True):
+            workers = workers or max(1, len(self.holders(key)) * __card_capacity__)
+        else:
+            workers = 1
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(lambda x: function(key, x), items))
+
+    def start(self):
+        if self._monitor is None:
+            self._stopping.clear()
+            self._monitor = threading.Thread(target=self._watch, name='card-pool-monitor', daemon=True)
+            self._monitor.start()
+
+    def stop(self):
+        if self._monitor is not None:
+            self._stopping.set()
+            self._monitor.join()
+            self._monitor = None
+
+    def _watch(self):
+        state = self.source.scan() if self.source is not None else None
+        while not self._stopping.is_set():
+            changed = False
+            if self.source is not None:
+                self.source.wait_for_change(state, self.health_interval)
+                changed = (new_state := self.source.scan()) != state
+                state = new_state
+            else:
+                self._stopping.wait(self.health_interval)
+            if self._stopping.is_set():
+                return
+            try:
+                if changed:
+                    self.refresh()
+                elif self.check_health():
+                    self.refresh()
+            except Exception as e:
+                logger.warning(f'Card pool check failed: {e}')
+
+
+class AgentCardBackend(object):
+    """Cards reached through gpg-agent and scdaemon. scdaemon works on one card at a time, so selecting the card
+    with SERIALNO --demand and running the operation happen under one lock. The selection only checks that the card
+    is there, gpg still picks the card holding the key, so this backend gives failover and not parallel cards"""
+    concurrent = False
+
+    def __init__(self, gpg, assuan):
+        self.gpg = gpg
+        self.assuan = assuan
+        self.lock = threading.Lock()
+
+    def _select(self, serial):
+        try:
+            self.assuan.scd_serialno(demand=serial)
+        except AssuanError as e:
+            raise CardRemovedError(f'Card [{serial}] is not available: {e}')
+
+    def cards(self) -> Dict[str, Set[str]]:
+        with self.lock:
+            try:
+                serials = self.assuan.scd_card_list()
+            except AssuanError:
+                serials = [x for x in [self._current()] if x]
+            found = {}
+            for serial in serials:
+                # A card that can not be read is left out, the others still make the pool
+                try:
+                    self._select(serial)
+                    found[serial] = set(self.assuan.scd_key_fprs())
+                except (CardRemovedError, AssuanError) as e:
+                    logger.warning(f'Skipping card [{serial}]: {e}')
+            return found
+
+    def _current(self):
+        try:
+            return self.assuan.scd_serialno()
+        except AssuanError:
+            return None
+
+    def ping(self, serial) -> bool:
+        with self.lock:
+            self._select(serial)
+            return True
+
+    def _run(self, serial, args, data):
+        with self.lock:
+            self._select(serial)
+            try:
+                return self.gpg.run(args, input=data, check=True).stdout
+            except RunnerError:
+                # Tell a pulled card from a bad input
+                self._select(serial)
+                raise
+
+    def decrypt(self, serial, data: bytes) -> bytes:
+        return self._run(serial, ['--quiet', '--batch', '--decrypt'], data)
+
+    def sign(self, serial, data: bytes, key: str) -> bytes:
+        return self._run(serial, ['--quiet', '--batch', '--detach-sign', '--local-user', f'{key}!'], data)
+
+
+@dataclass
+class SimulatedCard:
+    serial: str
+    keys: Set[str]
+    latency: float = 0.0
+    present: bool = True
+    operations: int = 0
+    in_use: int = field(default=0, repr=False)
+
+
+class SimulatedCardBackend(object):
+    """Cards in memory, taking latency seconds per operation, to load test the pool without hardware. Decrypting
+    returns the data as it is and signing hashes it with the key. insert and remove also notify the device source"""
+    concurrent = True
+
+    def __init__(self, cards: Iterable[SimulatedCard] = (), source: Optional[SimulatedDeviceSource] = None):
+        self.source = source or SimulatedDeviceSource()
+        self.lock = threading.Lock()
+        self._cards: Dict[str, SimulatedCard] = {}
+        self._devices: Dict[str, SimulatedDevice] = {}
+        for card in cards:
+            self.insert(card)
+
+    def insert(self, card: SimulatedCard):
+        with self.lock:
+            card.present = True
+            self._cards[card.serial] = card
+            self._devices[card.serial] = SimulatedDevice(card.serial, len(self._devices))
+        self.source.insert(self._devices[card.serial])
+
+    def remove(self, serial: str):
+        with self.lock:
+            self._cards[serial].present = False
+        self.source.remove(self._devices[serial])
+
+    def card(self, serial: str) -> SimulatedCard:
+        return self._cards[serial]
+
+    def cards(self) -> Dict[str, Set[str]]:
+        with self.lock:
+            return {x.serial: set(x.keys) for x in self._cards.values() if x.present}
+
+    def ping(self, serial) -> bool:
+        with self.lock:
+            card = self._cards.get(serial)
+            return card is not None and card.present
+
+    def _operate(self, serial) -> SimulatedCard:
+        with self.lock:
+            card = self._cards.get(serial)
+            if card is None or not card.present:
+                raise CardRemovedError(f'Card [{serial}] is not available')
+            if card.in_use:
+                raise CardError(f'Card [{serial}] got an operation while busy')
+            card.in_use += 1
+        try:
+            # Pulling the card halfway through fails the operation
+            deadline = time.monotonic() + card.latency
+            while (remaining := deadline - time.monotonic()) > 0:
+                time.sleep(min(remaining, 0.005))
+                if not card.present:
+                    raise CardRemovedError(f'Card [{serial}] was removed')
+            card.operations += 1
+            return card
+        finally:
+            with self.lock:
+                card.in_use -= 1
+
+    def decrypt(self, serial, data: bytes) -> bytes:
+        self._operate(serial)
+        return data
+
+    def sign(self, serial, data: bytes, key: str) -> bytes:
+        self._operate(serial)
+        return hashlib.sha256(key.encode('utf-8') + data).digest()
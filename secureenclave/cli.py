@@ -1,10 +1,23 @@
 """Console script for pysecureenclave."""
 import sys
+import glob
 import click
+from pathlib import Path
 from click_loguru import ClickLoguru
-from .secureenclave import SecureEnclave
-from .cli_keycmds import key_list, key_del, key_new, key_trust, key_import
-from .cli_cardcmds import card_status, card_list
+from loguru import logger
+from .secureenclave import SecureEnclave, Needs
+from . import batch
+from . import compression as compression_
+from . import client
+from . import envelope
+from . import inject
+from . import signing
+from . import trace
+from .cli_keycmds import key_list, key_del, key_new, key_trust, key_import, key_provision
+from .cli_cardcmds import card_status, card_list, card_pool
+from .cli_agentcmds import agent_status, agent_stop
+from .cli_configcmds import config_get, config_set, config_list
+from .configstore import __cache_size__, __cache_ttl__
 
 __program__ = 'secureenclave'
 __version__ = '0.0.1'
@@ -18,31 +31,238 @@ click_loguru = ClickLoguru(__program__, __version__, stderr_format_func=lambda x
 @click_loguru.stash_subcommand()
 @click_loguru.init_logger(logfile=False)
 @click.version_option(prog_name=__program__, version=__version__)
+@click.option('--daemon/--no-daemon', default=None, help='Route commands through the secureenclave daemon. By default it is used when running')
+@click.option('--profile', is_flag=True, help='Print how long every gpg, agent and card interaction took')
+@click.option('--profile-trace', type=click.Path(dir_okay=False, writable=True), help='Write the timings as a Chrome trace (chrome://tracing, Perfetto)')
 @click.pass_context
-def cli(ctx, **kwargs):
-    pass
+def cli(ctx, daemon, profile, profile_trace, **kwargs):
+    if profile or profile_trace:
+        tracer = trace.enable()
+        ctx.call_on_close(lambda: _report_profile(tracer, profile, profile_trace))
+        ctx.with_resource(trace.span(f'secureenclave {ctx.invoked_subcommand}', command=' '.join(sys.argv[1:])))
+
+
+def _report_profile(tracer, profile, profile_trace):
+    if profile:
+        click.echo(tracer.summary(), err=True)
+    if profile_trace:
+        tracer.write(profile_trace)
+
+
+def _is_stream(inputs, output):
+    return inputs == ('-',) or output == '-'
+
+
+def _write_stream(chunks, output):
+    target = sys.stdout.buffer if output == '-' else open(output, 'wb')
+    try:
+        for chunk in chunks:
+            target.write(chunk)
+        target.flush()
+    finally:
+        if target is not sys.stdout.buffer:
+            target.close()
+
+
+def _read_stream(inputs):
+    return sys.stdin.buffer if inputs == ('-',) else open(inputs[0], 'rb')
+
+
+def _via_daemon(ctx, inputs, output, call):
+    daemon_client = client.connect(mode=ctx.find_root().params.get('daemon'))
+    if daemon_client is None:
+        return False
+    with daemon_client, _read_stream(inputs) as source:
+        _write_stream(call(daemon_client, source), output)
+    return True
+
+
+def _parse_range(ctx, param, value):
+    if value is None:
+        return None
+    start, separator, end = value.partition(':')
+    try:
+        if not separator:
+            raise ValueError()
+        start, end = int(start) if start else 0, int(end) if end else None
+    except ValueError:
+        raise click.BadParameter('Expected START:END byte offsets, either of them can be left out')
+    if start < 0 or (end is not None and end < start):
+        raise click.BadParameter('Range must satisfy 0 <= START <= END')
+    return start, end
 
 
-@cli.command(name='enc', help='Encrypt file')
+def _batch_jobs(inputs, output, rename):
+    expanded = batch.expand_inputs(inputs)
+    if not expanded:
+        raise click.UsageError('No input files found')
+    single = len(inputs) == 1 and not glob.has_magic(inputs[0]) and Path(inputs[0]).is_file()
+    if single and not Path(output).is_dir():
+        return expanded, None
+    try:
+        return expanded, batch.plan_outputs(expanded, output, rename)
+    except Exception as e:
+        raise click.UsageError(str(e))
+
+
+@cli.command(name='enc', help='Encrypt files. When several files, globs or directories are given, OUTPUT is a directory. Use - for stdin/stdout')
+@click_loguru.logging_options
+@click_loguru.init_logger(logfile=False)
+@click.argument('inputs', nargs=-1, required=True)
+@click.argument('output')
+@click.option('-r', '--recipient', 'recipients', multiple=True, help='Key to encrypt to: fingerprint, key id, email, uid or @group; a * pattern may match several keys. Repeatable. Asks for one when missing')
+@click.option('--all-trusted', is_flag=True, help='Encrypt to every fully or ultimately trusted key in the keyring')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=batch.__default_workers__, show_default=True, help='Number of parallel gpg processes')
+@click.option('--envelope', 'use_envelope', is_flag=True, help='Wrap a random data key with gpg once and encrypt the payload in parallel authenticated chunks')
+@click.option('--sync', 'sync', is_flag=True, help='Keep OUTPUT in step with the INPUTS directory: encrypt new and changed files only, '
+                                                   'delete the ones gone from it and encrypt everything again when the recipients change')
+@click.option('--armor', is_flag=True, help='ASCII armored output (.asc) instead of binary (.gpg)')
+@click.option('--compression', type=click.Choice(compression_.__modes__), default='auto', show_default=True,
+              help='auto samples every input and skips compression when it is already compressed, or uses fast ZLIB otherwise')
+@click.pass_context
+def enc(ctx, inputs, output, recipients, all_trusted, jobs, use_envelope, sync, armor, compression, **kwargs):
+    if sync:
+        if len(inputs) != 1 or not Path(inputs[0]).is_dir() or output == '-':
+            raise click.UsageError('--sync takes one source directory and an output directory')
+        if recipients or all_trusted:
+            recipients = SecureEnclave(Needs.NOTHING).resolve_recipients(recipients, all_trusted)
+        with SecureEnclave(Needs.KEYRING) as secure_enclave:
+            result = secure_enclave.sync(inputs[0], output, recipients, jobs, use_envelope, armor, compression)
+        ok = batch.report(result.results, result.elapsed) if result.results else True
+        logger.info(f'{sum(x.ok for x in result.results)} encrypted, {len(result.unchanged)} unchanged, {len(result.deleted)} deleted')
+        if not ok:
+            ctx.exit(1)
+        return
+    streaming = _is_stream(inputs, output)
+    # Asking for a key would draw the menu over the stream
+    if streaming and (len(inputs) != 1 or not (recipients or all_trusted)):
+        raise click.UsageError('Streaming takes a single input and needs --recipient when reading from stdin or writing to stdout')
+    suffix = envelope.__suffix__ if use_envelope else '.asc' if armor else '.gpg'
+    expanded, planned = (None, None) if streaming else _batch_jobs(inputs, output, lambda x: x.with_name(x.name + suffix))
+    if recipients or all_trusted:
+        recipients = SecureEnclave(Needs.NOTHING).resolve_recipients(recipients, all_trusted)
+        logger.debug(f'Encrypting to {len(recipients)} recipients')
+    daemon_encrypt = lambda x, source: x.encrypt(source, recipients, armor, compression)
+    if planned is None and recipients and not use_envelope and _via_daemon(ctx, inputs, output, daemon_encrypt):
+        return
+    with SecureEnclave(Needs.KEYRING) as secure_enclave:
+        if streaming or (planned is None and use_envelope):
+            with _read_stream(inputs) as source:
+                if use_envelope:
+                    _write_stream(secure_enclave.encrypt_envelope(source, recipients), output)
+                else:
+                    _write_stream(secure_enclave.encrypt_stream(source, recipients, armor, compression), output)
+        elif planned is None:
+            secure_enclave.encrypt(expanded[0][0].as_posix(), output, recipients, armor, compression)
+        else:
+            results, elapsed = secure_enclave.encrypt_many(planned, recipients, jobs, use_envelope, armor, compression)
+            if not batch.report(results, elapsed):
+                ctx.exit(1)
+
+
+@cli.command(name='dec', help='Decrypt files. When several files, globs or directories are given, OUTPUT is a directory. Use - for stdin/stdout')
 @click_loguru.logging_options
 @click_loguru.init_logger(logfile=False)
-@click.argument('input_file', type=click.Path(exists=True))
-@click.argument('output_file')
+@click.argument('inputs', nargs=-1, required=True)
+@click.argument('output')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=batch.__default_workers__, show_default=True, help='Number of parallel gpg processes')
+@click.option('--range', 'byte_range', callback=_parse_range, metavar='START:END', help='Only decrypt this byte range of an envelope encrypted file (END excluded)')
 @click.pass_context
-def enc(ctx, input_file, output_file, **kwargs):
-    with SecureEnclave() as secure_enclave:
-        secure_enclave.encrypt(input_file, output_file)
+def dec(ctx, inputs, output, jobs, byte_range, **kwargs):
+    streaming = _is_stream(inputs, output)
+    if streaming and len(inputs) != 1:
+        raise click.UsageError('Streaming takes a single input')
+    if byte_range is not None:
+        if len(inputs) != 1 or inputs[0] == '-' or not Path(inputs[0]).is_file():
+            raise click.UsageError('--range takes a single envelope encrypted file')
+        with SecureEnclave(Needs.AGENT | Needs.CARD) as secure_enclave, secure_enclave.open_envelope(inputs[0]) as reader:
+            _write_stream(reader.iter_range(*byte_range), output)
+        return
+    expanded, planned = (None, None) if streaming else _batch_jobs(inputs, output, lambda x: x.with_suffix('') if x.suffix in ('.asc', '.gpg', envelope.__suffix__) else x)
+    if planned is None and _via_daemon(ctx, inputs, output, lambda x, source: x.decrypt(source)):
+        return
+    with SecureEnclave(Needs.AGENT | Needs.CARD) as secure_enclave:
+        if streaming:
+            with _read_stream(inputs) as source:
+                _write_stream(secure_enclave.decrypt_stream(source), output)
+        elif planned is None:
+            secure_enclave.decrypt(expanded[0][0].as_posix(), output)
+        else:
+            results, elapsed = secure_enclave.decrypt_many(planned, jobs)
+            if not batch.report(results, elapsed):
+                ctx.exit(1)
 
 
-@cli.command(name='dec', help='Decrypt file')
+@cli.command(name='sign', help='Sign files, globs or directories with a single signature: they are hashed into a sha256sum style manifest '
+                                'and only the manifest is signed, with the card when there is one')
 @click_loguru.logging_options
 @click_loguru.init_logger(logfile=False)
-@click.argument('input_file', type=click.Path(exists=True))
-@click.argument('output_file')
+@click.argument('inputs', nargs=-1, required=True)
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help=f'Manifest to write. Defaults to {signing.__manifest_name__} in the directory '
+                                                                        'when signing one, in the current directory when it holds every file and '
+                                                                        'in the closest directory holding them all otherwise')
+@click.option('-u', '--local-user', 'signer', help='Key to sign with')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=batch.__default_workers__, show_default=True, help='Number of files hashed in parallel')
 @click.pass_context
-def dec(ctx, input_file, output_file, **kwargs):
-    with SecureEnclave() as secure_enclave:
-        secure_enclave.decrypt(input_file, output_file)
+def sign(ctx, inputs, output, signer, jobs, **kwargs):
+    files = [path for path, _ in batch.expand_inputs(inputs)]
+    if not files:
+        raise click.UsageError('No input files found')
+    if output is None:
+        output = Path(signing.default_base(inputs, files), signing.__manifest_name__)
+    with SecureEnclave(Needs.AGENT | Needs.CARD) as secure_enclave:
+        signature = secure_enclave.sign_files(files, Path(output), signer, jobs)
+    logger.info(f'{len(files)} files in [{output}], signed in [{signature}]')
+
+
+@cli.command(name='verify', help='Verify a manifest written by sign: one signature check and the files hashed again in parallel')
+@click_loguru.logging_options
+@click_loguru.init_logger(logfile=False)
+@click.argument('manifest', type=click.Path(exists=True, dir_okay=False))
+@click.option('-s', '--signature', type=click.Path(exists=True, dir_okay=False), help=f'Detached signature. Defaults to MANIFEST{signing.__signature_suffix__}')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=batch.__default_workers__, show_default=True, help='Number of files hashed in parallel')
+@click.option('--signer', metavar='FPR', help='Fingerprint of the key the manifest must be signed with. '
+                                             'Without it the signing key must be at least marginally trusted')
+@click.pass_context
+def verify(ctx, manifest, signature, jobs, signer, **kwargs):
+    with SecureEnclave(Needs.KEYRING) as secure_enclave:
+        result = secure_enclave.verify_files(manifest, signature, jobs, signer)
+    logger.info(f'Good signature from [{result.signer}] (trust {result.trust})')
+    for name in result.mismatched:
+        logger.error(f'{name}: content changed')
+    for name in result.missing:
+        logger.error(f'{name}: missing')
+    logger.info(f'{result.checked - len(result.mismatched) - len(result.missing)}/{result.checked} files verified')
+    if not result.ok:
+        ctx.exit(1)
+
+
+def _parse_bindings(ctx, param, values):
+    try:
+        return [inject.parse_binding(x) for x in values]
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+@cli.command(name='run', help='Decrypt secrets in memory and run COMMAND with them, e.g. run -e TOKEN=token.asc -f TLS_KEY=key.pem.sev -- server. '
+                               'Nothing is written to disk')
+@click_loguru.logging_options
+@click_loguru.init_logger(logfile=False)
+@click.argument('command', nargs=-1, required=True, type=click.UNPROCESSED)
+@click.option('-e', '--env', 'env_secrets', multiple=True, callback=_parse_bindings, metavar='NAME=FILE',
+              help='Put the decrypted FILE in the environment variable NAME, without its trailing new lines. Repeatable')
+@click.option('-f', '--file', 'file_secrets', multiple=True, callback=_parse_bindings, metavar='NAME=FILE',
+              help='Hand the decrypted FILE over in an in memory file and set NAME to its /dev/fd path. Repeatable')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=batch.__default_workers__, show_default=True, help='Number of secrets decrypted in parallel')
+@click.pass_context
+def run(ctx, command, env_secrets, file_secrets, jobs, **kwargs):
+    executable = inject.find_executable(command[0])
+    with SecureEnclave(Needs.AGENT | Needs.CARD) as secure_enclave:
+        env, _ = inject.prepare(secure_enclave, env_secrets, file_secrets, jobs)
+    logger.debug(f'Running [{" ".join(command)}] with {len(env_secrets) + len(file_secrets)} secrets')
+    # Exec does not come back, so close the context now for --profile and the agent
+    ctx.find_root().close()
+    inject.execute(executable, list(command), env)
 
 
 @cli.group(help='Key related operations')
@@ -58,6 +278,7 @@ key.add_command(key_del)
 key.add_command(key_new)
 key.add_command(key_list)
 key.add_command(key_import)
+key.add_command(key_provision)
 
 
 @cli.group(help='Smart Card related operations')
@@ -69,6 +290,42 @@ def card(ctx, **kwargs):
 
 card.add_command(card_status)
 card.add_command(card_list)
+card.add_command(card_pool)
+
+
+@cli.group(help='gpg-agent related operations. The agent is kept alive between commands and stops after '
+                'SECUREENCLAVE_AGENT_IDLE_TIMEOUT seconds idle (0 stops it after every command)')
+@click_loguru.logging_options
+@click_loguru.init_logger(logfile=False)
+@click.pass_context
+def agent(ctx, **kwargs):
+    pass
+
+agent.add_command(agent_status)
+agent.add_command(agent_stop)
+
+
+@cli.group(help='Secure configuration stored encrypted in the enclave')
+@click_loguru.logging_options
+@click_loguru.init_logger(logfile=False)
+@click.pass_context
+def config(ctx, **kwargs):
+    pass
+
+config.add_command(config_get)
+config.add_command(config_set)
+config.add_command(config_list)
+
+
+@cli.command(name='daemon', help='Serve enclave operations to local clients over a Unix socket, keeping agent, card state and keyring index warm')
+@click_loguru.logging_options
+@click_loguru.init_logger(logfile=False)
+@click.option('--cache-size', type=click.IntRange(min=0), default=__cache_size__, show_default=True, help='Decrypted configuration values kept in memory')
+@click.option('--cache-ttl', type=click.FloatRange(min=0), default=__cache_ttl__, show_default=True, help='Seconds a decrypted configuration value stays in memory')
+@click.pass_context
+def daemon(ctx, cache_size, cache_ttl, **kwargs):
+    from .daemon import serve
+    serve(cache_size=cache_size, cache_ttl=cache_ttl)
 
 
 @cli.command(name='purge', help='Removes configuration from this machine, including all trusted keys')
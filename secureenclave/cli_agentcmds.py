@@ -0,0 +1,38 @@
+"""Console scripts for gpg-agent handling"""
+import click
+from loguru import logger
+from click_loguru import ClickLoguru
+from .secureenclave import SecureEnclave, Needs
+
+__all__ = ['agent_status', 'agent_stop']
+
+__program__ = 'secureenclave'
+__version__ = '0.0.1'
+
+log_format = "<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>\n"
+click_loguru = ClickLoguru(__program__, __version__, stderr_format_func=lambda x: log_format)
+
+@click.command(name='status', help='Show whether a gpg-agent is running for the enclave')
+@click_loguru.logging_options
+@click_loguru.init_logger(logfile=False)
+@click.pass_context
+def agent_status(ctx, **kwargs):
+    secure_enclave = SecureEnclave(Needs.NOTHING)
+    if pid := secure_enclave.gpg_agent.find_running():
+        idle = secure_enclave.gpg_agent.idle_time()
+        logger.info(f'gpg-agent running with pid {pid}, idle for {idle or 0:.0f} seconds '
+                    f'(stops after {secure_enclave.agent_idle_timeout} seconds idle)')
+    else:
+        logger.info('No gpg-agent running')
+
+
+@click.command(name='stop', help='Stop the gpg-agent kept alive between commands')
+@click_loguru.logging_options
+@click_loguru.init_logger(logfile=False)
+@click.pass_context
+def agent_stop(ctx, **kwargs):
+    secure_enclave = SecureEnclave(Needs.NOTHING)
+    if secure_enclave.gpg_agent.shutdown():
+        logger.info('gpg-agent stopped')
+    else:
+        logger.info('No gpg-agent running')
@@ -2,9 +2,10 @@
 import click
 from loguru import logger
 from click_loguru import ClickLoguru
-from .secureenclave import SecureEnclave
+from . import client
+from .secureenclave import SecureEnclave, Needs
 
-__all__ = ['card_list', 'card_status']
+__all__ = ['card_list', 'card_pool', 'card_status']
 
 __program__ = 'secureenclave'
 __version__ = '0.0.1'
@@ -15,21 +16,43 @@ click_loguru = ClickLoguru(__program__, __version__, stderr_format_func=lambda x
 @click.command(name='status', help='Show Status of Key Card')
 @click_loguru.logging_options
 @click_loguru.init_logger(logfile=False)
+@click.option('-t', '--timeout', type=float, help='Seconds to wait for the card to be inserted. Waits forever when missing')
 @click.pass_context
-def card_status(ctx, **kwargs):
-    with SecureEnclave() as secure_enclave:
+def card_status(ctx, timeout, **kwargs):
+    if daemon_client := client.connect(mode=ctx.find_root().params.get('daemon')):
+        with daemon_client:
+            click.echo(daemon_client.status(verbose=True)['card_status'], nl=False)
+        return
+    with SecureEnclave(Needs.AGENT | Needs.CARD) as secure_enclave:
         logger.info('Waiting for smart card to be inserted')
-        secure_enclave.smartcard.wait_for_it()
+        secure_enclave.smartcard.wait_for_it(timeout)
         secure_enclave.card_status()
 
 
 @click.command(name='list', help='List cards')
 @click_loguru.logging_options
 @click_loguru.init_logger(logfile=False)
+@click.option('-t', '--timeout', type=float, help='Seconds to wait for the card to be inserted. Waits forever when missing')
 @click.pass_context
-def card_list(ctx, **kwargs):
-    with SecureEnclave() as secure_enclave:
+def card_list(ctx, timeout, **kwargs):
+    with SecureEnclave(Needs.AGENT | Needs.CARD) as secure_enclave:
         logger.info('Waiting for smart card to be inserted')
-        secure_enclave.smartcard.wait_for_it()
+        secure_enclave.smartcard.wait_for_it(timeout)
         secure_enclave.card_list()
 
+
+
+@click.command(name='pool', help='List the cards scdaemon reaches by serial, with the keys each one holds and whether it answers')
+@click_loguru.logging_options
+@click_loguru.init_logger(logfile=False)
+@click.option('-t', '--timeout', type=float, help='Seconds to wait for the card to be inserted. Waits forever when missing')
+@click.pass_context
+def card_pool(ctx, timeout, **kwargs):
+    with SecureEnclave(Needs.AGENT) as secure_enclave:
+        logger.info('Waiting for smart card to be inserted')
+        secure_enclave.smartcard.wait_for_it(timeout)
+        pool = secure_enclave.card_pool()
+        pool.refresh()
+        pool.check_health()
+        for card in pool.cards.values():
+            click.echo(f'{card.serial} {"ok" if card.healthy else "failing"} {" ".join(sorted(card.keys))}')
@@ -0,0 +1,64 @@
+"""Console scripts for the configuration store"""
+import sys
+import click
+from click_loguru import ClickLoguru
+from . import client
+from .configstore import ConfigStore, wipe
+from .secureenclave import SecureEnclave, Needs
+
+__all__ = ['config_get', 'config_set', 'config_list']
+
+__program__ = 'secureenclave'
+__version__ = '0.0.1'
+
+log_format = "<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>\n"
+click_loguru = ClickLoguru(__program__, __version__, stderr_format_func=lambda x: log_format)
+
+@click.command(name='get', help='Print a configuration value')
+@click_loguru.logging_options
+@click_loguru.init_logger(logfile=False)
+@click.argument('name')
+@click.pass_context
+def config_get(ctx, name, **kwargs):
+    if daemon_client := client.connect(mode=ctx.find_root().params.get('daemon')):
+        with daemon_client:
+            value = daemon_client.config_get(name)
+    else:
+        with SecureEnclave(Needs.AGENT | Needs.CARD) as secure_enclave:
+            value = ConfigStore(secure_enclave).get(name)
+    try:
+        sys.stdout.buffer.write(value)
+        sys.stdout.buffer.flush()
+    finally:
+        wipe(value)
+
+
+@click.command(name='set', help='Store a configuration value, read from stdin when VALUE is missing')
+@click_loguru.logging_options
+@click_loguru.init_logger(logfile=False)
+@click.argument('name')
+@click.argument('value', required=False)
+@click.option('-r', '--recipient', help='Fingerprint of the key to encrypt with. Asks for it when missing')
+@click.pass_context
+def config_set(ctx, name, value, recipient, **kwargs):
+    data = value.encode('utf-8') if value is not None else sys.stdin.buffer.read()
+    if recipient and (daemon_client := client.connect(mode=ctx.find_root().params.get('daemon'))):
+        with daemon_client:
+            daemon_client.config_set(name, data, recipient)
+        return
+    with SecureEnclave(Needs.KEYRING) as secure_enclave:
+        ConfigStore(secure_enclave).set(name, data, recipient)
+
+
+@click.command(name='list', help='List configuration names')
+@click_loguru.logging_options
+@click_loguru.init_logger(logfile=False)
+@click.pass_context
+def config_list(ctx, **kwargs):
+    if daemon_client := client.connect(mode=ctx.find_root().params.get('daemon')):
+        with daemon_client:
+            names = daemon_client.config_list()
+    else:
+        names = ConfigStore(SecureEnclave(Needs.NOTHING)).list()
+    for name in names:
+        click.echo(name)
@@ -1,9 +1,14 @@
 """Console scripts for key handling"""
+import sys
 import click
 from click_loguru import ClickLoguru
-from .secureenclave import SecureEnclave
+from loguru import logger
+from . import batch
+from . import client
+from . import provision
+from .secureenclave import SecureEnclave, Needs, __ownertrust__
 
-__all__ = ['key_list', 'key_del', 'key_new', 'key_trust']
+__all__ = ['key_list', 'key_del', 'key_new', 'key_trust', 'key_import', 'key_provision']
 
 __program__ = 'secureenclave'
 __version__ = '0.0.1'
@@ -16,18 +21,69 @@ click_loguru = ClickLoguru(__program__, __version__, stderr_format_func=lambda x
 @click_loguru.init_logger(logfile=False)
 @click.pass_context
 def key_list(ctx, **kwargs):
-    with SecureEnclave() as secure_enclave:
+    if daemon_client := client.connect(mode=ctx.find_root().params.get('daemon')):
+        with daemon_client:
+            for key in daemon_client.list_keys():
+                click.echo(f'{key.pub} {key.fingerprint} [{key.trust}] {key.uid}')
+        return
+    with SecureEnclave(Needs.KEYRING) as secure_enclave:
         secure_enclave.list_keys()
 
 
-@click.command(name='import', help='List keys')
+@click.command(name='import', help='Import keys from files, directories, globs or - for a bundle on stdin. '
+                                    'Keys the keyring already has as they are are skipped, files that hold no keys too, and the rest go in one gpg run')
 @click_loguru.logging_options
 @click_loguru.init_logger(logfile=False)
-@click.argument('input_file', type=click.Path(exists=True))
+@click.argument('inputs', nargs=-1, required=True)
+@click.option('--force', is_flag=True, help='Import keys the keyring already has too, e.g. to pick up new signatures')
 @click.pass_context
-def key_import(ctx, input_file, **kwargs):
-    with SecureEnclave() as secure_enclave:
-        secure_enclave.import_key(input_file)
+def key_import(ctx, inputs, force, **kwargs):
+    bundles = [sys.stdin.buffer.read()] if '-' in inputs else []
+    names = ['-'] if '-' in inputs else []
+    for path, _ in batch.expand_inputs(x for x in inputs if x != '-'):
+        bundles.append(path.read_bytes())
+        names.append(path.as_posix())
+    if not bundles:
+        raise click.UsageError('No keys to import')
+    with SecureEnclave(Needs.KEYRING) as secure_enclave:
+        summary = secure_enclave.import_keys(bundles, force, names)
+    logger.info('{new} new, {updated} updated, {unchanged} unchanged, {secret} secret keys imported. '
+                '{skipped} already in the keyring were skipped'.format(**summary))
+
+
+@click.command(name='provision', help='Generate every key described in SPEC without prompts. SPEC is an ini file with a section per key '
+                                      '(name, email, comment, type, expire, subkeys, passphrase-env) and optional [defaults]')
+@click_loguru.logging_options
+@click_loguru.init_logger(logfile=False)
+@click.argument('spec', type=click.File('r'))
+@click.option('--passphrase-stdin', is_flag=True, help='Read the passphrase for keys without passphrase-env from the first line of stdin')
+@click.option('--no-protection', is_flag=True, help='Keys without passphrase-env get no passphrase')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=batch.__default_workers__, show_default=True,
+              help='Keys getting their subkeys at once. The agent generates and protects them in parallel, keyring writes go one at a time')
+@click.pass_context
+def key_provision(ctx, spec, passphrase_stdin, no_protection, jobs, **kwargs):
+    identities = provision.load_spec(spec.read())
+    if passphrase_stdin and no_protection:
+        raise click.UsageError('--passphrase-stdin and --no-protection do not go together')
+    if any(x.passphrase is None for x in identities) and not no_protection:
+        if passphrase_stdin:
+            passphrase = sys.stdin.readline().rstrip('\r\n')
+        else:
+            passphrase = click.prompt('Passphrase for the new keys', hide_input=True, confirmation_prompt=True)
+        if not passphrase:
+            raise click.UsageError('Empty passphrase, use --no-protection for keys without one')
+        for identity in (x for x in identities if x.passphrase is None):
+            identity.passphrase = passphrase
+    with SecureEnclave(Needs.KEYRING | Needs.AGENT) as secure_enclave:
+        outcomes = secure_enclave.provision_keys(identities, jobs)
+    for outcome in outcomes:
+        if outcome.ok:
+            click.echo(f'{outcome.fingerprint} {outcome.identity.handle} {outcome.identity.uid}')
+        else:
+            logger.error(f'[{outcome.identity.handle}] {outcome.error}')
+    logger.info(f'{sum(x.ok for x in outcomes)}/{len(outcomes)} keys created')
+    if not all(x.ok for x in outcomes):
+        ctx.exit(1)
 
 
 @click.command(name='new', help='New key generation')
@@ -35,7 +91,7 @@ def key_import(ctx, input_file, **kwargs):
 @click_loguru.init_logger(logfile=False)
 @click.pass_context
 def key_new(ctx, **kwargs):
-    with SecureEnclave() as secure_enclave:
+    with SecureEnclave(Needs.KEYRING | Needs.AGENT) as secure_enclave:
         secure_enclave.new_key()
 
 
@@ -44,14 +100,38 @@ def key_new(ctx, **kwargs):
 @click_loguru.init_logger(logfile=False)
 @click.pass_context
 def key_del(ctx, **kwargs):
-    with SecureEnclave() as secure_enclave:
+    with SecureEnclave(Needs.KEYRING | Needs.AGENT) as secure_enclave:
         secure_enclave.del_key()
 
 
-@click.command(name='trust', help='Trust a specific key from the list')
+@click.command(name='trust', help='Trust keys with a single trustdb update. KEYS are fingerprints, key ids, uid patterns or @groups. '
+                                   'Without KEYS, --from-file or --all it asks about every key that is not trusted yet')
 @click_loguru.logging_options
 @click_loguru.init_logger(logfile=False)
+@click.argument('keys', nargs=-1)
+@click.option('-f', '--from-file', type=click.File('r'), help='Read KEYS from this file, one per line. # starts a comment, - is stdin')
+@click.option('--all', 'all_keys', is_flag=True, help='Every key in the keyring')
+@click.option('--level', type=click.Choice(list(__ownertrust__)), default='ultimate', show_default=True, help='Ownertrust to set')
+@click.option('-y', '--yes', is_flag=True, help='Do not ask for confirmation')
 @click.pass_context
-def key_trust(ctx, **kwargs):
-    with SecureEnclave() as secure_enclave:
-        secure_enclave.trust_keys()
+def key_trust(ctx, keys, from_file, all_keys, level, yes, **kwargs):
+    specs = list(keys) + ([line.split('#')[0].strip() for line in from_file] if from_file else [])
+    specs = [x for x in specs if x]
+    with SecureEnclave(Needs.KEYRING) as secure_enclave:
+        if specs or all_keys:
+            selected = secure_enclave.gpg.get_keys() if all_keys else secure_enclave.find_keys(specs)
+            pending = [x for x in selected if x.ownertrust != level]
+            if not pending:
+                logger.info(f'All {len(selected)} keys are already trusted {level}')
+                return
+            for key in pending:
+                click.echo(f'{key.fingerprint} [{key.ownertrust}] {key.uid}')
+            if not yes:
+                click.confirm(f'Set the ownertrust of these {len(pending)} keys to {level}?', abort=True)
+            changes = secure_enclave.set_ownertrust([x.fingerprint for x in pending], level)
+        else:
+            changes = secure_enclave.trust_keys(level)
+        for key, before, after in changes:
+            before = before or ('-', '-')
+            click.echo(f'{key.fingerprint} ownertrust {before[0]} -> {after[0]}, validity {before[1]} -> {after[1]} {key.uid}')
+        logger.info(f'Trust changed for {len(changes)} keys')
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2024, Gonzalo Alvarez
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import socket
+import threading
+
+from loguru import logger
+from pathlib import Path
+from typing import Iterator, List, Optional, Union
+
+from . import protocol
+from . import trace
+from .gpg import GpgKey, iter_chunks
+from .secureenclave import enclave_home
+
+
+def socket_path(home=None):
+    return (home or enclave_home()).joinpath('daemon.sock')
+
+
+class DaemonError(Exception):
+    pass
+
+
+class DaemonClient(object):
+    """Client for a running secureenclave daemon. One connection, one request at a time"""
+    def __init__(self, path, timeout: Optional[float] = None):
+        self.path = Path(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(self.path.as_posix())
+        except OSError:
+            self.sock.close()
+            raise
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _trailer(self) -> dict:
+        trailer = protocol.recv_header(self.sock)
+        if trailer is None:
+            raise DaemonError('Daemon closed the connection')
+        if not trailer.pop('ok'):
+            raise DaemonError(trailer.get('error'))
+        return trailer
+
+    def call(self, op: str, **args) -> dict:
+        with trace.span(f'daemon {op}'):
+            protocol.send_header(self.sock, dict(args, op=op))
+            protocol.send_body(self.sock, [])
+            for _ in protocol.recv_body(self.sock):
+                pass
+            return self._trailer()
+
+    def stream(self, op: str, source, **args) -> Iterator[bytes]:
+        """Sends source as the request body while yielding the response body"""
+        with trace.span(f'daemon {op}') as span:
+            protocol.send_header(self.sock, dict(args, op=op))
+            sender = threading.Thread(target=protocol.send_body, args=(self.sock, iter_chunks(source)), daemon=True)
+            sender.start()
+            received = 0
+            try:
+                for chunk in protocol.recv_body(self.sock):
+                    received += len(chunk)
+                    yield chunk
+            finally:
+                sender.join()
+                span.set(bytes_out=received)
+            self._trailer()
+
+    def ping(self) -> int:
+        return self.call('ping')['pid']
+
+    def list_keys(self) -> List[GpgKey]:
+        return [GpgKey(**x) for x in self.call('list')['keys']]
+
+    def status(self, verbose: bool = False) -> dict:
+        return self.call('status', verbose=verbose)
+
+    def encrypt(self, source, recipients: Union[str, List[str]], armor: bool = False, compression: str = 'auto') -> Iterator[bytes]:
+        return self.stream('encrypt', source, recipient=recipients, armor=armor, compression=compression)
+
+    def decrypt(self, source) -> Iterator[bytes]:
+        return self.stream('decrypt', source)
+
+    def config_get(self, name: str) -> bytearray:
+        value = bytearray()
+        for chunk in self.stream('config_get', b'', name=name):
+            value += chunk
+        return value
+
+    def config_set(self, name: str, value: bytes, recipient: str):
+        for _ in self.stream('config_set', value, name=name, recipient=recipient):
+            pass
+
+    def config_list(self) -> List[str]:
+        return self.call('config_list')['names']
+
+
+def connect(path=None, mode: Optional[bool] = None) -> Optional[DaemonClient]:
+    """Connects to the daemon. mode False never does, None does when one answers and True insists"""
+    path = path or socket_path()
+    if mode is False:
+        return None
+    try:
+        client = DaemonClient(path)
+        client.ping()
+        logger.debug(f'Routing through daemon at [{path}]')
+        return client
+    except (OSError, DaemonError, protocol.ProtocolError) as e:
+        if mode:
+            raise DaemonError(f'No daemon answering at [{path}]: {e}')
+        return None
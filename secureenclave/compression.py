@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2024, Gonzalo Alvarez
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import math
+
+from collections import Counter
+from loguru import logger
+from typing import List
+
+# gpg compresses with ZLIB at level 6 unless told otherwise, which is wasted time on tarballs, images and anything
+# else that is already compressed. In auto mode a few blocks of the input are sampled: when their byte entropy is
+# close to 8 bits there is nothing to gain and compression is skipped, otherwise ZLIB runs at its fastest level.
+__modes__ = ('auto', 'none', 'fast', 'default')
+__gpg_args__ = {'none': ['--compress-algo', 'none'],
+                'fast': ['--compress-algo', 'zlib', '--compress-level', '1'],
+                'default': []}
+__block_size__: int = 16 * 1024
+__blocks__: int = 4
+__sample_size__: int = __block_size__ * __blocks__
+__incompressible__: float = 7.5
+
+
+def entropy(data: bytes) -> float:
+    """Shannon entropy in bits per byte"""
+    if not data:
+        return 0.0
+    total = len(data)
+    return -sum(count / total * math.log2(count / total) for count in Counter(data).values())
+
+
+def sample_file(path) -> bytes:
+    """A few blocks spread over the file, so a compressed payload after a text header is still noticed"""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as source:
+        if size <= __sample_size__:
+            return source.read()
+        blocks = []
+        for idx in range(__blocks__):
+            source.seek((size - __block_size__) * idx // (__blocks__ - 1))
+            blocks.append(source.read(__block_size__))
+        return b''.join(blocks)
+
+
+def choose(sample: bytes) -> str:
+    bits = entropy(sample)
+    mode = 'none' if bits >= __incompressible__ else 'fast'
+    logger.debug(f'Sampled entropy {bits:.2f} bits per byte, compression {mode}')
+    return mode
+
+
+def gpg_args(mode: str, sample: bytes = b'') -> List[str]:
+    """gpg options for a compression mode. auto picks one from the sample"""
+    if mode not in __modes__:
+        raise Exception(f'Unknown compression mode [{mode}], use one of {", ".join(__modes__)}')
+    return __gpg_args__[choose(sample) if mode == 'auto' else mode]
+
+
+def gpg_args_for_file(mode: str, path) -> List[str]:
+    return gpg_args(mode, sample_file(path) if mode == 'auto' else b'')
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2024, Gonzalo Alvarez
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import re
+import time
+import threading
+
+from collections import OrderedDict
+from loguru import logger
+from typing import List, Optional, Tuple
+
+__cache_ttl__: float = 300
+__cache_size__: int = 256
+__name_pattern__ = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_.-]*$')
+
+
+def wipe(value: bytearray):
+    """Overwrites a secret in place with zeros"""
+    value[:] = bytes(len(value))
+
+
+class SecretCache(object):
+    """Bounded cache of decrypted values with TTL and LRU eviction. Evicted values are zeroed in place"""
+    def __init__(self, max_entries: int = __cache_size__, ttl: float = __cache_ttl__, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.entries: 'OrderedDict[str, Tuple[bytearray, float, object]]' = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _evict(self, name: str):
+        value, _, _ = self.entries.pop(name)
+        wipe(value)
+
+    def get(self, name: str, version: object = None) -> Optional[bytearray]:
+        """A copy of the cached value, the caller can wipe it when done"""
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                return None
+            value, expires, cached_version = entry
+            if expires <= self.clock() or cached_version != version:
+                self._evict(name)
+                return None
+            self.entries.move_to_end(name)
+            return bytearray(value)
+
+    def put(self, name: str, value: bytes, version: object = None):
+        if self.max_entries <= 0 or self.ttl <= 0:
+            return
+        with self.lock:
+            if name in self.entries:
+                self._evict(name)
+            self.entries[name] = (bytearray(value), self.clock() + self.ttl, version)
+            while len(self.entries) > self.max_entries:
+                self._evict(next(iter(self.entries)))
+
+    def discard(self, name: str):
+        with self.lock:
+            if name in self.entries:
+                self._evict(name)
+
+    def clear(self):
+        with self.lock:
+            for name in list(self.entries):
+                self._evict(name)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ConfigStore(object):
+    """Named secrets kept encrypted under the enclave home, decrypted on demand through the cache"""
+    def __init__(self, secure_enclave, cache: Optional[SecretCache] = None):
+        self.secure_enclave = secure_enclave
+        self.cache = cache if cache is not None else SecretCache()
+        self.root = secure_enclave.home.joinpath('config')
+
+    def path(self, name: str):
+        if not __name_pattern__.match(name):
+            raise Exception(f'Invalid configuration name [{name}]')
+        return self.root.joinpath(f'{name}.gpg')
+
+    @staticmethod
+    def _version(path):
+        stat = os.stat(path)
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def list(self) -> List[str]:
+        if not self.root.exists():
+            return []
+        return sorted(x.name[:-len('.gpg')] for x in self.root.glob('*.gpg'))
+
+    def get(self, name: str) -> bytearray:
+        """The decrypted value in a buffer of its own, for the caller to wipe once used"""
+        path = self.path(name)
+        try:
+            version = self._version(path)
+        except FileNotFoundError:
+            self.cache.discard(name)
+            raise Exception(f'No configuration named [{name}]')
+        if (value := self.cache.get(name, version)) is not None:
+            logger.debug(f'Configuration [{name}] served from cache')
+            return value
+        value = bytearray()
+        with path.open('rb') as source:
+            for chunk in self.secure_enclave.decrypt_stream(source):
+                value += chunk
+        self.cache.put(name, value, version)
+        return value
+
+    def set(self, name: str, value: bytes, recipient: Optional[str] = None):
+        path = self.path(name)
+        self.root.mkdir(mode=0o700, parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+        try:
+            with tmp_path.open('wb') as target:
+                for chunk in self.secure_enclave.encrypt_stream(value, recipient):
+                    target.write(chunk)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        self.cache.put(name, value, self._version(path))
+        logger.debug(f'Configuration [{name}] stored')
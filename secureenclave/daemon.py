@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2024, Gonzalo Alvarez
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import socket
+import signal
+import threading
+import socketserver
+
+from dataclasses import asdict
+from loguru import logger
+
+from . import protocol
+from .client import socket_path
+from .configstore import ConfigStore, SecretCache, wipe, __cache_size__, __cache_ttl__
+from .secureenclave import SecureEnclave, Needs
+
+
+class EnclaveRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # A client can go away at any point, also while the rest of a failed request is drained
+        try:
+            while (header := protocol.recv_header(self.request)) is not None:
+                self.serve(header, protocol.recv_body(self.request))
+        except (protocol.ProtocolError, OSError) as e:
+            logger.debug(f'Dropping client: {e}')
+
+    def serve(self, header, body):
+        operation = getattr(self.server, 'op_{}'.format(header.get('op')), None)
+        try:
+            if operation is None:
+                raise Exception('Unknown operation [{}]'.format(header.get('op')))
+            self.server.secure_enclave.gpg_agent.touch()
+            result = operation(header, body)
+            if isinstance(result, dict):
+                protocol.send_body(self.request, [])
+                trailer = dict(result, ok=True)
+            else:
+                protocol.send_body(self.request, result)
+                trailer = {'ok': True}
+        except (protocol.ProtocolError, OSError):
+            raise
+        except Exception as e:
+            logger.debug(f'Operation [{header.get("op")}] failed: {e}')
+            protocol.send_body(self.request, [])
+            trailer = {'ok': False, 'error': str(e)}
+        for _ in body:
+            pass
+        protocol.send_header(self.request, trailer)
+
+
+class EnclaveDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves a warm SecureEnclave to local clients, one thread per connection"""
+    daemon_threads = True
+
+    def __init__(self, secure_enclave, path, cache=None):
+        self.secure_enclave = secure_enclave
+        self.config_store = ConfigStore(secure_enclave, cache)
+        self.path = path
+        old_umask = os.umask(0o077)
+        try:
+            super().__init__(path.as_posix(), EnclaveRequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def op_ping(self, header, body):
+        return {'pid': os.getpid()}
+
+    def op_list(self, header, body):
+        return {'keys': [asdict(x) for x in self.secure_enclave.gpg.get_keys()]}
+
+    def op_status(self, header, body):
+        secure_enclave = self.secure_enclave
+        status = {'card_pub': getattr(secure_enclave, 'card_pub', None), 'agent_pid': secure_enclave.gpg_agent.find_running()}
+        try:
+            status['readers'] = secure_enclave.gpg_agent.list_readers()
+        except Exception:
+            status['readers'] = []
+        if header.get('verbose'):
+            status['card_status'] = secure_enclave.card_status_text()
+        return status
+
+    def op_encrypt(self, header, body):
+        if not header.get('recipient'):
+            raise Exception('The daemon can only encrypt to an explicit recipient')
+        return self.secure_enclave.encrypt_stream(body, header['recipient'], header.get('armor', False), header.get('compression', 'auto'))
+
+    def op_decrypt(self, header, body):
+        return self.secure_enclave.decrypt_stream(body)
+
+    def op_config_get(self, header, body):
+        value = self.config_store.get(header['name'])
+        def send():
+            try:
+                yield value
+            finally:
+                wipe(value)
+        return send()
+
+    def op_config_set(self, header, body):
+        if not header.get('recipient'):
+            raise Exception('The daemon can only encrypt to an explicit recipient')
+        self.config_store.set(header['name'], b''.join(body), header['recipient'])
+        return {}
+
+    def op_config_list(self, header, body):
+        return {'names': self.config_store.list()}
+
+
+def _clear_stale_socket(path):
+    if not path.exists():
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path.as_posix())
+        raise Exception(f'A daemon is already listening on [{path}]')
+    except (ConnectionRefusedError, FileNotFoundError):
+        path.unlink(missing_ok=True)
+    finally:
+        probe.close()
+
+
+def serve(path=None, cache_size=__cache_size__, cache_ttl=__cache_ttl__):
+    path = path or socket_path()
+    with SecureEnclave(Needs.ALL) as secure_enclave:
+        _clear_stale_socket(path)
+        server = EnclaveDaemon(secure_enclave, path, SecretCache(cache_size, cache_ttl))
+        stop = lambda signum, frame: threading.Thread(target=server.shutdown).start()
+        signal.signal(signal.SIGTERM, stop)
+        logger.info(f'Listening on [{path}]')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            server.config_store.cache.clear()
+            path.unlink(missing_ok=True)
+            logger.info('Daemon stopped')
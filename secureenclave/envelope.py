@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2024, Gonzalo Alvarez
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import io
+import os
+import mmap
+import struct
+import hashlib
+import itertools
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from .gpg import iter_chunks
+
+# Layout: magic, chunk size, wrapped key length, wrapped key (an OpenPGP message holding the data key),
+# then the payload in chunks of chunk size plaintext bytes, each sealed with AES-256-GCM and followed by its tag.
+# The nonce is the chunk index and the additional data binds each chunk to the header, its index and whether
+# it is the last one, so chunks can not be reordered, moved between files or truncated away.
+# As every chunk but the last has the same size, the offset of any chunk follows from its index and the
+# file size tells how many there are, so ranges can be decrypted without touching the rest of the file.
+__magic__: bytes = b'SEENV\x00\x01\x00'
+__header__ = struct.Struct('>8sII')
+__tag_size__: int = 16
+__key_size__: int = 32
+__chunk_size__: int = 1024 * 1024
+__default_workers__: int = os.cpu_count() or 1
+__suffix__: str = '.sev'
+
+
+class EnvelopeError(Exception):
+    pass
+
+
+def _aesgcm(key: bytes):
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    return AESGCM(key)
+
+
+def _nonce(index: int) -> bytes:
+    return index.to_bytes(12, 'big')
+
+
+def _aad(header_digest: bytes, index: int, final: bool) -> bytes:
+    return header_digest + struct.pack('>QB', index, 1 if final else 0)
+
+
+def is_envelope(prefix: bytes) -> bool:
+    return prefix[:len(__magic__)] == __magic__
+
+
+def peek(source, size: int = len(__magic__)):
+    """Reads at least size bytes of source, enough to tell whether it is an envelope. Returns (prefix, all the chunks again)"""
+    chunks = iter_chunks(source)
+    head = []
+    read = 0
+    while read < size and (chunk := next(chunks, None)) is not None:
+        head.append(chunk)
+        read += len(chunk)
+    return b''.join(head), itertools.chain(head, chunks)
+
+
+def is_envelope_file(path) -> bool:
+    with open(path, 'rb') as source:
+        return is_envelope(source.read(len(__magic__)))
+
+
+def _ordered_map(function: Callable, items: Iterable, workers: int) -> Iterator:
+    """Like ThreadPoolExecutor.map but keeps at most a couple of items per worker in flight"""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending: deque = deque()
+        for item in items:
+            pending.append(pool.submit(function, *item))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _with_final_flag(chunks: Iterator[bytes]) -> Iterator:
+    """Yields (index, chunk, final) looking one chunk ahead. There is always at least one chunk"""
+    previous = b''
+    index = 0
+    started = False
+    for chunk in chunks:
+        if started:
+            yield index, previous, False
+            index += 1
+        previous = chunk
+        started = True
+    yield index, previous, True
+
+
+class _Reader:
+    """Reads exact sizes out of bytes, file objects or iterables of chunks"""
+    def __init__(self, source):
+        self.source = iter_chunks(source)
+        self.buffer = bytearray()
+
+    def read(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            chunk = next(self.source, None)
+            if chunk is None:
+                break
+            self.buffer.extend(chunk)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def chunks(self, size: int) -> Iterator[bytes]:
+        while chunk := self.read(size):
+            yield chunk
+
+
+def read_header(read: Callable[[int], bytes]):
+    """Parses the header, returning (header bytes, chunk size, wrapped key)"""
+    fixed = read(__header__.size)
+    if len(fixed) < __header__.size or not is_envelope(fixed):
+        raise EnvelopeError('Not an envelope encrypted file')
+    magic, chunk_size, wrapped_size = __header__.unpack(fixed)
+    wrapped = read(wrapped_size)
+    if len(wrapped) != wrapped_size or chunk_size == 0:
+        raise EnvelopeError('Truncated envelope header')
+    return fixed + wrapped, chunk_size, wrapped
+
+
+def unwrap_key(secure_enclave, wrapped: bytes) -> bytes:
+    key = b''.join(secure_enclave.gpg.stream(['--decrypt'], wrapped))
+    if len(key) != __key_size__:
+        raise EnvelopeError('Wrapped data key has the wrong size')
+    return key
+
+
+def encrypt(secure_enclave, source, recipients: List[str], chunk_size: int = __chunk_size__,
+            workers: int = __default_workers__) -> Iterator[bytes]:
+    """Encrypts source under a fresh data key wrapped with gpg for every recipient"""
+    if not recipients:
+        raise EnvelopeError('Envelope encryption needs at least one recipient')
+    key = os.urandom(__key_size__)
+    gpg_args = ['--encrypt'] + [x for recipient in recipients for x in ('--recipient', recipient)]
+    wrapped = b''.join(secure_enclave.gpg.stream(gpg_args, key))
+    header = __header__.pack(__magic__, chunk_size, len(wrapped)) + wrapped
+    header_digest = hashlib.sha256(header).digest()
+    cipher = _aesgcm(key)
+    logger.debug(f'Envelope encrypting for {len(recipients)} recipients in {chunk_size} byte chunks with {workers} workers')
+
+    def seal(index, chunk, final):
+        return cipher.encrypt(_nonce(index), chunk, _aad(header_digest, index, final))
+
+    yield header
+    yield from _ordered_map(seal, _with_final_flag(_Reader(source).chunks(chunk_size)), workers)
+
+
+def decrypt(secure_enclave, source, workers: int = __default_workers__, key: Optional[bytes] = None) -> Iterator[bytes]:
+    """Decrypts an envelope, asking gpg (and so the card) for the data key only once. key skips gpg when the
+    data key was already unwrapped"""
+    reader = _Reader(source)
+    header, chunk_size, wrapped = read_header(reader.read)
+    header_digest = hashlib.sha256(header).digest()
+    cipher = _aesgcm(key or unwrap_key(secure_enclave, wrapped))
+
+    def open_chunk(index, chunk, final):
+        from cryptography.exceptions import InvalidTag
+        try:
+            return cipher.decrypt(_nonce(index), chunk, _aad(header_digest, index, final))
+        except InvalidTag:
+            raise EnvelopeError(f'Chunk {index} failed authentication')
+
+    yield from _ordered_map(open_chunk, _with_final_flag(reader.chunks(chunk_size + __tag_size__)), workers)
+
+
+def encrypt_file(secure_enclave, input, output, recipients: List[str], workers: int = __default_workers__):
+    with open(input, 'rb') as source, open(output, 'wb') as target:
+        for chunk in encrypt(secure_enclave, source, recipients, workers=workers):
+            target.write(chunk)
+
+
+def decrypt_file(secure_enclave, input, output, workers: int = __default_workers__):
+    with open(input, 'rb') as source, open(output, 'wb') as target:
+        for chunk in decrypt(secure_enclave, source, workers):
+            target.write(chunk)
+
+
+class EnvelopeReader(io.RawIOBase):
+    """Read only, seekable file over an envelope. Only the chunks covering what is read get decrypted"""
+    def __init__(self, secure_enclave, path, workers: int = __default_workers__):
+        super().__init__()
+        self.workers = workers
+        self.file = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise EnvelopeError('Not an envelope encrypted file')
+        try:
+            self.header, self.chunk_size, wrapped = read_header(self._header_reader())
+            self.header_digest = hashlib.sha256(self.header).digest()
+            self.sealed_size = self.chunk_size + __tag_size__
+            payload = len(self.map) - len(self.header)
+            self.chunk_count = max(1, -(-payload // self.sealed_size))
+            last = payload - (self.chunk_count - 1) * self.sealed_size - __tag_size__
+            if last < 0:
+                raise EnvelopeError('Truncated envelope payload')
+            self.size = (self.chunk_count - 1) * self.chunk_size + last
+            self.cipher = _aesgcm(unwrap_key(secure_enclave, wrapped))
+        except Exception:
+            self.close()
+            raise
+        self.position = 0
+        self.cached: Tuple[int, bytes] = (-1, b'')
+
+    def _header_reader(self):
+        offset = 0
+        def read(size):
+            nonlocal offset
+            data = self.map[offset:offset + size]
+            offset += len(data)
+            return data
+        return read
+
+    def close(self):
+        if not self.closed:
+            if hasattr(self, 'map'):
+                self.map.close()
+            self.file.close()
+        super().close()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        if base + offset < 0:
+            raise ValueError('Negative seek position')
+        self.position = base + offset
+        return self.position
+
+    def chunk(self, index: int) -> bytes:
+        if self.cached[0] == index:
+            return self.cached[1]
+        start = len(self.header) + index * self.sealed_size
+        sealed = self.map[start:start + self.sealed_size]
+        final = index == self.chunk_count - 1
+        from cryptography.exceptions import InvalidTag
+        try:
+            data = self.cipher.decrypt(_nonce(index), sealed, _aad(self.header_digest, index, final))
+        except InvalidTag:
+            raise EnvelopeError(f'Chunk {index} failed authentication')
+        self.cached = (index, data)
+        return data
+
+    def iter_range(self, start: int, end: Optional[int] = None) -> Iterator[bytes]:
+        """Yields the plaintext between start and end, decrypting the chunks involved in parallel"""
+        end = self.size if end is None else min(end, self.size)
+        if start >= end:
+            return
+        first, last = start // self.chunk_size, (end - 1) // self.chunk_size
+        indexes = range(first, last + 1)
+        chunks = map(self.chunk, indexes) if first == last else _ordered_map(self.chunk, ((x,) for x in indexes), self.workers)
+        for index, data in zip(indexes, chunks):
+            offset = index * self.chunk_size
+            yield data[max(start - offset, 0):end - offset]
+
+    def read(self, size: int = -1) -> bytes:
+        end = self.size if size is None or size < 0 else self.position + size
+        data = b''.join(self.iter_range(self.position, end))
+        self.position += len(data)
+        return data
+
+    def readall(self) -> bytes:
+        return self.read()
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
@@ -7,12 +7,20 @@ __metaclass__ = type
 
 import os, sys
 import shutil
-import invoke
 import re
+import threading
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from loguru import logger
-from typing import List
+from typing import Iterable, Iterator, List, Optional, Union
+
+from . import runner
+from . import trace
+from .keyindex import KeyIndex, keyring_signature
+
+__chunk_size__: int = 64 * 1024
+__list_args__ = ['--quiet', '--batch', '--with-colons', '--with-keygrip', '--list-keys']
+__list_timeout__: float = 60
 
 
 __gpg_conf__: str = """use-agent
@@ -32,12 +40,39 @@ verify-options show-uid-validity
 with-fingerprint
 """
 
+__validity__ = {'o': 'unknown', 'i': 'invalid', 'd': 'disabled', 'r': 'revoked', 'e': 'expired', '-': 'unknown',
+                'q': 'undefined', 'n': 'never', 'm': 'marginal', 'f': 'full', 'u': 'ultimate'}
+
+__rsa_algos__ = ('1', '2', '3')
+__algo_names__ = {'16': 'elg', '17': 'dsa', '20': 'elg'}
+
+
+@dataclass
+class GpgSubkey:
+    pub: str
+    fingerprint: str
+    capabilities: str
+    created: Optional[int] = None
+    expires: Optional[int] = None
+    keygrip: Optional[str] = None
+
+
 @dataclass
 class GpgKey:
     uid: str
     pub: str
     fingerprint: str
     trust: str
+    uids: List[str] = field(default_factory=list)
+    capabilities: str = ''
+    created: Optional[int] = None
+    expires: Optional[int] = None
+    keygrip: Optional[str] = None
+    subkeys: List[GpgSubkey] = field(default_factory=list)
+    ownertrust: str = 'unknown'
+
+    def __post_init__(self):
+        self.subkeys = [GpgSubkey(**x) if isinstance(x, dict) else x for x in self.subkeys]
 
     def __str__(self):
         return self.uid.strip()
@@ -51,6 +86,63 @@ class GpgKey:
     def __radd__(self, other):
         return other + str(self)
 
+
+def _unescape(value: str) -> str:
+    if '\\x' not in value:
+        return value
+    return re.sub(r'\\x([0-9a-fA-F]{2})', lambda x: chr(int(x.group(1), 16)), value)
+
+
+def _timestamp(value: str) -> Optional[int]:
+    return int(value) if value.isdigit() else None
+
+
+def _pub(fields: List[str]) -> str:
+    """Names the key the way --list-keys does with keyid-format 0xlong, e.g. rsa4096/0x0123456789ABCDEF"""
+    algo = fields[3]
+    if algo in __rsa_algos__:
+        name = 'rsa' + fields[2]
+    elif algo in __algo_names__:
+        name = __algo_names__[algo] + fields[2]
+    else:
+        name = fields[16] if len(fields) > 16 and fields[16] else 'algo' + algo
+    return '{}/0x{}'.format(name, fields[4])
+
+
+def parse_colons(raw: str) -> List[GpgKey]:
+    """Parses the --with-colons listing of a keyring in a single pass"""
+    keys: List[GpgKey] = []
+    key: Optional[GpgKey] = None
+    current = None
+    for line in raw.splitlines():
+        fields = line.split(':')
+        record = fields[0]
+        if record == 'pub':
+            key = GpgKey('', _pub(fields), '', __validity__.get(fields[1], 'unknown'), [], fields[11],
+                         _timestamp(fields[5]), _timestamp(fields[6]), ownertrust=__validity__.get(fields[8], 'unknown'))
+            keys.append(key)
+            current = key
+        elif key is None:
+            continue
+        elif record == 'fpr':
+            if not current.fingerprint:
+                current.fingerprint = fields[9]
+        elif record == 'grp':
+            if not current.keygrip:
+                current.keygrip = fields[9]
+        elif record == 'uid':
+            uid = _unescape(fields[9])
+            if not key.uids:
+                key.uid = uid
+                key.trust = __validity__.get(fields[1], key.trust)
+            key.uids.append(uid)
+            current = None
+        elif record == 'sub':
+            current = GpgSubkey(_pub(fields), '', fields[11], _timestamp(fields[5]), _timestamp(fields[6]))
+            key.subkeys.append(current)
+    return keys
+
+
 class Gpg(object):
     def __init__(self, homepath):
         self.gpg_bin = shutil.which('gpg')
@@ -64,10 +156,19 @@ class Gpg(object):
             with self.gpg_home.joinpath('gpg.conf').open('w') as conffile:
                 conffile.write(__gpg_conf__)
             logger.debug("Configuration written")
+        self.key_index_path = self.gpg_home.joinpath('keyindex.json')
+        self._key_index = None
+        self._key_index_lock = threading.Lock()
 
     def getenv(self):
         environment = {'SSH_AUTH_SOCK': self.gpg_home.joinpath('S.gpg-agent.ssh').as_posix(),
-                       'GNUPGHOME': self.gpg_home.as_posix(), 'GPG_TTY': os.ttyname(sys.stdout.fileno())}
+                       'GNUPGHOME': self.gpg_home.as_posix()}
+        for stream in (sys.stdout, sys.stderr, sys.stdin):
+            try:
+                environment['GPG_TTY'] = os.ttyname(stream.fileno())
+                break
+            except (OSError, ValueError, AttributeError):
+                continue
         env = dict(os.environ)
         env.update(environment)
         return env
@@ -78,28 +179,64 @@ class Gpg(object):
     def getbin(self):
         return self.gpg_bin
 
+    def key_index(self) -> KeyIndex:
+        """Returns the index of the keyring, listing it again only when the keyring files changed"""
+        with self._key_index_lock:
+            if (key_index := self.cached_key_index()) is not None:
+                return key_index
+            return self.update_key_index(self.list_keys())
+
+    def cached_key_index(self) -> Optional[KeyIndex]:
+        """The index of the keyring when it is still current, None when the keyring has to be listed again"""
+        if self._key_index is None:
+            self._key_index = KeyIndex.load(self.key_index_path, GpgKey)
+        return self._key_index if self._key_index.signature == keyring_signature(self.gpg_home) else None
+
+    def update_key_index(self, keys) -> KeyIndex:
+        # Listing can run a trustdb check that rewrites trustdb.gpg, so sign what is left after it
+        self._key_index.update(keys, keyring_signature(self.gpg_home))
+        self._key_index.save(self.key_index_path)
+        return self._key_index
+
     def get_keys(self):
-        keys : List[GpgKey] = []
-        gpg_cmd = '{} --quiet --list-keys'.format(self.getbin())
-        output = invoke.run(gpg_cmd, env=self.getenv(), pty=True, hide=True)
-        raw = output.stdout # type: ignore
-        if 'uid  ' in raw:
-            logger.debug('There is at least a uid in the keylist')
-            uid = fingerprint = pub = trust = None
-            for line in raw.splitlines():
-                if match := re.search('fingerprint[ ]*= ([A-F0-9 ]*)', line):
-                    fingerprint = match.group(1).replace(" ", "")
-                if match := re.search('uid (.*)$', line):
-                    uid = match.group(1).strip()
-                    if submatch := re.search("(\\[[ a-z]*\\]) (.*)", uid):
-                        uid = submatch.group(2).strip()
-                        trust = submatch.group(1).replace("[", "").replace("]","").strip()
-                if match := re.search('pub [ ]*([a-zA-Z0-9\\/]*)', line):
-                    pub = match.group(1)
-                if pub and fingerprint and uid and trust:
-                    logger.debug(f'Found a full match key uuid {uid} - {pub}')
-                    keys.append(GpgKey(uid, pub, fingerprint, trust))
-                    pub = fingerprint = uid = trust = None
+        with trace.span('get_keys') as span:
+            keys = self.key_index().keys()
+            span.set(keys=len(keys))
         return keys
 
+    def list_keys(self):
+        result = self.run(__list_args__, timeout=__list_timeout__)
+        keys = parse_colons(result.text)
+        logger.debug(f'Found {len(keys)} keys in the keyring')
+        return keys
 
+    def run(self, args: List[str], input: Optional[bytes] = None, timeout: Optional[float] = None, check: bool = False) -> runner.Completed:
+        """Runs gpg with the given arguments over pipes and returns its output"""
+        return runner.run([self.getbin()] + args, self.getenv(), input, timeout, check)
+
+    def interactive(self, args: List[str], check: bool = False) -> int:
+        """Runs gpg on the user's terminal, for steps that prompt"""
+        return runner.interactive([self.getbin()] + args, self.getenv(), check=check)
+
+    def stream(self, args: List[str], source: Union[bytes, Iterable[bytes]], chunk_size: int = __chunk_size__,
+               timeout: Optional[float] = None) -> Iterator[bytes]:
+        """Runs gpg with the given arguments over pipes, feeding it source and yielding its output in chunks"""
+        gpg_cmd = [self.getbin(), '--quiet', '--batch'] + args
+        return runner.stream(gpg_cmd, self.getenv(), iter_chunks(source, chunk_size), timeout, chunk_size)
+
+
+def iter_chunks(source: Union[bytes, Iterable[bytes]], chunk_size: int = __chunk_size__) -> Iterator[bytes]:
+    """Normalizes bytes, file objects and iterables of chunks into an iterator of byte chunks"""
+    if isinstance(source, str):
+        source = source.encode('utf-8')
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for offset in range(0, len(view), chunk_size):
+            yield bytes(view[offset:offset + chunk_size])
+    elif hasattr(source, 'read'):
+        while chunk := source.read(chunk_size): # type: ignore
+            yield chunk
+    else:
+        for chunk in source:
+            if chunk:
+                yield chunk
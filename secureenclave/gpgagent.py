@@ -6,25 +6,32 @@ from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
 import os, sys
+import time
 import shutil
-import psutil
+import threading
 import subprocess
 
+from loguru import logger
+
+from . import runner
+from . import trace
+from .assuan import AssuanClient, AssuanError, agent_socket_path
+
 __gpg_agent_conf__ = """pinentry-program {}
 enable-ssh-support
 default-cache-ttl 600
 max-cache-ttl 7200
 """
 
+__agent_idle_timeout__: int = 600
+__agent_start_timeout__: float = 30
+
 class GpgAgent(object):
     def __init__(self, gpg):
         self.gpg = gpg
         self.gpg_agent_bin = shutil.which('gpg-agent')
         if not self.gpg_agent_bin:
             raise Exception('Failed to find gpg-agent program. Use your package manager or homebrew to install it and make sure it is in the path.')
-        self.gpg_connect_agent_bin = shutil.which('gpg-connect-agent')
-        if not self.gpg_connect_agent_bin:
-            raise Exception('Failed to find gpg-connect-agent program. Use your package manager or homebrew to install it and make sure it is in the PATH.')
         self.pinentry_bin = shutil.which('pinentry-tty')
         if not self.pinentry_bin:
             raise Exception('Failed to find pinentry-tty program. Use your package manager or homebrew to install it and make sure it is in the PATH.')
@@ -32,25 +39,121 @@ class GpgAgent(object):
         if not self.gpg_agent_conf_path.exists():
             with self.gpg_agent_conf_path.open('w') as agentfile:
                 agentfile.write(__gpg_agent_conf__.format(self.pinentry_bin))
+        self.assuan = AssuanClient(agent_socket_path(self.gpg.gethome()))
+        self._holding = None
 
-    def start(self):
-        gpgagent_cmd = [self.gpg_agent_bin, '--daemon', '--verbose', '--enable-ssh-support', '--log-file', self.gpg.gethome().joinpath('gpg-agent.log').as_posix()]
-        subprocess.run(gpgagent_cmd, env=self.gpg.getenv(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        gpg_pid_cmd = [self.gpg_connect_agent_bin, '/subst', '/serverpid', '/echo ${get serverpid}', '/bye']
-        gpg_pid_out = subprocess.run(gpg_pid_cmd, env=self.gpg.getenv(), capture_output=True)
-        self.gpg_agent_pid = int(gpg_pid_out.stdout.decode("utf-8").strip())
+    def find_running(self):
+        import psutil
+        try:
+            pid = self.assuan.getinfo_pid()
+        except (OSError, ValueError, AssuanError):
+            self.assuan.close()
+            return None
+        return pid if psutil.pid_exists(pid) else None
 
-    def list_readers(self):
-        gpg_lc_cmd = [self.gpg_connect_agent_bin, '--hex', 'scd getinfo reader_list', '/bye']
-        gpg_lc_out = subprocess.run(gpg_lc_cmd, env=self.gpg.getenv(), capture_output=True)
-        return gpg_lc_out.stdout.decode("utf-8").strip() # type:ignore
+    def start(self, reuse=True):
+        if reuse and (pid := self.find_running()):
+            logger.debug(f'Reusing running gpg-agent [{pid}]')
+            self.gpg_agent_pid = pid
+            self.touch()
+            return
+        runner.run(self.daemon_command(), self.gpg.getenv(), timeout=__agent_start_timeout__, name='gpg-agent --daemon')
+        self.started()
+
+    def daemon_command(self):
+        return [self.gpg_agent_bin, '--daemon', '--verbose', '--enable-ssh-support', '--log-file', self.gpg.gethome().joinpath('gpg-agent.log').as_posix()]
+
+    def started(self):
+        """Picks up the agent that daemon_command just started"""
+        self.assuan.close()
+        self.gpg_agent_pid = self.assuan.getinfo_pid()
+        logger.debug(f'Started gpg-agent [{self.gpg_agent_pid}]')
+        self.touch()
+
+    def stamp_path(self):
+        return self.gpg.gethome().joinpath('gpg-agent.stamp')
+
+    def touch(self):
+        self.stamp_path().touch()
 
+    def idle_time(self):
+        try:
+            return time.time() - self.stamp_path().stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def hold(self, idle_timeout=__agent_idle_timeout__):
+        """Touches the idle stamp in the background until release, so the reaper does not stop the agent in the middle
+        of an operation that takes longer than idle_timeout"""
+        if idle_timeout <= 0 or self._holding is not None:
+            return
+        self._holding = threading.Event()
+        interval = max(1.0, min(idle_timeout / 3, 30))
+        def beat(holding):
+            while not holding.wait(interval):
+                self.touch()
+        threading.Thread(target=beat, args=(self._holding,), name='gpg-agent-hold', daemon=True).start()
+
+    def release(self, idle_timeout=__agent_idle_timeout__):
+        """Leaves the agent running for the next command, unless idle_timeout is 0"""
+        import psutil
+        if self._holding is not None:
+            self._holding.set()
+            self._holding = None
+        if idle_timeout <= 0:
+            self.stop()
+            return
+        self.touch()
+        reaper_pid_path = self.gpg.gethome().joinpath('gpg-agent-reaper.pid')
+        if reaper_pid_path.exists():
+            reaper_pid, agent_pid = (reaper_pid_path.read_text().split() + ['0', '0'])[:2]
+            if int(agent_pid) == self.gpg_agent_pid and psutil.pid_exists(int(reaper_pid)) \
+                    and __name__ in ' '.join(psutil.Process(int(reaper_pid)).cmdline()):
+                return
+        reaper_cmd = [sys.executable, '-m', __name__, self.stamp_path().as_posix(), str(self.gpg_agent_pid), str(idle_timeout)]
+        reaper = subprocess.Popen(reaper_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        reaper_pid_path.write_text(f'{reaper.pid} {self.gpg_agent_pid}')
+        logger.debug(f'gpg-agent [{self.gpg_agent_pid}] will stop after {idle_timeout} seconds idle')
+
+    def shutdown(self):
+        if pid := self.find_running():
+            self.gpg_agent_pid = pid
+            self.stop()
+            return True
+        return False
+
+    def list_readers(self):
+        return self.assuan.scd_reader_list()
 
     def stop(self):
+        import psutil
+        self.assuan.close()
         if psutil.pid_exists(self.gpg_agent_pid):
-            agentprocess = psutil.Process(self.gpg_agent_pid)
+            with trace.span('agent stop', pid=self.gpg_agent_pid):
+                agentprocess = psutil.Process(self.gpg_agent_pid)
+                agentprocess.terminate()
+                gone, alive = psutil.wait_procs([agentprocess], timeout=3)
+                for proc in alive:
+                    proc.kill()
+
+
+def reap(stamp_path, agent_pid, idle_timeout):
+    """Terminates the agent once nothing has used it for idle_timeout seconds"""
+    import psutil
+    while psutil.pid_exists(agent_pid):
+        try:
+            idle = time.time() - os.stat(stamp_path).st_mtime
+        except FileNotFoundError:
+            return
+        if idle >= idle_timeout:
+            agentprocess = psutil.Process(agent_pid)
             agentprocess.terminate()
             gone, alive = psutil.wait_procs([agentprocess], timeout=3)
             for proc in alive:
                 proc.kill()
+            return
+        time.sleep(min(idle_timeout - idle, 30))
+
 
+if __name__ == '__main__':
+    reap(sys.argv[1], int(sys.argv[2]), float(sys.argv[3]))
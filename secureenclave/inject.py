@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2024, Gonzalo Alvarez
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import re
+import sys
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from typing import Dict, List, Optional, Tuple
+
+from . import batch
+
+# Secrets for a child process, decrypted in memory and never written to disk. Environment secrets are set as
+# variables. File secrets go in a memfd, or a pipe where there are no memfds, inherited by the child, and the
+# variable holds its /dev/fd path so programs that want a file name can open it.
+__name_pattern__ = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+__pipe_size__: int = 64 * 1024
+
+
+def parse_binding(value: str) -> Tuple[str, str]:
+    """NAME=FILE into (NAME, FILE)"""
+    name, separator, path = value.partition('=')
+    if not separator or not path or not __name_pattern__.match(name):
+        raise ValueError(f'[{value}] is not NAME=FILE with NAME a valid environment variable name')
+    return name, path
+
+
+def decrypt_all(secure_enclave, paths: List[str], workers: int = batch.__default_workers__) -> List[bytes]:
+    """Decrypts every file into memory, several at a time"""
+    def decrypt(path):
+        with open(path, 'rb') as source:
+            return b''.join(secure_enclave.decrypt_stream(source))
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(paths) or 1))) as pool:
+        return list(pool.map(decrypt, paths))
+
+
+def secret_fd(name: str, data: bytes) -> int:
+    """A readable, inheritable file descriptor holding data, backed by memory"""
+    if hasattr(os, 'memfd_create'):
+        fd = os.memfd_create(name, 0)
+        view, written = memoryview(data), 0
+        while written < len(data):
+            written += os.write(fd, view[written:])
+        os.lseek(fd, 0, os.SEEK_SET)
+    else:
+        if len(data) > __pipe_size__:
+            raise Exception(f'[{name}] is too big to be passed over a pipe on this platform')
+        fd, writer = os.pipe()
+        os.write(writer, data)
+        os.close(writer)
+    os.set_inheritable(fd, True)
+    return fd
+
+
+def prepare(secure_enclave, env_secrets: List[Tuple[str, str]], file_secrets: List[Tuple[str, str]],
+            workers: int = batch.__default_workers__) -> Tuple[Dict[str, str], List[int]]:
+    """The environment for the child and the descriptors it inherits"""
+    bindings = list(env_secrets) + list(file_secrets)
+    names = [name for name, _ in bindings]
+    if duplicated := sorted({x for x in names if names.count(x) > 1}):
+        raise Exception(f'Secrets bound more than once: {", ".join(duplicated)}')
+    plaintexts = decrypt_all(secure_enclave, [path for _, path in bindings], workers)
+    env = dict(os.environ)
+    fds = []
+    for idx, ((name, path), data) in enumerate(zip(bindings, plaintexts)):
+        if idx < len(env_secrets):
+            if b'\x00' in data:
+                raise Exception(f'[{path}] has NUL bytes and can not go in an environment variable, pass it as a file')
+            env[name] = data.decode('utf-8', 'surrogateescape').rstrip('\n')
+        else:
+            fd = secret_fd(name, data)
+            fds.append(fd)
+            env[name] = f'/dev/fd/{fd}'
+        logger.debug(f'Secret [{path}] bound to {name}')
+    return env, fds
+
+
+def find_executable(command: str) -> str:
+    executable: Optional[str] = shutil.which(command)
+    if executable is None:
+        raise Exception(f'Command not found: {command}')
+    return executable
+
+
+def execute(executable: str, argv: List[str], env: Dict[str, str]):
+    """Replaces this process with argv. Does not return"""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execve(executable, argv, env)
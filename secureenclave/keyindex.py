@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2024, Gonzalo Alvarez
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import json
+
+from dataclasses import asdict
+from loguru import logger
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+__index_version__: int = 3
+__keyring_files__: Tuple[str, ...] = ('pubring.kbx', 'pubring.gpg', 'trustdb.gpg')
+
+
+def keyring_signature(gpg_home) -> List[List]:
+    """Identifies the current state of the keyring files, changing whenever gpg rewrites any of them"""
+    signature = []
+    for name in __keyring_files__:
+        try:
+            stat = os.stat(gpg_home.joinpath(name))
+            signature.append([name, stat.st_ino, stat.st_mtime_ns, stat.st_size])
+        except FileNotFoundError:
+            continue
+    return signature
+
+
+class KeyIndex(object):
+    def __init__(self, keys: Iterable[Any] = (), signature: Optional[List[List]] = None):
+        self.signature = signature
+        self.by_fingerprint: Dict[str, Any] = {}
+        self.by_pub: Dict[str, Any] = {}
+        self.by_uid: Dict[str, List[Any]] = {}
+        for key in keys:
+            self.by_fingerprint[key.fingerprint] = key
+        self._reindex()
+
+    def _reindex(self):
+        self.by_pub = {key.pub: key for key in self.by_fingerprint.values()}
+        self.by_uid = {}
+        for key in self.by_fingerprint.values():
+            self.by_uid.setdefault(key.uid, []).append(key)
+
+    def keys(self) -> List[Any]:
+        return list(self.by_fingerprint.values())
+
+    def get(self, fingerprint: str) -> Optional[Any]:
+        return self.by_fingerprint.get(fingerprint)
+
+    def has_pub(self, pub: str) -> bool:
+        return pub in self.by_pub
+
+    def find_uid(self, uid: str) -> List[Any]:
+        return self.by_uid.get(uid, [])
+
+    def __len__(self):
+        return len(self.by_fingerprint)
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self.by_fingerprint
+
+    def update(self, keys: Iterable[Any], signature: List[List]):
+        """Merges a fresh listing, touching only the entries that were added, removed or changed"""
+        fresh = {key.fingerprint: key for key in keys}
+        removed = [x for x in self.by_fingerprint if x not in fresh]
+        changed = [x for x, key in fresh.items() if self.by_fingerprint.get(x) != key]
+        for fingerprint in removed:
+            del self.by_fingerprint[fingerprint]
+        for fingerprint in changed:
+            self.by_fingerprint[fingerprint] = fresh[fingerprint]
+        if removed or changed:
+            self._reindex()
+        self.signature = signature
+        logger.debug(f'Key index refreshed: {len(changed)} added or changed, {len(removed)} removed')
+
+    @classmethod
+    def load(cls, path, key_type) -> 'KeyIndex':
+        try:
+            with open(path) as indexfile:
+                data = json.load(indexfile)
+            if data.get('version') == __index_version__:
+                return cls([key_type(**x) for x in data['keys']], data['signature'])
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, KeyError):
+            logger.debug(f'Discarding unreadable key index [{path}]')
+        return cls()
+
+    def save(self, path):
+        data = {'version': __index_version__, 'signature': self.signature, 'keys': [asdict(x) for x in self.by_fingerprint.values()]}
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as indexfile:
+            json.dump(data, indexfile)
+        os.replace(tmp_path, path)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2024, Gonzalo Alvarez
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import re
+import base64
+import binascii
+import hashlib
+
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional, Set, Tuple
+
+# Just enough of RFC 4880 to split exported keyrings into transferable keys and fingerprint them without gpg:
+# armor, packet framing and v4 fingerprints. What is inside the packets is left for gpg to judge; input that is not
+# framed as OpenPGP packets at all raises PacketError.
+__armor__ = re.compile(rb'-----BEGIN PGP (?:PUBLIC|PRIVATE) KEY BLOCK-----\r?\n(.*?)-----END PGP (?:PUBLIC|PRIVATE) KEY BLOCK-----', re.S)
+__public_key__: int = 6
+__secret_key__: int = 5
+__public_subkey__: int = 14
+__user_id__: int = 13
+
+
+class PacketError(Exception):
+    pass
+
+
+@dataclass
+class KeyBlock:
+    """One transferable key: its packets as they came and what identifies it"""
+    data: bytes
+    fingerprint: Optional[str] = None
+    secret: bool = False
+    uids: List[str] = field(default_factory=list)
+    subkeys: List[str] = field(default_factory=list)
+
+
+def dearmor(data: bytes) -> bytes:
+    """Binary packets out of armored or binary input. Several armored blocks are concatenated"""
+    if not data.lstrip()[:5] == b'-----':
+        return data
+    packets = bytearray()
+    for body in __armor__.findall(data):
+        lines = body.split(b'\n')
+        if b':' in lines[0]:
+            # Armor headers end at the first empty line
+            lines = lines[next((idx for idx, x in enumerate(lines) if not x.strip()), len(lines)):]
+        encoded = b''.join(x.strip() for x in lines if x.strip() and not x.startswith(b'='))
+        try:
+            packets.extend(base64.b64decode(encoded, validate=True))
+        except binascii.Error as e:
+            raise PacketError(f'Invalid armor: {e}')
+    return bytes(packets)
+
+
+def _header(data: bytes, start: int, size: int) -> bytes:
+    if start + size > len(data):
+        raise PacketError(f'Truncated packet header at offset {start}')
+    return data[start:start + size]
+
+
+def iter_packets(data: bytes) -> Iterator[Tuple[int, int, int, int]]:
+    """Yields (tag, start, body start, end) for every packet"""
+    offset = 0
+    while offset < len(data):
+        start = offset
+        header = data[offset]
+        if not header & 0x80:
+            raise PacketError(f'Invalid packet header at offset {offset}')
+        if header & 0x40:
+            tag = header & 0x3f
+            first = _header(data, offset + 1, 1)[0]
+            if first < 192:
+                length, offset = first, offset + 2
+            elif first < 224:
+                length, offset = ((first - 192) << 8) + _header(data, offset + 2, 1)[0] + 192, offset + 3
+            elif first == 255:
+                length, offset = int.from_bytes(_header(data, offset + 2, 4), 'big'), offset + 6
+            else:
+                raise PacketError('Partial body lengths do not belong in a keyring')
+        else:
+            tag = (header >> 2) & 0x0f
+            length_type = header & 0x03
+            if length_type == 3:
+                length, offset = len(data) - offset - 1, offset + 1
+            else:
+                size = 1 << length_type
+                length, offset = int.from_bytes(_header(data, offset + 1, size), 'big'), offset + 1 + size
+        if offset + length > len(data):
+            raise PacketError('Truncated packet')
+        yield tag, start, offset, offset + length
+        offset += length
+
+
+def packet_set(data: bytes) -> Set[Tuple[int, bytes]]:
+    """(tag, body) of every packet, so two encodings of the same packets compare equal"""
+    return {(tag, data[body_start:end]) for tag, _, body_start, end in iter_packets(data)}
+
+
+def fingerprint(body: bytes) -> Optional[str]:
+    """v4 fingerprint of a public key or subkey packet body"""
+    if not body or body[0] != 4:
+        return None
+    return hashlib.sha1(b'\x99' + len(body).to_bytes(2, 'big') + body).hexdigest().upper()
+
+
+def split_keys(data: bytes) -> List[KeyBlock]:
+    """Splits a keyring, armored or not, into one KeyBlock per primary key"""
+    data = dearmor(data)
+    blocks: List[KeyBlock] = []
+    start = None
+    for tag, packet_start, body_start, end in iter_packets(data):
+        if tag in (__public_key__, __secret_key__):
+            if blocks:
+                blocks[-1].data = data[start:packet_start]
+            start = packet_start
+            secret = tag == __secret_key__
+            blocks.append(KeyBlock(b'', None if secret else fingerprint(data[body_start:end]), secret))
+        elif not blocks:
+            raise PacketError('Packets before the first key')
+        elif tag == __user_id__:
+            blocks[-1].uids.append(data[body_start:end].decode('utf-8', 'replace'))
+        elif tag == __public_subkey__:
+            if sub_fingerprint := fingerprint(data[body_start:end]):
+                blocks[-1].subkeys.append(sub_fingerprint)
+    if blocks:
+        blocks[-1].data = data[start:]
+    return blocks
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2024, Gonzalo Alvarez
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import json
+import struct
+
+from typing import Iterable, Iterator, Optional
+
+# A request is a JSON header frame followed by a body: zero or more data frames closed by an empty frame.
+# A response is a body followed by a JSON trailer frame telling whether the operation succeeded.
+# A frame is a 4 byte big endian length followed by that many bytes.
+__frame_header__ = struct.Struct('>I')
+__max_frame__: int = 16 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def _recv_exactly(sock, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            if not data:
+                raise EOFError('Connection closed')
+            raise ProtocolError('Connection closed in the middle of a frame')
+        data.extend(chunk)
+    return bytes(data)
+
+
+def send_frame(sock, payload: bytes):
+    # Sent apart so a secret payload is not copied into a buffer nobody can wipe
+    sock.sendall(__frame_header__.pack(len(payload)))
+    sock.sendall(payload)
+
+
+def recv_frame(sock) -> bytes:
+    size, = __frame_header__.unpack(_recv_exactly(sock, __frame_header__.size))
+    if size > __max_frame__:
+        raise ProtocolError(f'Frame of {size} bytes is over the limit')
+    return _recv_exactly(sock, size) if size else b''
+
+
+def send_header(sock, header: dict):
+    send_frame(sock, json.dumps(header, separators=(',', ':')).encode('utf-8'))
+
+
+def recv_header(sock) -> Optional[dict]:
+    """Returns the next header, or None when the peer closed the connection between messages"""
+    try:
+        frame = recv_frame(sock)
+    except EOFError:
+        return None
+    if not frame:
+        raise ProtocolError('Expected a header frame')
+    return json.loads(frame.decode('utf-8'))
+
+
+def send_body(sock, chunks: Iterable[bytes]):
+    for chunk in chunks:
+        if chunk:
+            send_frame(sock, chunk)
+    send_frame(sock, b'')
+
+
+def recv_body(sock) -> Iterator[bytes]:
+    try:
+        while chunk := recv_frame(sock):
+            yield chunk
+    except EOFError:
+        raise ProtocolError('Connection closed in the middle of a body')
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2024, Gonzalo Alvarez
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import re
+import configparser
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from loguru import logger
+from typing import Dict, List, Optional
+
+from . import batch
+
+# Unattended key generation for many identities at once. The spec is an ini file with one section per key and an
+# optional [defaults] section:
+#
+#   [defaults]
+#   type = ed25519
+#   expire = 2y
+#   subkeys = sign, encrypt, auth
+#
+#   [alice]
+#   name = Alice Example
+#   email = alice@example.com
+#   comment = laptop
+#   passphrase-env = ALICE_PASSPHRASE
+#
+# Keys without passphrase-env get the passphrase given to the command, if any. Every key and its first subkey come
+# out of one gpg --generate-key run over a parameter file fed through stdin, so passphrases never show up in argv.
+# Fingerprints are read from the KEY_CREATED status lines. The remaining subkeys are added with --quick-add-key,
+# several keys at a time. Only the agent side of those runs overlaps: generating the subkey and protecting it with
+# the passphrase. Every run writes the same pubring.kbx, and the keybox lock takes those writes one at a time.
+__key_types__ = {
+    'ed25519': {'primary': ['Key-Type: eddsa', 'Key-Curve: ed25519'],
+                'sign': ['eddsa', 'ed25519'], 'auth': ['eddsa', 'ed25519'], 'encrypt': ['ecdh', 'cv25519'],
+                'quick': {'sign': 'ed25519', 'auth': 'ed25519', 'encrypt': 'cv25519'}},
+}
+for _bits in (2048, 3072, 4096):
+    __key_types__[f'rsa{_bits}'] = {'primary': ['Key-Type: rsa', f'Key-Length: {_bits}'],
+                                    'sign': ['rsa', str(_bits)], 'auth': ['rsa', str(_bits)], 'encrypt': ['rsa', str(_bits)],
+                                    'quick': {x: f'rsa{_bits}' for x in ('sign', 'auth', 'encrypt')}}
+__subkey_usages__ = ('sign', 'encrypt', 'auth')
+__defaults__ = {'type': 'ed25519', 'expire': '2y', 'subkeys': 'sign, encrypt, auth'}
+__handle_pattern__ = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+
+
+@dataclass
+class Identity:
+    handle: str
+    name: str
+    email: Optional[str] = None
+    comment: Optional[str] = None
+    key_type: str = 'ed25519'
+    expire: str = '2y'
+    subkeys: List[str] = field(default_factory=lambda: list(__subkey_usages__))
+    passphrase: Optional[str] = None
+
+    @property
+    def uid(self) -> str:
+        return self.name + (f' ({self.comment})' if self.comment else '') + (f' <{self.email}>' if self.email else '')
+
+
+@dataclass
+class Provisioned:
+    identity: Identity
+    fingerprint: Optional[str] = None
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.fingerprint is not None and self.error is None
+
+
+def _check_value(handle: str, name: str, value: Optional[str]):
+    # A new line would end the parameter and start another one
+    if value is not None and ('\n' in value or '\r' in value):
+        raise Exception(f'[{handle}] {name} can not span several lines')
+
+
+def load_spec(text: str) -> List[Identity]:
+    """Identities out of a spec file"""
+    config = configparser.ConfigParser(interpolation=None, default_section='defaults')
+    config.read_string(text)
+    identities = []
+    for handle in config.sections():
+        section = config[handle]
+        if not __handle_pattern__.match(handle):
+            raise Exception(f'[{handle}] is not a valid key handle, use letters, digits, dots, dashes and underscores')
+        if not section.get('name'):
+            raise Exception(f'[{handle}] has no name')
+        key_type = section.get('type', __defaults__['type']).lower()
+        if key_type not in __key_types__:
+            raise Exception(f'[{handle}] has an unknown key type [{key_type}], use one of {", ".join(__key_types__)}')
+        subkeys = [x.strip().lower() for x in section.get('subkeys', __defaults__['subkeys']).split(',') if x.strip()]
+        if unknown := [x for x in subkeys if x not in __subkey_usages__]:
+            raise Exception(f'[{handle}] has unknown subkey usages: {", ".join(unknown)}')
+        identity = Identity(handle, section['name'], section.get('email'), section.get('comment'), key_type,
+                            section.get('expire', __defaults__['expire']), list(dict.fromkeys(subkeys)))
+        if variable := section.get('passphrase-env'):
+            if variable not in os.environ:
+                raise Exception(f'[{handle}] takes its passphrase from {variable}, which is not set')
+            identity.passphrase = os.environ[variable]
+        for name in ('name', 'email', 'comment', 'expire'):
+            _check_value(handle, name, section.get(name))
+        identities.append(identity)
+    if not identities:
+        raise Exception('The spec has no keys')
+    return identities
+
+
+def parameters(identities: List[Identity]) -> str:
+    """gpg --generate-key parameter file for the identities and their first subkey"""
+    blocks = []
+    for identity in identities:
+        key_type = __key_types__[identity.key_type]
+        lines = list(key_type['primary']) + ['Key-Usage: cert']
+        if identity.subkeys:
+            algo, size = key_type[identity.subkeys[0]]
+            lines += [f'Subkey-Type: {algo}', f'Subkey-{"Curve" if algo in ("ecdh", "eddsa") else "Length"}: {size}',
+                      f'Subkey-Usage: {identity.subkeys[0]}']
+        lines.append(f'Name-Real: {identity.name}')
+        if identity.email:
+            lines.append(f'Name-Email: {identity.email}')
+        if identity.comment:
+            lines.append(f'Name-Comment: {identity.comment}')
+        lines.append(f'Expire-Date: {identity.expire}')
+        if identity.passphrase:
+            _check_value(identity.handle, 'passphrase', identity.passphrase)
+            lines.append(f'Passphrase: {identity.passphrase}')
+        else:
+            lines.append('%no-protection')
+        lines += [f'Handle: {identity.handle}', '%commit']
+        blocks.append('\n'.join(lines) + '\n')
+    return ''.join(blocks)
+
+
+def parse_created(status: str) -> Dict[str, Optional[str]]:
+    """handle -> fingerprint from KEY_CREATED, or None from KEY_NOT_CREATED"""
+    created: Dict[str, Optional[str]] = {}
+    for line in status.splitlines():
+        fields = line.split()
+        if len(fields) >= 5 and fields[:2] == ['[GNUPG:]', 'KEY_CREATED']:
+            created[fields[4]] = fields[3]
+        elif len(fields) >= 3 and fields[:2] == ['[GNUPG:]', 'KEY_NOT_CREATED']:
+            created[fields[2]] = None
+    return created
+
+
+def provision(secure_enclave, identities: List[Identity], workers: int = batch.__default_workers__) -> List[Provisioned]:
+    """Generates every identity, returning what happened to each"""
+    handles = [x.handle for x in identities]
+    if duplicated := sorted({x for x in handles if handles.count(x) > 1}):
+        raise Exception(f'Key handles used more than once: {", ".join(duplicated)}')
+    logger.info(f'Generating {len(identities)} keys')
+    result = secure_enclave.gpg.run(['--quiet', '--batch', '--status-fd', '1', '--generate-key'], input=parameters(identities).encode('utf-8'))
+    created = parse_created(result.text)
+    outcomes = []
+    for identity in identities:
+        fingerprint = created.get(identity.handle)
+        outcomes.append(Provisioned(identity, fingerprint, None if fingerprint else result.error_text or 'gpg did not create the key'))
+
+    def add_subkeys(outcome: Provisioned):
+        identity = outcome.identity
+        quick = __key_types__[identity.key_type]['quick']
+        passphrase_args = ['--pinentry-mode', 'loopback', '--passphrase-fd', '0']
+        for usage in identity.subkeys[1:]:
+            added = secure_enclave.gpg.run(['--quiet', '--batch'] + passphrase_args + ['--quick-add-key', outcome.fingerprint, quick[usage], usage,
+                                            identity.expire], input=(identity.passphrase or '').encode('utf-8'))
+            if not added.ok:
+                outcome.error = f'Could not add the {usage} subkey: {added.error_text}'
+                return
+
+    pending = [x for x in outcomes if x.ok and len(x.identity.subkeys) > 1]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        list(pool.map(add_subkeys, pending))
+    return outcomes
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2024, Gonzalo Alvarez
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import re
+import fnmatch
+import configparser
+
+from loguru import logger
+from typing import Dict, Iterable, List, Optional
+
+# Recipient groups live in the [groups] section of secureenclave.ini in the enclave home, one group per line.
+# Members are separated by commas or new lines and can be anything a recipient can: fingerprints, key ids,
+# uid patterns or other @groups. A recipient without * ? or [ has to name a single key, by a whole uid, an email or
+# a part of the uid no other key has; fanning out takes a pattern or a group.
+#
+#   [groups]
+#   ops = 0xE8FD8EA72DA1CCA9BB2F3E72FFD95C0CD76BC55C, *@ops.example.com
+#   release = @ops, Alice <alice@example.com>
+__config_name__: str = 'secureenclave.ini'
+__key_id_pattern__ = re.compile(r'^(0x)?([0-9A-Fa-f]{8}|[0-9A-Fa-f]{16}|[0-9A-Fa-f]{40})$')
+__unusable__ = ('revoked', 'expired', 'disabled', 'invalid')
+__trusted__ = ('ultimate', 'full')
+# gpg --batch refuses to encrypt to keys below marginal validity, with no assurance they belong to the named user
+__valid__ = ('ultimate', 'full', 'marginal')
+
+
+def load_groups(home) -> Dict[str, List[str]]:
+    path = home.joinpath(__config_name__)
+    if not path.exists():
+        return {}
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(path, encoding='utf-8')
+    if not config.has_section('groups'):
+        return {}
+    return {name: [x.strip() for x in re.split(r'[,\n]', value) if x.strip()] for name, value in config.items('groups')}
+
+
+def _can_encrypt(key) -> bool:
+    return key.trust not in __unusable__ and (not key.capabilities or 'E' in key.capabilities)
+
+
+def _is_pattern(spec: str) -> bool:
+    return any(x in spec for x in '*?[')
+
+
+def _names(uid: str) -> List[str]:
+    """What a uid is matched exactly by: the whole uid, its email and its email in angle brackets"""
+    uid = uid.casefold()
+    if match := re.search(r'<([^<>]*)>\s*$', uid):
+        return [uid, match.group(1), f'<{match.group(1)}>']
+    return [uid]
+
+
+def _match(keys, spec: str) -> List:
+    if match := __key_id_pattern__.match(spec):
+        key_id = match.group(2).upper()
+        return [x for x in keys if x.fingerprint.upper().endswith(key_id)
+                or any(y.fingerprint.upper().endswith(key_id) for y in x.subkeys)]
+    pattern = spec.casefold()
+    if _is_pattern(pattern):
+        return [x for x in keys if any(fnmatch.fnmatchcase(y.casefold(), pattern) for y in x.uids or [x.uid])]
+    # A whole uid or email wins over uids that merely contain it, alice@example.com is not malice@example.com
+    exact = [x for x in keys if any(pattern in _names(y) for y in x.uids or [x.uid])]
+    return exact or [x for x in keys if any(pattern in y.casefold() for y in x.uids or [x.uid])]
+
+
+def resolve(keys, specs: Iterable[str], groups: Optional[Dict[str, List[str]]] = None, all_trusted: bool = False,
+            usable: bool = True) -> List[str]:
+    """Turns recipient specs into the fingerprints to encrypt to, in order and without duplicates.
+    With usable False keys that can not encrypt are matched too, for operations on the keys themselves"""
+    keys = list(keys)
+    groups = groups or {}
+    fingerprints: Dict[str, None] = {}
+    if all_trusted:
+        for key in keys:
+            if key.trust in __trusted__ and _can_encrypt(key):
+                fingerprints[key.fingerprint] = None
+        if not fingerprints:
+            raise Exception('No trusted keys to encrypt to')
+
+    def expand(spec: str, seen: tuple):
+        if spec.startswith('@'):
+            name = spec[1:].lower()
+            if name not in groups:
+                raise Exception(f'No recipient group named [{name}]')
+            if name in seen:
+                raise Exception(f'Recipient group [{name}] includes itself')
+            for member in groups[name]:
+                expand(member, seen + (name,))
+            return
+        matches = [x for x in _match(keys, spec) if _can_encrypt(x) or not usable]
+        if not matches:
+            raise Exception(f'No {"usable " if usable else ""}key matches [{spec}]')
+        if len(matches) > 1 and not _is_pattern(spec):
+            # Like gpg -r, a recipient is one key. Encrypting to several takes a pattern or a group
+            raise Exception(f'[{spec}] matches several keys: {", ".join(f"{x.fingerprint} ({x.uid})" for x in matches)}. '
+                            f'Use a fingerprint, the full email, a * pattern or a @group')
+        if usable and (unverified := [x.fingerprint for x in matches if x.trust not in __valid__]):
+            raise Exception(f'[{spec}] matches keys with {matches[0].trust if len(unverified) == 1 else "too low"} validity: {", ".join(unverified)}. '
+                            f'gpg will not encrypt to them until they are trusted, use key trust')
+        logger.debug(f'Recipient [{spec}] matches {", ".join(x.fingerprint for x in matches)}')
+        for key in matches:
+            fingerprints[key.fingerprint] = None
+
+    for spec in specs:
+        expand(spec.strip(), ())
+    return list(fingerprints)
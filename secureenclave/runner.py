@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2024, Gonzalo Alvarez
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import subprocess
+import threading
+
+from dataclasses import dataclass
+from loguru import logger
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from . import trace
+
+# Every gpg process goes through here: argv lists, never a shell, and plain pipes whenever the output is read by
+# the program. Interactive steps (key generation, PIN prompts) inherit the caller's terminal instead of a pty, and
+# gpg and pinentry find it through GPG_TTY. At most __max_processes__ non interactive processes run at once, so
+# batch operations queue here instead of piling up on the keyring lock.
+__max_processes__: int = int(os.environ.get('SECUREENCLAVE_GPG_PROCESSES', max(2, min(8, os.cpu_count() or 1))))
+__read_size__: int = 64 * 1024
+
+_slots = threading.BoundedSemaphore(__max_processes__)
+
+
+class RunnerError(Exception):
+    def __init__(self, argv: List[str], returncode: int, stderr: bytes):
+        self.argv = argv
+        self.returncode = returncode
+        self.stderr = stderr
+        name = os.path.basename(argv[0]) if argv else 'process'
+        super().__init__('{} failed with exit code {}: {}'.format(name, returncode, stderr.decode('utf-8', 'replace').strip()))
+
+
+@dataclass
+class Completed:
+    argv: List[str]
+    returncode: int
+    stdout: bytes
+    stderr: bytes
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0
+
+    @property
+    def text(self) -> str:
+        return self.stdout.decode('utf-8', 'replace')
+
+    @property
+    def error_text(self) -> str:
+        return self.stderr.decode('utf-8', 'replace').strip()
+
+
+def set_max_processes(count: int):
+    global _slots, __max_processes__
+    __max_processes__ = max(1, count)
+    _slots = threading.BoundedSemaphore(__max_processes__)
+
+
+def _timeout_error(argv, timeout):
+    return TimeoutError(f'{os.path.basename(argv[0])} did not finish within {timeout} seconds')
+
+
+def run(argv: List[str], env: Optional[Dict[str, str]] = None, input: Optional[bytes] = None, timeout: Optional[float] = None,
+        check: bool = False, name: Optional[str] = None) -> Completed:
+    """Runs argv to completion over pipes and returns its output"""
+    with _slots, trace.span(name or trace.gpg_span_name(argv), command=trace.command_line(argv)) as span:
+        try:
+            result = subprocess.run(argv, env=env, input=input, stdin=None if input is not None else subprocess.DEVNULL,
+                                    capture_output=True, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            span.set(timeout=timeout)
+            raise _timeout_error(argv, timeout)
+        span.set(exit_code=result.returncode, bytes_in=len(input or b''), bytes_out=len(result.stdout))
+    if check and result.returncode != 0:
+        raise RunnerError(argv, result.returncode, result.stderr)
+    return Completed(argv, result.returncode, result.stdout, result.stderr)
+
+
+def stream(argv: List[str], env: Optional[Dict[str, str]], chunks: Iterable[bytes], timeout: Optional[float] = None,
+           read_size: int = __read_size__) -> Iterator[bytes]:
+    """Runs argv feeding it chunks and yielding its output as it comes. Raises RunnerError when it fails"""
+    slots = _slots
+    slots.acquire()
+    try:
+        process = subprocess.Popen(argv, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except BaseException:
+        slots.release()
+        raise
+    # The slot goes back when the process exits, not when the consumer reaches the end of the output, so a stream
+    # that is paused or dropped without being closed does not starve every other gpg call
+    threading.Thread(target=lambda: (process.wait(), slots.release()), daemon=True).start()
+    with trace.span(trace.gpg_span_name(argv), command=trace.command_line(argv)) as span:
+        errors: List[bytes] = []
+        counts = {'bytes_in': 0, 'bytes_out': 0}
+        expired = threading.Event()
+        def feed():
+            try:
+                for chunk in chunks:
+                    process.stdin.write(chunk) # type: ignore
+                    counts['bytes_in'] += len(chunk)
+            except (BrokenPipeError, ValueError):
+                pass
+            finally:
+                try:
+                    process.stdin.close() # type: ignore
+                except BrokenPipeError:
+                    pass
+        def expire():
+            expired.set()
+            process.kill()
+        feeder = threading.Thread(target=feed, daemon=True)
+        drainer = threading.Thread(target=lambda: errors.append(process.stderr.read()), daemon=True) # type: ignore
+        watchdog = threading.Timer(timeout, expire) if timeout else None
+        feeder.start()
+        drainer.start()
+        if watchdog:
+            watchdog.start()
+        try:
+            while chunk := process.stdout.read1(read_size): # type: ignore
+                counts['bytes_out'] += len(chunk)
+                yield chunk
+            process.wait()
+        finally:
+            if watchdog:
+                watchdog.cancel()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close() # type: ignore
+            feeder.join()
+            drainer.join()
+            span.set(exit_code=process.returncode, **counts)
+        if expired.is_set():
+            raise _timeout_error(argv, timeout)
+        if process.returncode != 0:
+            raise RunnerError(argv, process.returncode, b''.join(errors))
+
+
+def interactive(argv: List[str], env: Optional[Dict[str, str]] = None, timeout: Optional[float] = None, check: bool = False) -> int:
+    """Runs argv attached to the caller's terminal, for steps where the user answers gpg or pinentry"""
+    with trace.span(trace.gpg_span_name(argv), command=trace.command_line(argv), interactive=True) as span:
+        try:
+            returncode = subprocess.run(argv, env=env, timeout=timeout).returncode
+        except subprocess.TimeoutExpired:
+            raise _timeout_error(argv, timeout)
+        span.set(exit_code=returncode)
+    if check and returncode != 0:
+        raise RunnerError(argv, returncode, b'')
+    logger.debug(f'{os.path.basename(argv[0])} exited with {returncode}')
+    return returncode
@@ -7,85 +7,132 @@ __metaclass__ = type
 import shutil
 import platformdirs
 import os, sys
-import subprocess
-import invoke
-import psutil
 import re
+import time
 
+from enum import Flag
 from loguru import logger
 from pathlib import Path
-from io import StringIO
-from bullet import YesNo, Input, VerticalPrompt, Bullet, Password
 
-from .gpgagent import GpgAgent
-from .gpg import Gpg
+from .gpgagent import GpgAgent, __agent_idle_timeout__
+from .gpg import Gpg, __list_timeout__
 from .smartcard import SmartCard
+from . import batch
+from . import cardpool
+from . import compression as compression_
+from . import envelope
+from . import openpgp
+from . import provision
+from . import signing
+from . import sync as sync_
+from . import trace
+from . import recipients as recipients_
 
 __author__ = 'GaPyTools'
 __program__ = 'SecureEnclave'
 
+__card_timeout__: float = 30
+
 __gpg_fetch_key__ = """admin
 fetch
 quit
 """
+__card_status_args__ = ['--quiet', '--batch', '--card-status', '--no-tty']
+__card_fetch_args__ = ['--quiet', '--card-edit', '--expert', '--batch', '--display-charset', 'utf-8', '--no-tty', '--command-fd', '0']
+
+__ownertrust__ = {'never': 3, 'marginal': 4, 'full': 5, 'ultimate': 6}
+
+def enclave_home():
+    return Path(platformdirs.user_data_dir(__program__, __author__))
+
+
+class Needs(Flag):
+    """What a command needs set up before it runs. Everything else is left untouched"""
+    NOTHING = 0
+    KEYRING = 1
+    AGENT = 2
+    CARD = 4
+    ALL = KEYRING | AGENT | CARD
 
-__gpg_trust_key__ = """trust
-5
-y
-quit
-"""
 
 class SecureEnclave(object):
     @staticmethod
     def purge():
-        home = Path(platformdirs.user_data_dir(__program__, __author__))
+        from bullet import YesNo
+        home = enclave_home()
         client = YesNo('Are you sure you want to remove the configuration folder for Secure Enclave and all the stored keys? ', default='n')
         if client.launch():
             shutil.rmtree(home)
             logger.debug('Configuration removed')
 
-    def __init__(self):
-        self.home = Path(platformdirs.user_data_dir(__program__, __author__))
+    def __init__(self, needs=Needs.ALL):
+        self.needs = needs
+        self.home = enclave_home()
         self.gpg = Gpg(self.home)
-        self.gpg_agent = GpgAgent(self.gpg)
-        self.smartcard = SmartCard(self.gpg)
+        self._gpg_agent = None
+        self._smartcard = None
+        self.agent_started = False
+        self.agent_idle_timeout = int(os.environ.get('SECUREENCLAVE_AGENT_IDLE_TIMEOUT', __agent_idle_timeout__))
+
+    @property
+    def gpg_agent(self):
+        if self._gpg_agent is None:
+            self._gpg_agent = GpgAgent(self.gpg)
+        return self._gpg_agent
+
+    @property
+    def smartcard(self):
+        if self._smartcard is None:
+            self._smartcard = SmartCard(self.gpg, self.gpg_agent)
+        return self._smartcard
 
 
     def is_card_installed(self):
         try:
-            gpg_cmd = '{} --quiet --batch --card-status --no-tty'.format(self.gpg.getbin())
-            result = invoke.run(gpg_cmd, env=self.gpg.getenv(), pty=True, hide=True)
-            if match := re.search('sec>  ([a-zA-Z0-9\\/]*)', result.stdout): # type: ignore
-                self.card_pub = match.group(1)
-                logger.debug(f'Found key in card [{self.card_pub}]')
-            else:
-                logger.debug('Failed to match. No secure key in card')
-                logger.debug(result.stdout) # type: ignore
-            return True
-        except:
+            result = self.gpg.run(__card_status_args__, timeout=__card_timeout__)
+        except TimeoutError as e:
+            logger.debug(f'Card failed to be recognized: {e}')
+            return False
+        return self.card_found(result)
+
+    def card_found(self, result):
+        """Tells from a --card-status run whether there is a card, remembering the key it holds"""
+        if not result.ok:
             logger.debug('Card failed to be recognized')
             return False
+        if match := re.search('sec>  ([a-zA-Z0-9\\/]*)', result.text):
+            self.card_pub = match.group(1)
+            logger.debug(f'Found key in card [{self.card_pub}]')
+        else:
+            logger.debug('Failed to match. No secure key in card')
+            logger.debug(result.text)
+        return True
 
 
     def __enter__(self):
-        self.gpg_agent.start()
-        if self.is_card_installed():
-            key_list = self.gpg.get_keys()
-            logger.debug(key_list)
-            if hasattr(self, 'card_pub') and self.card_pub and len(list(filter(lambda x: x.pub == self.card_pub, key_list))) > 0:
+        if Needs.AGENT in self.needs:
+            self.gpg_agent.start()
+            self.gpg_agent.hold(self.agent_idle_timeout)
+            self.agent_started = True
+        if Needs.CARD in self.needs and self.is_card_installed():
+            key_index = self.gpg.key_index()
+            logger.debug(f'{len(key_index)} keys in the keyring')
+            if hasattr(self, 'card_pub') and self.card_pub and key_index.has_pub(self.card_pub):
                 logger.debug(f'key [{self.card_pub}] already in key list')
             else:
                 logger.info('A card is installed. Retrieving remote key id from card')
-                gpg_cmd = '{} --quiet --card-edit --expert --batch --display-charset utf-8 --no-tty --command-fd 0'.format(self.gpg.getbin())
-                invoke.run(gpg_cmd, env=self.gpg.getenv(), hide=True, in_stream=StringIO(__gpg_fetch_key__))
+                self.gpg.run(__card_fetch_args__, input=__gpg_fetch_key__.encode('utf-8'), timeout=__card_timeout__)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.gpg_agent.stop()
+        if self.agent_started:
+            self.gpg_agent.release(self.agent_idle_timeout)
 
     def card_status(self):
-        gpg_cmd = '{} --quiet --batch --card-status --no-tty'.format(self.gpg.getbin())
-        invoke.run(gpg_cmd, env=self.gpg.getenv(), pty=True)
+        print(self.card_status_text(), end='')
+
+    def card_status_text(self):
+        return self.gpg.run(__card_status_args__, timeout=__card_timeout__).text
 
     def card_list(self):
         cards = self.smartcard.list_cards()
@@ -94,15 +141,57 @@ class SecureEnclave(object):
             dev, info = card
             logger.info(f'Card {idx+1}: {dev.fingerprint}')
 
+    def card_pool(self, backend=None):
+        """Every attached card by serial and the keys it holds, to spread card work over them. The other methods here
+        still let gpg pick the card"""
+        backend = backend or cardpool.AgentCardBackend(self.gpg, self.gpg_agent.assuan)
+        return cardpool.CardPool(backend, getattr(backend, 'source', None) or self.smartcard.source)
+
     def list_keys(self):
-        gpg_cmd = '{} --list-keys --with-keygrip'.format(self.gpg.getbin())
-        invoke.run(gpg_cmd, env=self.gpg.getenv(), pty=True)
+        print(self.gpg.run(['--list-keys', '--with-keygrip'], timeout=__list_timeout__).text, end='')
 
-    def import_key(self, filename):
-        gpg_cmd = '{} --import {}'.format(self.gpg.getbin(), filename)
-        invoke.run(gpg_cmd, env=self.gpg.getenv(), pty=True)
+    def import_keys(self, bundles, force=False, names=None):
+        """Imports every key found in bundles in one gpg run, leaving out keys the keyring already has as they are.
+        Bundles that are not OpenPGP keys are skipped with a warning, names says where each came from.
+        Returns counts of new, updated, unchanged and skipped keys"""
+        key_index = self.gpg.key_index()
+        blocks = []
+        for idx, bundle in enumerate(bundles):
+            try:
+                blocks.extend(openpgp.split_keys(bundle))
+            except openpgp.PacketError as e:
+                logger.warning(f'Skipping [{names[idx] if names else f"bundle {idx + 1}"}], it holds no OpenPGP keys: {e}')
+        fresh, seen = [], set()
+        summary = {'new': 0, 'updated': 0, 'unchanged': 0, 'skipped': 0, 'secret': 0}
+        # A key is left out only when the keyring already has every packet of it, so revocations, new expiry
+        # dates and certifications still get in. The keys the keyring knows are exported once to compare
+        known = sorted({x.fingerprint for x in blocks if x.fingerprint and key_index.get(x.fingerprint) is not None})
+        present = {}
+        if known and not force:
+            exported = self.gpg.run(['--quiet', '--batch', '--export'] + known, check=True).stdout
+            present = {x.fingerprint: openpgp.packet_set(x.data) for x in openpgp.split_keys(exported)}
+        for block in blocks:
+            unchanged = block.fingerprint in present and openpgp.packet_set(block.data) <= present[block.fingerprint]
+            if block.data in seen or (unchanged and not force):
+                summary['skipped'] += 1
+                continue
+            seen.add(block.data)
+            fresh.append(block)
+        logger.debug(f'{len(fresh)} keys to import, {summary["skipped"]} already in the keyring')
+        if not fresh:
+            return summary
+        result = self.gpg.run(['--quiet', '--batch', '--status-fd', '1', '--import'], input=b''.join(x.data for x in fresh))
+        for line in result.text.splitlines():
+            fields = line.split()
+            if fields[:2] == ['[GNUPG:]', 'IMPORT_OK']:
+                reason = int(fields[2])
+                summary['secret' if reason & 16 else 'new' if reason & 1 else 'updated' if reason else 'unchanged'] += 1
+        if not result.ok:
+            raise Exception(f'gpg could not import all keys: {result.error_text}')
+        return summary
 
     def new_key(self):
+        from bullet import Input, VerticalPrompt, Password
         prompts = VerticalPrompt([
             Input("Key Owner Full name: "),
             Input("Key Owner Email address: "),
@@ -115,61 +204,184 @@ class SecureEnclave(object):
         new_key_uid = f'{prompts[0][1]} ({prompts[2][1]}) <{prompts[1][1]}>'
         passphrase = prompts[3][1]
         logger.info("Creating new key")
-        gpg_cmd = '{} -q --batch --passphrase {} --quick-generate-key "{}" rsa4096 cert never'.format(self.gpg.getbin(), passphrase, new_key_uid)
-        result = invoke.run(gpg_cmd, env=self.gpg.getenv(), pty=True)
-        if result.exited != 0: # type:ignore
+        passphrase_args = ['-q', '--batch', '--pinentry-mode', 'loopback', '--passphrase-fd', '0']
+        result = self.gpg.run(passphrase_args + ['--quick-generate-key', new_key_uid, 'rsa4096', 'cert', 'never'], input=passphrase.encode('utf-8'))
+        if not result.ok:
             logger.error("Could not create the master key properly")
             return False
         new_key = next(iter([x for x in self.gpg.get_keys() if x.uid == new_key_uid]))
         logger.debug(f'New key with fingerprint {new_key.fingerprint}')
         logger.info('New key created. Creating its subkeys')
         for subkey_type in ['sign', 'encrypt', 'auth']:
-            gpg_cmd = '{} -q --batch --pinentry-mode=loopback --passphrase {} --quick-add-key "{}" rsa4096 "{}" "2y"'.format(self.gpg.getbin(), passphrase, new_key.fingerprint, subkey_type)
-            result = invoke.run(gpg_cmd, env=self.gpg.getenv(), pty=True)
-            if result.exited != 0: # type:ignore
+            result = self.gpg.run(passphrase_args + ['--quick-add-key', new_key.fingerprint, 'rsa4096', subkey_type, '2y'], input=passphrase.encode('utf-8'))
+            if not result.ok:
                 logger.error(f'Could not create {subkey_type} subkey properly')
                 return False
         logger.info('Key creation completed. Use "key list" to explore')
 
 
+    def provision_keys(self, identities, workers=batch.__default_workers__):
+        """Generates many keys without prompts, see provision"""
+        with trace.span('provision', keys=len(identities)):
+            return provision.provision(self, identities, workers)
+
     def del_key(self):
+        from bullet import Bullet
         keys = self.gpg.get_keys()
         selected = Bullet('Select which key to delete: ', keys).launch() # type:ignore
-        gpg_cmd = '{} -q --batch --delete-secret-key {}'.format(self.gpg.getbin(), selected.fingerprint)
-        invoke.run(gpg_cmd, env=self.gpg.getenv(), pty=True)
-        gpg_cmd = '{} -q --batch --delete-key {}'.format(self.gpg.getbin(), selected.fingerprint)
-        invoke.run(gpg_cmd, env=self.gpg.getenv(), pty=True)
+        self.gpg.interactive(['-q', '--batch', '--delete-secret-key', selected.fingerprint])
+        self.gpg.interactive(['-q', '--batch', '--delete-key', selected.fingerprint])
 
 
-    def encrypt(self, input, output):
+    def select_key(self):
+        from bullet import Bullet
+        if not sys.stdin.isatty():
+            raise Exception('No recipient given and no terminal to ask for one')
         key_list = self.gpg.get_keys()
         if len(key_list):
-            selected = Bullet('Select which key to delete: ', key_list).launch() # type:ignore
-            key_id = selected.fingerprint
-            logger.debug(f'Encrypting with keyid [{key_id}]')
-            gpg_cmd = '{} --quiet --armor --encrypt --recipient {} -o {} {}'.format(self.gpg.getbin(), key_id, output, input)
-            invoke.run(gpg_cmd, env=self.gpg.getenv(), hide=False, pty=True)
+            selected = Bullet('Select which key to encrypt with: ', key_list).launch() # type:ignore
+            return selected.fingerprint
+        logger.error('No keys available to encrypt with')
+        return None
 
-    def trust_keys(self):
-        key_list = self.gpg.get_keys()
-        logger.debug(len(key_list))
-        logger.debug(key_list)
-        trusted_count = 0
-        for key in key_list:
-            if key.trust == 'ultimate':
-                logger.debug('Key already trusted {key.uid}')
-            else:
-                trusted_count += 1
-                logger.info(f'Key UID: {key.uid}')
-                client = YesNo(f'Would you like to trust [{key.fingerprint}] ', default='n')
-                if client.launch():
-                    gpg_cmd = '{} --quiet --expert --batch --display-charset utf-8 --command-fd 0 --no-tty --edit-key {}'.format(self.gpg.getbin(), key.fingerprint)
-                    invoke.run(gpg_cmd, env=self.gpg.getenv(), hide=True, in_stream=StringIO(__gpg_trust_key__))
-        if trusted_count == 0:
-            logger.info('No untrusted keys to trust')
+    def resolve_recipients(self, specs, all_trusted=False):
+        """Resolves fingerprints, key ids, uid patterns and @groups against the keyring"""
+        groups = recipients_.load_groups(self.home)
+        return recipients_.resolve(self.gpg.get_keys(), specs, groups, all_trusted)
+
+    def find_keys(self, specs):
+        """The keys matching fingerprints, key ids, uid patterns or @groups, whatever they can do"""
+        fingerprints = recipients_.resolve(self.gpg.get_keys(), specs, recipients_.load_groups(self.home), usable=False)
+        key_index = self.gpg.key_index()
+        return [key_index.get(x) for x in fingerprints]
+
+    def _recipients(self, recipients):
+        recipients = recipients or self.select_key()
+        if not recipients:
+            raise Exception('No key selected to encrypt with')
+        return [recipients] if isinstance(recipients, str) else list(recipients)
+
+    @staticmethod
+    def _recipient_args(recipients):
+        return [x for recipient in recipients for x in ('--recipient', recipient)]
+
+    def _encrypt_args(self, recipients, armor, compression_args):
+        return (['--armor'] if armor else []) + compression_args + ['--encrypt'] + self._recipient_args(recipients)
+
+    def encrypt(self, input, output, recipients=None, armor=False, compression='auto'):
+        recipients = self._recipients(recipients)
+        logger.debug(f'Encrypting to [{", ".join(recipients)}]')
+        compression_args = compression_.gpg_args_for_file(compression, input)
+        self.gpg.interactive(['--quiet'] + self._encrypt_args(recipients, armor, compression_args) + ['-o', output, input])
+
+    def encrypt_stream(self, source, recipients=None, armor=False, compression='auto'):
+        recipients = self._recipients(recipients)
+        logger.debug(f'Streaming encryption to [{", ".join(recipients)}]')
+        sample, chunks = envelope.peek(source, compression_.__sample_size__) if compression == 'auto' else (b'', source)
+        return self.gpg.stream(self._encrypt_args(recipients, armor, compression_.gpg_args(compression, sample)), chunks)
+
+    def encrypt_envelope(self, source, recipients=None, workers=envelope.__default_workers__):
+        recipients = self._recipients(recipients)
+        logger.debug(f'Envelope encryption to [{", ".join(recipients)}]')
+        return envelope.encrypt(self, source, recipients, workers=workers)
+
+    def decrypt_stream(self, source):
+        prefix, chunks = envelope.peek(source)
+        if envelope.is_envelope(prefix):
+            logger.debug('Streaming envelope decryption')
+            return envelope.decrypt(self, chunks)
+        logger.debug('Streaming decryption with GPG')
+        return self.gpg.stream(['--decrypt'], chunks)
+
+    def open_envelope(self, path, workers=envelope.__default_workers__):
+        logger.debug(f'Opening envelope [{path}] for random access')
+        return envelope.EnvelopeReader(self, path, workers)
+
+    def _gpg_operation(self, args, file_args=None):
+        def operation(source, target):
+            extra = file_args(source) if file_args else []
+            result = self.gpg.run(['--quiet', '--batch', '--yes'] + extra + args + ['-o', target.as_posix(), source.as_posix()])
+            return result.ok, result.error_text or None
+        return operation
+
+    def _envelope_operation(self, function, *args):
+        def operation(source, target):
+            with trace.span(f'envelope.{function.__name__}', command=f'{function.__name__} {source}', bytes_in=source.stat().st_size):
+                function(self, source, target, *args)
+            return True, None
+        return operation
+
+    def _run_batch(self, operation, jobs, workers):
+        start = time.perf_counter()
+        results = batch.run_batch(operation, jobs, workers)
+        return results, time.perf_counter() - start
+
+    def encrypt_many(self, jobs, recipients=None, workers=batch.__default_workers__, use_envelope=False, armor=False, compression='auto'):
+        recipients = self._recipients(recipients)
+        logger.debug(f'Encrypting {len(jobs)} files to [{", ".join(recipients)}] using {workers} workers')
+        if use_envelope:
+            return self._run_batch(self._envelope_operation(envelope.encrypt_file, recipients), jobs, workers)
+        # Every file gets its own compression choice
+        operation = self._gpg_operation(self._encrypt_args(recipients, armor, []), lambda x: compression_.gpg_args_for_file(compression, x))
+        return self._run_batch(operation, jobs, workers)
+
+    def sync(self, source, target, recipients=None, workers=batch.__default_workers__, use_envelope=False, armor=False, compression='auto'):
+        """Encrypts the files of source into target, skipping the ones that did not change since the last sync"""
+        recipients = self._recipients(recipients)
+        logger.debug(f'Syncing [{source}] into [{target}] for [{", ".join(recipients)}] using {workers} workers')
+        return sync_.sync(self, source, target, recipients, workers, use_envelope, armor, compression)
+
+    def sign_files(self, files, manifest, signer=None, workers=batch.__default_workers__):
+        """Hashes files into manifest and signs it once, with the card when there is one"""
+        with trace.span('sign', files=len(files)):
+            return signing.sign(self, files, manifest, signer, workers)
+
+    def verify_files(self, manifest, signature=None, workers=batch.__default_workers__, signer=None):
+        with trace.span('verify'):
+            return signing.verify(self, manifest, signature, workers, signer)
+
+    def select_untrusted(self, level='ultimate'):
+        """Asks about every key below level and returns the fingerprints the user accepted"""
+        from bullet import YesNo
+        selected = []
+        for key in self.gpg.get_keys():
+            if key.ownertrust == level:
+                logger.debug(f'Key already trusted {key.uid}')
+                continue
+            logger.info(f'Key UID: {key.uid}')
+            if YesNo(f'Would you like to trust [{key.fingerprint}] ', default='n').launch():
+                selected.append(key.fingerprint)
+        return selected
+
+    def set_ownertrust(self, fingerprints, level='ultimate'):
+        """Sets the ownertrust of every key in one --import-ownertrust run.
+        Returns (key, before, after) for every key whose (ownertrust, validity) changed"""
+        before = {x.fingerprint: (x.ownertrust, x.trust) for x in self.gpg.get_keys()}
+        ownertrust = ''.join(f'{x}:{__ownertrust__[level]}:\n' for x in fingerprints)
+        logger.debug(f'Setting ownertrust of {len(fingerprints)} keys to {level}')
+        self.gpg.run(['--quiet', '--batch', '--import-ownertrust'], input=ownertrust.encode('utf-8'), check=True)
+        self.gpg.run(['--quiet', '--batch', '--check-trustdb'])
+        after = [(x, (x.ownertrust, x.trust)) for x in self.gpg.get_keys()]
+        return [(key, before.get(key.fingerprint), state) for key, state in after if before.get(key.fingerprint) != state]
+
+    def trust_keys(self, level='ultimate'):
+        fingerprints = self.select_untrusted(level)
+        if not fingerprints:
+            logger.info('No keys to trust')
+            return []
+        return self.set_ownertrust(fingerprints, level)
 
     def decrypt(self, input, output):
+        if envelope.is_envelope_file(input):
+            logger.debug('Decrypting envelope')
+            return envelope.decrypt_file(self, input, output)
         logger.debug('Decrypting with GPG')
-        gpg_cmd = '{} --quiet --armor --decrypt -o {} {}'.format(self.gpg.getbin(), output, input)
-        invoke.run(gpg_cmd, env=self.gpg.getenv(), hide=False, pty=True)
+        self.gpg.interactive(['--quiet', '--decrypt', '-o', output, input])
 
+    def decrypt_many(self, jobs, workers=batch.__default_workers__):
+        logger.debug(f'Decrypting {len(jobs)} files using {workers} workers')
+        gpg_operation = self._gpg_operation(['--decrypt'])
+        envelope_operation = self._envelope_operation(envelope.decrypt_file)
+        def operation(source, target):
+            return (envelope_operation if envelope.is_envelope_file(source) else gpg_operation)(source, target)
+        return self._run_batch(operation, jobs, workers)
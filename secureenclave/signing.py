@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2024, Gonzalo Alvarez
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+
+from dataclasses import dataclass, field
+from loguru import logger
+from pathlib import Path, PurePosixPath
+from typing import List, Optional, Tuple
+
+from . import batch
+
+# A whole file set is signed once: the files are hashed in parallel into a manifest in sha256sum format, with
+# paths relative to the manifest, and only the manifest gets a detached signature. Verifying checks that single
+# signature and hashes the files again, so the card is used once whatever the number of files.
+__manifest_name__: str = 'SHA256SUMS'
+__signature_suffix__: str = '.asc'
+# A good signature is not enough: anybody whose key is in the keyring can make one. It has to come from a key
+# trusted at least marginally, or from the signer asked for
+__trusted__ = ('marginal', 'fully', 'ultimate')
+
+
+@dataclass
+class Verification:
+    signer: str
+    trust: str
+    checked: int = 0
+    mismatched: List[str] = field(default_factory=list)
+    missing: List[str] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.mismatched and not self.missing
+
+
+def signature_path(manifest: Path) -> Path:
+    return manifest.with_name(manifest.name + __signature_suffix__)
+
+
+def default_base(inputs: List[str], files: List[Path]) -> Path:
+    """Where the manifest goes when none is given: the directory signed, the current directory when it holds
+    every file, or else the closest directory holding them all"""
+    if len(inputs) == 1 and Path(inputs[0]).is_dir():
+        return Path(inputs[0])
+    cwd = Path.cwd().resolve()
+    parents = [x.resolve().parent for x in files]
+    if all(x == cwd or cwd in x.parents for x in parents):
+        return Path('.')
+    return Path(os.path.commonpath(parents))
+
+
+def build(files: List[Path], base: Path, workers: int = batch.__default_workers__) -> bytes:
+    """The manifest of files, named relative to base. Every file has to be under base, parse would refuse the rest"""
+    names = {path: Path(os.path.relpath(path, base)).as_posix() for path in files}
+    if outside := [path.as_posix() for path, name in names.items() if name.split('/')[0] == '..']:
+        raise Exception(f'{", ".join(outside[:3])}{" and more" if len(outside) > 3 else ""} not under [{base}], '
+                        f'the manifest has to be in a directory holding every file it signs')
+    digests = batch.hash_files(files, workers)
+    lines = sorted((names[path], digest) for path, digest in digests.items())
+    return ''.join(f'{digest}  {name}\n' for name, digest in lines).encode('utf-8')
+
+
+def parse(data: bytes) -> List[Tuple[str, str]]:
+    """(name, sha256) for every line of a manifest"""
+    entries = []
+    for number, line in enumerate(data.decode('utf-8').splitlines(), 1):
+        if not line.strip():
+            continue
+        digest, separator, name = line.partition('  ')
+        if not separator or len(digest) != 64 or not name:
+            raise Exception(f'Malformed manifest line {number}: {line}')
+        if PurePosixPath(name).is_absolute() or '..' in PurePosixPath(name).parts:
+            raise Exception(f'Manifest line {number} points outside the manifest directory: {name}')
+        entries.append((name, digest.lower()))
+    return entries
+
+
+def parse_status(status: str, signer: Optional[str] = None) -> Tuple[str, str]:
+    """Signer fingerprint and trust out of the --status-fd output of --verify. Raises unless the signature is good
+    and comes from signer, or from a trusted key when no signer is given"""
+    fingerprints, trust = [], 'undefined'
+    for line in status.splitlines():
+        fields = line.split()
+        if len(fields) < 2 or fields[0] != '[GNUPG:]':
+            continue
+        if fields[1] in ('BADSIG', 'ERRSIG', 'REVKEYSIG'):
+            raise Exception(f'Bad signature: {" ".join(fields[1:])}')
+        if fields[1] == 'VALIDSIG':
+            # The last field is the fingerprint of the primary key, the first one of the signing subkey
+            fingerprints = [fields[-1], fields[2]] if len(fields) >= 12 else [fields[2]]
+        elif fields[1].startswith('TRUST_'):
+            trust = fields[1][len('TRUST_'):].lower()
+    if not fingerprints:
+        raise Exception('No valid signature found')
+    found = fingerprints[0]
+    if trust == 'never':
+        raise Exception(f'The manifest is signed by [{found}], a key that is never trusted')
+    if signer is not None:
+        if signer.upper().removeprefix('0X') not in [x.upper() for x in fingerprints]:
+            raise Exception(f'The manifest is signed by [{found}], not by [{signer}]')
+    elif trust not in __trusted__:
+        raise Exception(f'The manifest is signed by [{found}], a key with {trust} trust. Trust the key or name the expected signer')
+    return found, trust
+
+
+def check(entries: List[Tuple[str, str]], base: Path, workers: int = batch.__default_workers__) -> Tuple[List[str], List[str]]:
+    """Returns (mismatched, missing) names after hashing every file in the manifest"""
+    paths = {name: base.joinpath(name) for name, _ in entries}
+    missing = [name for name, path in paths.items() if not path.is_file()]
+    digests = batch.hash_files([x for name, x in paths.items() if name not in missing], workers)
+    mismatched = [name for name, digest in entries if name not in missing and digests[paths[name]] != digest]
+    logger.debug(f'{len(entries)} files checked, {len(mismatched)} mismatched, {len(missing)} missing')
+    return mismatched, missing
+
+
+def sign(secure_enclave, files: List[Path], manifest: Path, signer: Optional[str] = None,
+         workers: int = batch.__default_workers__) -> Path:
+    """Writes the manifest of files and its detached signature. Returns the signature path"""
+    manifest = Path(manifest)
+    skip = {manifest.resolve(), signature_path(manifest).resolve()}
+    files = [x for x in files if x.resolve() not in skip]
+    data = build(files, manifest.parent, workers)
+    manifest.write_bytes(data)
+    signature = signature_path(manifest)
+    secure_enclave.gpg.run(['--quiet', '--yes', '--armor', '--detach-sign'] + (['--local-user', signer] if signer else []) +
+                           ['-o', signature.as_posix(), manifest.as_posix()], check=True)
+    logger.debug(f'{len(files)} files signed in [{manifest}]')
+    return signature
+
+
+def verify(secure_enclave, manifest: Path, signature: Optional[Path] = None, workers: int = batch.__default_workers__,
+           signer: Optional[str] = None) -> Verification:
+    """Checks the signature of the manifest and then the files it lists"""
+    manifest = Path(manifest)
+    signature = Path(signature) if signature else signature_path(manifest)
+    # The bytes that are verified are the ones that are parsed, gpg reads them from stdin
+    data = manifest.read_bytes()
+    result = secure_enclave.gpg.run(['--quiet', '--batch', '--status-fd', '1', '--verify', signature.as_posix(), '-'], input=data)
+    signer, trust = parse_status(result.text, signer)
+    entries = parse(data)
+    mismatched, missing = check(entries, manifest.parent, workers)
+    return Verification(signer, trust, len(entries), mismatched, missing)
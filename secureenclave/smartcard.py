@@ -6,31 +6,145 @@ from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
 import time
+import threading
 
+from dataclasses import dataclass
 from loguru import logger
-from ykman.device import list_all_devices, scan_devices
-from yubikit.core.smartcard import SmartCardConnection
+from typing import Optional
+
+from . import trace
+from .assuan import AssuanError
+
+__poll_min__: float = 0.02
+__poll_max__: float = 1.0
+
+
+class YkmanDeviceSource:
+    """Devices as seen by ykman, with udev notifications when pyudev is available"""
+    def __init__(self):
+        self.monitor = None
+        try:
+            import pyudev
+            self.monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+            self.monitor.filter_by(subsystem='usb')
+            self.monitor.start()
+        except Exception:
+            logger.debug('No device notifications available, falling back to polling')
+
+    def scan(self):
+        from ykman.device import scan_devices
+        pids, state = scan_devices()
+        return state
+
+    def devices(self):
+        from ykman.device import list_all_devices
+        return list_all_devices()
+
+    def wait_for_change(self, state, timeout):
+        """Blocks until a device change is notified or timeout expires. None means notifications are unsupported"""
+        if self.monitor is None:
+            return None
+        return self.monitor.poll(timeout=timeout) is not None
+
+
+@dataclass
+class SimulatedDevice:
+    fingerprint: str
+    serial: int
+
+
+class SimulatedDeviceSource:
+    """In-memory device source, to exercise the card logic without hardware"""
+    def __init__(self, devices=()):
+        self.condition = threading.Condition()
+        self.state = 0
+        self._devices = [(x, None) for x in devices]
+
+    def insert(self, device):
+        with self.condition:
+            self._devices.append((device, None))
+            self.state += 1
+            self.condition.notify_all()
+
+    def remove(self, device):
+        with self.condition:
+            self._devices = [x for x in self._devices if x[0] != device]
+            self.state += 1
+            self.condition.notify_all()
+
+    def scan(self):
+        with self.condition:
+            return self.state
+
+    def devices(self):
+        with self.condition:
+            return list(self._devices)
+
+    def wait_for_change(self, state, timeout):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.state != state, timeout)
 
 
 class SmartCard:
-    def __init__(self, gpg):
+    def __init__(self, gpg, agent=None, source=None):
         self.gpg = gpg
+        self.agent = agent
+        self._source = source
+
+    @property
+    def source(self):
+        if self._source is None:
+            self._source = YkmanDeviceSource()
+        return self._source
 
-    def wait_for_it(self):
-        state = None
-        card_not_found=False
+    def _wait(self, waiter, deadline, what):
+        """Calls waiter(timeout) until it returns a value, backing off when it can not block by itself"""
+        delay = __poll_min__
         while True:
-            pids, new_state = scan_devices()
-            if new_state != state:
-                devices = list_all_devices()
-                if devices:
-                    logger.debug(devices)
-                    if card_not_found:
-                        logger.debug('waiting 500 milliseconds for GPG to pick up the card')
-                        time.sleep(0.5)
-                    return devices
-            card_not_found = True
-            time.sleep(0.2)
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise TimeoutError(f'Timed out waiting for {what}')
+            result, blocked = waiter(__poll_max__ if remaining is None else min(remaining, __poll_max__))
+            if result:
+                return result
+            if not blocked:
+                time.sleep(delay if remaining is None else max(0, min(delay, remaining)))
+                delay = min(delay * 2, __poll_max__)
+
+    def is_ready(self):
+        if self.agent is None:
+            return True
+        try:
+            return len(self.agent.list_readers()) > 0
+        except (AssuanError, OSError) as e:
+            logger.debug(f'scdaemon is not ready: {e}')
+            self.agent.assuan.close()
+            return False
+
+    def wait_for_it(self, timeout: Optional[float] = None):
+        with trace.span('card wait', timeout=timeout) as span:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            state = self.source.scan()
+            devices = self.source.devices()
+            if devices:
+                logger.debug(devices)
+                return devices
+
+            def card_inserted(wait):
+                nonlocal state
+                notified = self.source.wait_for_change(state, wait)
+                new_state = self.source.scan()
+                if new_state != state:
+                    state = new_state
+                    return self.source.devices(), True
+                return None, notified is not None
+
+            devices = self._wait(card_inserted, deadline, 'a smart card')
+            logger.debug(devices)
+            span.set(devices=len(devices))
+            logger.debug('Waiting for scdaemon to pick up the card')
+            self._wait(lambda wait: (self.is_ready(), False), deadline, 'scdaemon to pick up the card')
+            return devices
 
     def list_cards(self):
-        return list_all_devices()
+        return self.source.devices()
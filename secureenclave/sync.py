@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2024, Gonzalo Alvarez
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import json
+import time
+
+from dataclasses import dataclass, field
+from loguru import logger
+from pathlib import Path, PurePosixPath
+from typing import Any, Dict, List, Tuple
+
+from . import batch
+from . import envelope
+from . import recipients as recipients_
+
+# Incremental encryption of a tree. The destination keeps a manifest with the size, mtime and sha256 of every
+# source file it holds a ciphertext for, plus the encryption keys of the recipients. A file whose size and mtime
+# did not move is not even read; one that moved is hashed and only encrypted again when its content changed.
+# Changing the recipients, their encryption subkeys or the output format encrypts everything again.
+__manifest_name__: str = '.secureenclave-sync.json'
+__manifest_version__: int = 1
+
+
+@dataclass
+class SyncResult:
+    results: List[batch.BatchResult] = field(default_factory=list)
+    unchanged: List[str] = field(default_factory=list)
+    deleted: List[str] = field(default_factory=list)
+    full: bool = False
+    elapsed: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return all(x.ok for x in self.results)
+
+
+def recipient_keys(keys, recipients: List[str]) -> List[str]:
+    """What the ciphertexts depend on: every recipient fingerprint with the subkeys it encrypts to"""
+    keys = list(keys)
+    by_fingerprint = {x.fingerprint: x for x in keys}
+    state = []
+    for fingerprint in recipients_.resolve(keys, recipients):
+        key = by_fingerprint[fingerprint]
+        subkeys = sorted(x.fingerprint for x in key.subkeys if 'e' in x.capabilities)
+        state.append(':'.join([fingerprint] + subkeys))
+    return sorted(state)
+
+
+def inside(target: Path, output: str) -> bool:
+    """Whether output names a file under target, so deleting it can not reach anything else"""
+    name = PurePosixPath(output)
+    if not output or name.is_absolute() or '..' in name.parts:
+        return False
+    root = target.resolve()
+    return root in target.joinpath(name).resolve().parents
+
+
+def load_manifest(target: Path) -> Dict[str, Any]:
+    path = target.joinpath(__manifest_name__)
+    try:
+        manifest = json.loads(path.read_text(encoding='utf-8'))
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logger.warning(f'Ignoring the unreadable manifest [{path}], everything will be encrypted again')
+        return {}
+    if manifest.get('version') != __manifest_version__:
+        return {}
+    files = {}
+    for name, entry in manifest.get('files', {}).items():
+        # The manifest sits with the ciphertexts, it is not trusted to point anywhere else
+        if isinstance(entry, dict) and inside(target, str(entry.get('output', ''))):
+            files[name] = entry
+        else:
+            logger.warning(f'Ignoring manifest entry [{name}] in [{path}], its output is outside [{target}]')
+    manifest['files'] = files
+    return manifest
+
+
+def save_manifest(target: Path, manifest: Dict[str, Any]):
+    path = target.joinpath(__manifest_name__)
+    temporary = path.with_name(path.name + '.tmp')
+    temporary.write_text(json.dumps(manifest, indent=1, sort_keys=True), encoding='utf-8')
+    os.replace(temporary, path)
+
+
+def plan(source: Path, target: Path, manifest: Dict[str, Any], keys: List[str], suffix: str,
+         workers: int = batch.__default_workers__) -> Tuple[List[Tuple[Path, Path]], Dict[str, Dict[str, Any]], List[str], List[str], bool]:
+    """Returns (jobs, entries, unchanged, orphans, full). entries holds the manifest entry of every source file"""
+    full = manifest.get('recipients') != keys or manifest.get('suffix') != suffix
+    known = {} if full else manifest.get('files', {})
+    entries: Dict[str, Dict[str, Any]] = {}
+    candidates: List[Tuple[Path, str]] = []
+    unchanged: List[str] = []
+    for path, relative in batch.expand_inputs([source.as_posix()]):
+        name = relative.as_posix()
+        stat = path.stat()
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'output': name + suffix}
+        entries[name] = entry
+        old = known.get(name)
+        if old and old['size'] == entry['size'] and old['mtime_ns'] == entry['mtime_ns'] and target.joinpath(old['output']).exists():
+            entry['sha256'] = old['sha256']
+            unchanged.append(name)
+        else:
+            candidates.append((path, name))
+    digests = batch.hash_files([path for path, _ in candidates], workers)
+    jobs = []
+    for path, name in candidates:
+        entry, old = entries[name], known.get(name)
+        entry['sha256'] = digests[path]
+        if old and old['sha256'] == entry['sha256'] and target.joinpath(old['output']).exists():
+            # Touched but not changed
+            unchanged.append(name)
+        else:
+            jobs.append((path, target.joinpath(entry['output'])))
+    outputs = {x['output'] for x in entries.values()}
+    orphans = sorted(x['output'] for x in manifest.get('files', {}).values() if x['output'] not in outputs)
+    return jobs, entries, unchanged, orphans, full
+
+
+def sync(secure_enclave, source, target, recipients: List[str], workers: int = batch.__default_workers__,
+         use_envelope: bool = False, armor: bool = False, compression: str = 'auto') -> SyncResult:
+    """Brings target up to date with source, encrypting only what changed since the last sync"""
+    source, target = Path(source), Path(target)
+    if not source.is_dir():
+        raise Exception(f'[{source}] is not a directory')
+    if source.resolve() in (target.resolve(), *target.resolve().parents):
+        raise Exception(f'[{target}] is inside [{source}], the ciphertexts would be synced too')
+    start = time.perf_counter()
+    keys = recipient_keys(secure_enclave.gpg.get_keys(), recipients)
+    suffix = envelope.__suffix__ if use_envelope else '.asc' if armor else '.gpg'
+    manifest = load_manifest(target)
+    jobs, entries, unchanged, orphans, full = plan(source, target, manifest, keys, suffix, workers)
+    if full and manifest:
+        logger.info('Recipients or output format changed, encrypting everything again')
+    logger.debug(f'{len(jobs)} files to encrypt, {len(unchanged)} unchanged, {len(orphans)} to delete')
+    result = SyncResult(unchanged=unchanged, full=full)
+    if jobs:
+        result.results, _ = secure_enclave.encrypt_many(jobs, recipients, workers, use_envelope, armor, compression)
+    for failed in (x for x in result.results if not x.ok):
+        # Forget it so the next sync tries again, whatever was left behind
+        entries.pop(failed.input.relative_to(source).as_posix(), None)
+    for orphan in orphans:
+        path = target.joinpath(orphan)
+        path.unlink(missing_ok=True)
+        result.deleted.append(orphan)
+        for parent in path.parents:
+            if parent == target or target not in parent.parents or any(parent.iterdir()):
+                break
+            parent.rmdir()
+    target.mkdir(parents=True, exist_ok=True)
+    save_manifest(target, {'version': __manifest_version__, 'recipients': keys, 'suffix': suffix, 'files': entries})
+    result.elapsed = time.perf_counter() - start
+    return result
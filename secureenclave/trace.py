@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2024, Gonzalo Alvarez
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import json
+import time
+import threading
+
+from typing import Dict, List, Optional
+
+
+class _NullSpan(object):
+    """What span() hands out while tracing is off. Does nothing, so instrumented code pays one global lookup"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+__null_span__ = _NullSpan()
+__gpg_commands__ = ('--card-status', '--card-edit', '--list-keys', '--list-secret-keys', '--encrypt', '--decrypt', '--sign',
+                    '--detach-sign', '--verify', '--import', '--export', '--edit-key', '--delete-key', '--delete-secret-key',
+                    '--delete-secret-and-public-key', '--generate-key', '--full-generate-key', '--quick-generate-key',
+                    '--import-ownertrust', '--export-ownertrust', '--update-trustdb', '--check-trustdb')
+
+
+class Span(object):
+    def __init__(self, tracer, name: str, attrs: Dict):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.start = 0
+        self.duration = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.duration = time.perf_counter_ns() - self.start
+        if exc_type is not None:
+            self.attrs['error'] = f'{exc_type.__name__}: {exc_val}'
+        self.tracer.record(self)
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+class Tracer(object):
+    """Collects finished spans from every thread"""
+    def __init__(self):
+        self.origin = time.perf_counter_ns()
+        self.spans: List[Dict] = []
+        self.lock = threading.Lock()
+
+    def record(self, span: Span):
+        entry = {'name': span.name, 'start': span.start - self.origin, 'duration': span.duration,
+                 'thread': threading.get_ident(), 'attrs': span.attrs}
+        with self.lock:
+            self.spans.append(entry)
+
+    def summary(self) -> str:
+        totals: Dict[str, List[int]] = {}
+        for entry in self.spans:
+            totals.setdefault(entry['name'], []).append(entry['duration'])
+        lines = [f'{"span":<28} {"count":>6} {"total ms":>10} {"max ms":>10}']
+        for name, durations in sorted(totals.items(), key=lambda x: -sum(x[1])):
+            lines.append(f'{name:<28} {len(durations):>6} {sum(durations) / 1e6:>10.2f} {max(durations) / 1e6:>10.2f}')
+        for entry in sorted(self.spans, key=lambda x: x['start']):
+            if 'command' in entry['attrs']:
+                attrs = ' '.join(f'{k}={v}' for k, v in entry['attrs'].items() if k != 'command')
+                lines.append(f'{entry["duration"] / 1e6:>10.2f} ms  {entry["attrs"]["command"]}  {attrs}')
+        return '\n'.join(lines)
+
+    def chrome_trace(self) -> Dict:
+        """The spans in Chrome trace event format, for chrome://tracing or Perfetto"""
+        events = [{'name': x['name'], 'ph': 'X', 'ts': x['start'] / 1000, 'dur': x['duration'] / 1000, 'pid': os.getpid(),
+                   'tid': x['thread'], 'args': x['attrs']} for x in self.spans]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, path):
+        with open(path, 'w') as target:
+            json.dump(self.chrome_trace(), target, default=str)
+
+
+__tracer__: Optional[Tracer] = None
+
+
+def enable() -> Tracer:
+    global __tracer__
+    if __tracer__ is None:
+        __tracer__ = Tracer()
+    return __tracer__
+
+
+def disable() -> Optional[Tracer]:
+    global __tracer__
+    tracer, __tracer__ = __tracer__, None
+    return tracer
+
+
+def span(name: str, **attrs):
+    """Times the enclosed block as a span named name. Attributes can be added later through set()"""
+    if __tracer__ is None:
+        return __null_span__
+    return Span(__tracer__, name, attrs)
+
+
+def command_line(argv) -> str:
+    return argv if isinstance(argv, str) else ' '.join(str(x) for x in argv)
+
+
+def gpg_span_name(argv) -> str:
+    """Names a gpg run after its command, so the summary tells --card-status from --decrypt"""
+    tokens = argv.split() if isinstance(argv, str) else argv
+    return next((f'gpg {x}' for x in tokens if x in __gpg_commands__), 'gpg')
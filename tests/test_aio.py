@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""Tests for the asyncio API."""
+
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import pytest
+
+from secureenclave import envelope
+from secureenclave.aio import AsyncRunner, AsyncSecureEnclave
+from secureenclave.runner import RunnerError
+from secureenclave.secureenclave import Needs
+from secureenclave.smartcard import SimulatedDevice, SimulatedDeviceSource, SmartCard
+
+
+def python(code):
+    return [sys.executable, '-c', code]
+
+
+def test_run_and_failures():
+    async def main():
+        aio_runner = AsyncRunner()
+        result = await aio_runner.run(python('import sys; sys.stdout.write(sys.stdin.read().upper())'), input=b'data')
+        assert result.ok and result.stdout == b'DATA'
+        with pytest.raises(RunnerError, match='exit code 3'):
+            await aio_runner.run(python('import sys; sys.exit(3)'), check=True)
+        with pytest.raises(TimeoutError):
+            await aio_runner.run(python('import time; time.sleep(10)'), timeout=0.2)
+    asyncio.run(main())
+
+
+def test_cancellation_kills_the_child(tmp_path):
+    pid_path = tmp_path.joinpath('pid')
+    async def main():
+        task = asyncio.ensure_future(AsyncRunner().run(python(f'import os, time; open({pid_path.as_posix()!r}, "w").write(str(os.getpid())); time.sleep(30)')))
+        while not pid_path.exists() or not pid_path.read_text():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    asyncio.run(main())
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_path.read_text()), 0)
+
+
+def test_concurrency_limit():
+    async def main():
+        aio_runner = AsyncRunner(max_processes=2)
+        start = time.monotonic()
+        await asyncio.gather(*(aio_runner.run(python('import time; time.sleep(0.3)')) for _ in range(4)))
+        return time.monotonic() - start
+    assert asyncio.run(main()) >= 0.6
+
+
+class SlowSource(SimulatedDeviceSource):
+    """USB enumeration that takes its time, like ykman does"""
+    def devices(self):
+        time.sleep(0.1)
+        return super().devices()
+
+
+class ReadyAgent:
+    def list_readers(self):
+        time.sleep(0.1)
+        return ['Yubico YubiKey CCID 00 00']
+
+
+def test_wait_for_card_keeps_the_loop_running(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_DATA_HOME', tmp_path.as_posix())
+    secure_enclave = AsyncSecureEnclave(Needs.NOTHING)
+    source = SlowSource()
+    secure_enclave.secure_enclave._smartcard = SmartCard(None, ReadyAgent(), source)
+    async def main():
+        ticks = 0
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+        task = asyncio.ensure_future(ticker())
+        asyncio.get_running_loop().call_later(0.15, source.insert, SimulatedDevice('0123', 1))
+        devices = await secure_enclave.wait_for_card(timeout=5)
+        task.cancel()
+        return devices, ticks
+    devices, ticks = asyncio.run(main())
+    assert len(devices) == 1
+    assert ticks >= 20
+
+
+@pytest.mark.skipif(not shutil.which('gpg'), reason='gpg is not installed')
+def test_encrypt_and_decrypt_concurrently(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_DATA_HOME', tmp_path.as_posix())
+    async def main():
+        async with AsyncSecureEnclave(Needs.KEYRING) as secure_enclave:
+            await secure_enclave.run(['--batch', '--generate-key'], check=True, input=b'%no-protection\nKey-Type: eddsa\nKey-Curve: ed25519\n'
+                                     b'Subkey-Type: ecdh\nSubkey-Curve: cv25519\nName-Real: Async\nName-Email: async@example.com\n%commit\n')
+            recipient = (await secure_enclave.get_keys())[0].fingerprint
+            payloads = [os.urandom(1000 * idx) for idx in range(1, 9)]
+            sealed = await asyncio.gather(*(secure_enclave.encrypt(x, recipient) for x in payloads))
+            assert await asyncio.gather(*(secure_enclave.decrypt(x) for x in sealed)) == payloads
+            wrapped = b''.join(envelope.encrypt(secure_enclave.secure_enclave, payloads[0], [recipient]))
+            assert await secure_enclave.decrypt(wrapped) == payloads[0]
+            tmp_path.joinpath('plain').write_bytes(payloads[1])
+            await secure_enclave.encrypt_file(tmp_path.joinpath('plain'), tmp_path.joinpath('plain.gpg'), recipient)
+            await secure_enclave.decrypt_file(tmp_path.joinpath('plain.gpg'), tmp_path.joinpath('copy'))
+            assert tmp_path.joinpath('copy').read_bytes() == payloads[1]
+            return secure_enclave.gpg.getenv()
+    env = asyncio.run(main())
+    subprocess.run(['gpgconf', '--kill', 'all'], env=env, capture_output=True)
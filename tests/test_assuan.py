@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""Tests for the Assuan client, against a fake agent socket."""
+
+import os
+import shutil
+import socket
+import subprocess
+import threading
+import time
+
+import pytest
+
+from secureenclave.assuan import AssuanClient, AssuanError, agent_socket_path, escape, unescape
+
+__responses__ = {
+    b'GETINFO pid': [b'D 4242', b'OK'],
+    b'SCD GETINFO reader_list': [b'D Yubico YubiKey CCID 00 00%0AOther Reader 01 00%0A', b'OK'],
+    b'SCD SERIALNO': [b'S SERIALNO D2760001240103040006123456780000 0', b'OK'],
+    b'HAVEKEY AAAA': [b'OK'],
+    b'HAVEKEY BBBB': [b'ERR 67108881 No secret key <GPG Agent>'],
+    b'PKDECRYPT': [b'INQUIRE CIPHERTEXT'],
+    b'SLOW': [b'OK'],
+}
+
+
+@pytest.fixture
+def fake_agent(tmp_path):
+    path = tmp_path.joinpath('S.gpg-agent')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path.as_posix())
+    server.listen(1)
+    received = []
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            try:
+                with conn, conn.makefile('rb') as reader:
+                    conn.sendall(b'OK Pleased to meet you\n')
+                    for line in reader:
+                        line = line.rstrip(b'\n')
+                        received.append(line)
+                        if line == b'BYE':
+                            conn.sendall(b'OK closing connection\n')
+                            break
+                        if line == b'END':
+                            conn.sendall(b'OK\n')
+                        elif not line.startswith(b'D '):
+                            if line == b'SLOW':
+                                time.sleep(0.3)
+                            for response in __responses__.get(line, [b'ERR 275 Unknown IPC command']):
+                                conn.sendall(response + b'\n')
+            except OSError:
+                # The client went away, wait for the next one
+                pass
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    yield path, received
+    server.close()
+
+
+def test_escape_round_trip():
+    assert unescape(escape(b'100%\r\nok')) == b'100%\r\nok'
+    assert escape(b'a\nb') == b'a%0Ab'
+
+
+def test_typed_queries(fake_agent):
+    path, received = fake_agent
+    with AssuanClient(path) as client:
+        assert client.getinfo_pid() == 4242
+        assert client.scd_reader_list() == ['Yubico YubiKey CCID 00 00', 'Other Reader 01 00']
+        assert client.scd_serialno() == 'D2760001240103040006123456780000'
+        assert client.havekey('AAAA')
+        assert not client.havekey('BBBB')
+        with pytest.raises(AssuanError) as error:
+            client.transact('NOPE')
+        assert error.value.code == 275
+    assert received[-1] == b'BYE'
+
+
+def test_inquire_is_answered_with_data(fake_agent):
+    path, received = fake_agent
+    with AssuanClient(path) as client:
+        client.transact('PKDECRYPT', inquire=lambda keyword: b'(7:enc-val)\n')
+    assert b'D (7:enc-val)%0A' in received
+    assert b'END' in received
+
+
+def test_timeout_does_not_leave_a_stale_reply(fake_agent):
+    path, _ = fake_agent
+    client = AssuanClient(path, timeout=0.25)
+    with pytest.raises(TimeoutError):
+        client.transact('SLOW')
+    assert client.sock is None
+    assert client.getinfo_pid() == 4242
+    client.close()
+
+
+@pytest.mark.skipif(not shutil.which('gpgconf'), reason='gnupg is not installed')
+def test_socket_path_matches_gpgconf(tmp_path):
+    env = dict(os.environ, GNUPGHOME=tmp_path.as_posix())
+    expected = subprocess.run(['gpgconf', '--list-dirs', 'agent-socket'], env=env, capture_output=True, text=True)
+    assert agent_socket_path(tmp_path).as_posix() == expected.stdout.strip()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+"""Tests for the batch helpers used by `enc` and `dec`."""
+
+import shutil
+
+import pytest
+from pathlib import Path
+
+from secureenclave import batch
+
+
+def test_expand_inputs_dedups_directories_and_globs(tmp_path):
+    tmp_path.joinpath('conf', 'nested').mkdir(parents=True)
+    tmp_path.joinpath('conf', 'nested', 'a.yml').write_text('a')
+    tmp_path.joinpath('conf', 'b.yml').write_text('b')
+    inputs = batch.expand_inputs([tmp_path.joinpath('conf').as_posix(), tmp_path.joinpath('conf', '*.yml').as_posix()])
+    assert [relative for _, relative in inputs] == [Path('b.yml'), Path('nested/a.yml')]
+
+
+def test_outputs_mirror_the_input_tree(tmp_path):
+    for name in ['a/x.yml', 'b/x.yml', 'b/deep/y.yml']:
+        tmp_path.joinpath(name).parent.mkdir(parents=True, exist_ok=True)
+        tmp_path.joinpath(name).write_text(name)
+    files = batch.expand_inputs([tmp_path.joinpath('a', 'x.yml').as_posix(), tmp_path.joinpath('b', 'x.yml').as_posix()])
+    assert [relative for _, relative in files] == [Path('a/x.yml'), Path('b/x.yml')]
+    globbed = batch.expand_inputs([tmp_path.joinpath('**', '*.yml').as_posix()])
+    assert sorted(relative for _, relative in globbed) == [Path('a/x.yml'), Path('b/deep/y.yml'), Path('b/x.yml')]
+    assert [relative for _, relative in batch.expand_inputs([tmp_path.joinpath('b', '*').as_posix()])] == [Path('deep/y.yml'), Path('x.yml')]
+
+
+def test_colliding_outputs_fail_before_any_work(tmp_path):
+    for name in ['a/x.yml', 'b/x.yml']:
+        tmp_path.joinpath(name).parent.mkdir(parents=True, exist_ok=True)
+        tmp_path.joinpath(name).write_text(name)
+    inputs = batch.expand_inputs([tmp_path.joinpath('a').as_posix(), tmp_path.joinpath('b').as_posix()])
+    with pytest.raises(Exception, match='would both be written to'):
+        batch.plan_outputs(inputs, tmp_path.joinpath('out').as_posix(), lambda x: x)
+
+
+def test_run_batch_reports_every_file(tmp_path):
+    for name in ['one', 'two', 'three']:
+        tmp_path.joinpath(name).write_text(name)
+    inputs = batch.expand_inputs([tmp_path.joinpath('*').as_posix()])
+    jobs = batch.plan_outputs(inputs, tmp_path.joinpath('out').as_posix(), lambda x: x.with_name(x.name + '.asc'))
+
+    def operation(source, target):
+        if source.name == 'two':
+            return False, 'broken'
+        shutil.copy(source, target)
+        return True, None
+
+    results = batch.run_batch(operation, jobs, workers=2)
+    assert [x.ok for x in results] == [True, True, False]
+    assert tmp_path.joinpath('out', 'one.asc').read_text() == 'one'
+    assert not batch.report(results, 0.1)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""Tests for the card pool, load tested on simulated cards."""
+
+import threading
+import time
+
+import pytest
+
+from secureenclave.assuan import AssuanError
+from secureenclave.cardpool import AgentCardBackend, CardError, CardPool, CardRemovedError, SimulatedCard, SimulatedCardBackend
+
+KEY = 'A' * 40
+OTHER = 'B' * 40
+
+
+def simulated(count, latency=0.02, keys=(KEY,)):
+    return SimulatedCardBackend([SimulatedCard(f'card{idx}', set(keys), latency) for idx in range(count)])
+
+
+def test_operations_spread_over_every_card_holding_the_key():
+    backend = simulated(4, latency=0.05)
+    backend.insert(SimulatedCard('other', {OTHER}, 0.05))
+    pool = CardPool(backend)
+    pool.refresh()
+    start = time.monotonic()
+    results = pool.map(KEY, pool.decrypt, [bytes([x]) for x in range(32)])
+    elapsed = time.monotonic() - start
+    assert results == [bytes([x]) for x in range(32)]
+    # 32 operations of 50ms on 4 cards, one at a time per card
+    assert elapsed < 32 * 0.05 / 2
+    assert [backend.card(f'card{idx}').operations for idx in range(4)] == [8, 8, 8, 8]
+    assert backend.card('other').operations == 0
+    assert pool.sign(KEY, b'data') == pool.sign(KEY, b'data')
+    with pytest.raises(CardError, match='No healthy card'):
+        pool.decrypt('C' * 40, b'data')
+
+
+def test_serialized_backends_run_one_operation_at_a_time():
+    backend = simulated(4, latency=0.02)
+    backend.concurrent = False
+    pool = CardPool(backend)
+    pool.refresh()
+    start = time.monotonic()
+    assert pool.map(KEY, pool.decrypt, [b'x'] * 8) == [b'x'] * 8
+    assert time.monotonic() - start >= 8 * 0.02
+    assert not AgentCardBackend.concurrent
+
+
+def test_removed_card_fails_over_and_comes_back():
+    backend = simulated(3, latency=0.02)
+    with CardPool(backend, backend.source, health_interval=0.05) as pool:
+        threading.Timer(0.05, backend.remove, ['card1']).start()
+        assert pool.map(KEY, pool.decrypt, [b'x'] * 60) == [b'x'] * 60
+        deadline = time.monotonic() + 2
+        while 'card1' in pool.cards and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert sorted(pool.cards) == ['card0', 'card2']
+        backend.insert(backend.card('card1'))
+        while 'card1' not in pool.cards and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert pool.cards['card1'].healthy
+
+
+def test_no_card_left_raises():
+    backend = simulated(1)
+    pool = CardPool(backend)
+    pool.refresh()
+    backend.remove('card0')
+    # Failing over finds nothing else holding the key
+    with pytest.raises(CardError, match='No healthy card'):
+        pool.decrypt(KEY, b'x')
+    assert not pool.cards['card0'].healthy and pool.cards['card0'].failures == 1
+    backend.insert(backend.card('card0'))
+    assert pool.check_health() == [] and pool.decrypt(KEY, b'x') == b'x'
+
+
+def test_busy_cards_time_out():
+    pool = CardPool(simulated(1))
+    pool.refresh()
+    with pool.acquire(KEY):
+        with pytest.raises(TimeoutError):
+            pool.decrypt(KEY, b'x', timeout=0.05)
+
+
+class FakeAssuan:
+    def __init__(self, cards, card_list=True):
+        self.cards = cards
+        self.card_list = card_list
+        self.current = next(iter(cards), None)
+
+    def scd_card_list(self):
+        if not self.card_list:
+            raise AssuanError(275, 'Unknown IPC command')
+        return list(self.cards)
+
+    def scd_serialno(self, demand=None):
+        if demand is not None and demand not in self.cards:
+            raise AssuanError(100696144, 'No such device')
+        self.current = demand or self.current
+        return self.current
+
+    def scd_key_fprs(self):
+        if self.cards[self.current] is None:
+            raise AssuanError(100663406, 'Card error')
+        return self.cards[self.current]
+
+
+def test_agent_backend_reads_cards_through_scdaemon():
+    assuan = FakeAssuan({'D276C': None, 'D276A': [KEY, OTHER], 'D276B': [KEY]})
+    backend = AgentCardBackend(None, assuan)
+    assert backend.cards() == {'D276A': {KEY, OTHER}, 'D276B': {KEY}}
+    del assuan.cards['D276C']
+    assuan.card_list = False
+    assert backend.cards() == {'D276B': {KEY}}
+    del assuan.cards['D276A']
+    with pytest.raises(CardRemovedError):
+        backend.ping('D276A')
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+"""Tests for the adaptive compression choice of `enc`."""
+
+import gzip
+import os
+
+import pytest
+
+from secureenclave import compression
+
+TEXT = b''.join(b'%06d key=value enabled=true\n' % idx for idx in range(20000))
+
+
+def test_entropy():
+    assert compression.entropy(b'') == 0.0
+    assert compression.entropy(b'a' * 100) == 0.0
+    assert compression.entropy(bytes(range(256)) * 4) == pytest.approx(8.0)
+
+
+def test_compressed_inputs_are_not_compressed_again(tmp_path):
+    assert compression.gpg_args('auto', TEXT[:compression.__sample_size__]) == compression.__gpg_args__['fast']
+    assert compression.gpg_args('auto', os.urandom(compression.__sample_size__)) == ['--compress-algo', 'none']
+    assert compression.gpg_args('default', os.urandom(1024)) == []
+    with pytest.raises(Exception, match='Unknown compression mode'):
+        compression.gpg_args('brotli')
+
+
+def test_files_are_sampled_past_their_header(tmp_path):
+    path = tmp_path.joinpath('bundle.tar.gz')
+    path.write_bytes(TEXT[:2048] + gzip.compress(os.urandom(512 * 1024)))
+    assert len(compression.sample_file(path)) == compression.__sample_size__
+    assert compression.gpg_args_for_file('auto', path) == ['--compress-algo', 'none']
+    path.write_bytes(TEXT[:100])
+    assert compression.sample_file(path) == TEXT[:100]
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""Tests for the configuration store and its decrypted value cache."""
+
+import pytest
+
+from secureenclave.configstore import ConfigStore, SecretCache, wipe
+
+
+class Clock:
+    now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_cache_expires_and_zeroes_values():
+    clock = Clock()
+    cache = SecretCache(max_entries=4, ttl=10, clock=clock)
+    cache.put('db', b'hunter2')
+    value = cache.entries['db'][0]
+    assert cache.get('db') == b'hunter2'
+    clock.now = 11
+    assert cache.get('db') is None
+    assert value == bytearray(7)
+
+
+def test_cache_evicts_least_recently_used():
+    cache = SecretCache(max_entries=2, ttl=10, clock=Clock())
+    cache.put('a', b'1')
+    cache.put('b', b'2')
+    cache.get('a')
+    evicted = cache.entries['b'][0]
+    cache.put('c', b'3')
+    assert list(cache.entries) == ['a', 'c']
+    assert evicted == bytearray(1)
+
+
+def test_cache_drops_entries_of_another_version():
+    cache = SecretCache()
+    cache.put('a', b'1', version=1)
+    assert cache.get('a', version=2) is None
+    assert len(cache) == 0
+
+
+class FakeEnclave:
+    def __init__(self, home):
+        self.home = home
+        self.decryptions = 0
+
+    def encrypt_stream(self, source, recipient):
+        yield bytes(reversed(source))
+
+    def decrypt_stream(self, source):
+        self.decryptions += 1
+        yield bytes(reversed(source.read()))
+
+
+def test_store_serves_repeated_gets_from_cache(tmp_path):
+    enclave = FakeEnclave(tmp_path)
+    store = ConfigStore(enclave)
+    store.set('db.password', b'hunter2', 'AA')
+    assert tmp_path.joinpath('config', 'db.password.gpg').read_bytes() == b'2retnuh'
+    store.cache.clear()
+    assert [store.get('db.password') for _ in range(3)] == [b'hunter2'] * 3
+    assert enclave.decryptions == 1
+    assert store.list() == ['db.password']
+
+
+def test_values_are_buffers_the_caller_can_wipe(tmp_path):
+    store = ConfigStore(FakeEnclave(tmp_path))
+    store.set('token', b'secret', 'AA')
+    value = store.get('token')
+    assert isinstance(value, bytearray) and value == b'secret'
+    wipe(value)
+    # The cache keeps its own copy
+    assert store.get('token') == b'secret' and value == bytearray(6)
+
+
+def test_store_notices_values_changed_on_disk(tmp_path):
+    enclave = FakeEnclave(tmp_path)
+    store = ConfigStore(enclave)
+    store.set('token', b'one', 'AA')
+    ConfigStore(enclave).set('token', b'three', 'AA')
+    assert store.get('token') == b'three'
+    with pytest.raises(Exception, match='Invalid configuration name'):
+        store.get('../escape')
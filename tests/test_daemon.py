@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+"""Tests for the daemon and its client, with an in-memory enclave."""
+
+import socket
+import threading
+
+import pytest
+
+from secureenclave.client import DaemonClient, DaemonError, connect
+from secureenclave import protocol
+from secureenclave.daemon import EnclaveDaemon
+from secureenclave.gpg import GpgKey, iter_chunks
+
+
+class FakeAgent:
+    def touch(self):
+        pass
+
+    def find_running(self):
+        return 1234
+
+    def list_readers(self):
+        return ['Simulated Reader 00 00']
+
+
+class FakeGpg:
+    def get_keys(self):
+        return [GpgKey('Alice <alice@example.com>', 'ed25519/0x01', 'AA' * 20, 'ultimate')]
+
+
+class FakeEnclave:
+    card_pub = 'ed25519/0x01'
+
+    def __init__(self, home):
+        self.home = home
+        self.gpg = FakeGpg()
+        self.gpg_agent = FakeAgent()
+
+    def encrypt_stream(self, source, recipient, armor=False, compression='auto'):
+        yield recipient.encode('utf-8') + b':'
+        for chunk in iter_chunks(source):
+            yield chunk.upper()
+
+    def decrypt_stream(self, source):
+        for chunk in iter_chunks(source):
+            if b'bad' in chunk:
+                raise Exception('gpg failed with exit code 2')
+            yield chunk.lower()
+
+    def card_status_text(self):
+        return 'Reader ...........: Simulated\n'
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    server = EnclaveDaemon(FakeEnclave(tmp_path), tmp_path.joinpath('daemon.sock'))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.path
+    server.shutdown()
+    server.server_close()
+
+
+def test_connect_modes(daemon, tmp_path):
+    assert connect(tmp_path.joinpath('missing.sock')) is None
+    assert connect(daemon, mode=False) is None
+    with pytest.raises(DaemonError):
+        connect(tmp_path.joinpath('missing.sock'), mode=True)
+    with connect(daemon) as client:
+        assert client.ping() > 0
+
+
+def test_queries_and_streams_share_one_connection(daemon):
+    with DaemonClient(daemon) as client:
+        assert [x.uid for x in client.list_keys()] == ['Alice <alice@example.com>']
+        status = client.status(verbose=True)
+        assert status['agent_pid'] == 1234 and status['card_status'].startswith('Reader')
+        payload = b'abc' * 500000
+        assert b''.join(client.encrypt(payload, 'AA')) == b'AA:' + payload.upper()
+        assert b''.join(client.decrypt([b'ABC', b'DEF'])) == b'abcdef'
+
+
+def test_failed_operation_keeps_the_connection_usable(daemon):
+    with DaemonClient(daemon) as client:
+        with pytest.raises(DaemonError, match='exit code 2'):
+            b''.join(client.decrypt([b'good', b'bad', b'more'] * 1000))
+        with pytest.raises(DaemonError, match='Unknown operation'):
+            client.call('nope')
+        assert client.ping() > 0
+
+
+def test_client_leaving_while_a_failed_request_is_drained(tmp_path):
+    server = EnclaveDaemon(FakeEnclave(tmp_path), tmp_path.joinpath('daemon.sock'))
+    errors = []
+    finished = threading.Event()
+    server.handle_error = lambda request, address: errors.append(address)
+    shutdown_request = server.shutdown_request
+    server.shutdown_request = lambda request: (shutdown_request(request), finished.set())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(server.path.as_posix())
+            protocol.send_header(sock, {'op': 'nope'})
+            protocol.send_frame(sock, b'part of a body')
+            # Gone before the empty frame that ends the body
+            assert protocol.recv_frame(sock) == b''
+        assert finished.wait(5) and errors == []
+        with DaemonClient(server.path) as client:
+            assert client.ping() > 0
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_config_values_round_trip(daemon):
+    with DaemonClient(daemon) as client:
+        client.config_set('api.token', b'secret', 'AA')
+        assert client.config_list() == ['api.token']
+        assert client.config_get('api.token') == b'secret'
+        with pytest.raises(DaemonError, match='No configuration named'):
+            client.config_get('missing')
+
+
+def test_concurrent_clients(daemon):
+    results = {}
+
+    def work(idx):
+        with DaemonClient(daemon) as client:
+            results[idx] = b''.join(client.encrypt(str(idx).encode() * 10000, 'R'))
+
+    threads = [threading.Thread(target=work, args=(x,)) for x in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(results[x] == b'R:' + str(x).encode() * 10000 for x in range(8))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""Tests for envelope encryption, with a fake gpg wrapping the data key."""
+
+import os
+
+import pytest
+
+from secureenclave import envelope
+from secureenclave.gpg import iter_chunks
+
+
+class FakeGpg:
+    def __init__(self):
+        self.calls = []
+
+    def stream(self, args, source):
+        self.calls.append(args[0])
+        data = b''.join(iter_chunks(source))
+        if args[0] == '--encrypt':
+            return iter([b'WRAPPED:' + bytes(x ^ 0x5a for x in data)])
+        return iter([bytes(x ^ 0x5a for x in data[len(b'WRAPPED:'):])])
+
+
+class FakeEnclave:
+    def __init__(self):
+        self.gpg = FakeGpg()
+
+
+def roundtrip(plaintext, chunk_size=1024, workers=4):
+    enclave = FakeEnclave()
+    sealed = b''.join(envelope.encrypt(enclave, plaintext, ['AA' * 20], chunk_size, workers))
+    return enclave, sealed, b''.join(envelope.decrypt(enclave, sealed, workers))
+
+
+@pytest.mark.parametrize('size', [0, 1, 1024, 1025, 10 * 1024 + 7])
+def test_roundtrip(size):
+    plaintext = os.urandom(size)
+    enclave, sealed, decrypted = roundtrip(plaintext)
+    assert decrypted == plaintext
+    assert envelope.is_envelope(sealed)
+    assert enclave.gpg.calls == ['--encrypt', '--decrypt']
+
+
+def test_rechunks_uneven_sources():
+    plaintext = os.urandom(5000)
+    enclave = FakeEnclave()
+    source = [plaintext[:7], plaintext[7:3000], plaintext[3000:]]
+    sealed = b''.join(envelope.encrypt(enclave, source, ['AA' * 20], 1024))
+    assert b''.join(envelope.decrypt(enclave, [sealed[:10], sealed[10:]])) == plaintext
+
+
+def test_detects_tampering_and_truncation():
+    enclave, sealed, _ = roundtrip(os.urandom(4096))
+    tampered = bytearray(sealed)
+    tampered[-100] ^= 1
+    with pytest.raises(envelope.EnvelopeError, match='failed authentication'):
+        b''.join(envelope.decrypt(enclave, bytes(tampered)))
+    # Dropping the last chunk leaves a valid chunk that was not sealed as the final one
+    with pytest.raises(envelope.EnvelopeError, match='failed authentication'):
+        b''.join(envelope.decrypt(enclave, sealed[:-(1024 + envelope.__tag_size__)]))
+
+
+def test_rejects_other_formats():
+    with pytest.raises(envelope.EnvelopeError, match='Not an envelope'):
+        b''.join(envelope.decrypt(FakeEnclave(), b'-----BEGIN PGP MESSAGE-----'))
+    prefix, chunks = envelope.peek([b'SEE', b'NV', b'\x00\x01\x00rest'])
+    assert envelope.is_envelope(prefix)
+    assert b''.join(chunks) == b'SEENV\x00\x01\x00rest'
+
+
+def test_reader_decrypts_ranges(tmp_path):
+    plaintext = os.urandom(10 * 1024 + 7)
+    enclave, sealed, _ = roundtrip(plaintext)
+    path = tmp_path.joinpath('data.sev')
+    path.write_bytes(sealed)
+    with envelope.EnvelopeReader(enclave, path) as reader:
+        assert reader.size == len(plaintext)
+        assert b''.join(reader.iter_range(1000, 3100)) == plaintext[1000:3100]
+        reader.seek(-10, 2)
+        assert reader.read() == plaintext[-10:]
+        reader.seek(5)
+        assert reader.read(2000) == plaintext[5:2005]
+        assert reader.tell() == 2005
+        assert b''.join(reader.iter_range(10 * 1024, 99999)) == plaintext[10 * 1024:]
+
+
+def test_reader_rejects_truncated_files(tmp_path):
+    enclave, sealed, _ = roundtrip(os.urandom(4096))
+    path = tmp_path.joinpath('data.sev')
+    path.write_bytes(sealed[:-(1024 + envelope.__tag_size__)])
+    with envelope.EnvelopeReader(enclave, path) as reader:
+        with pytest.raises(envelope.EnvelopeError, match='failed authentication'):
+            reader.read()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+"""Tests for the `Gpg` wrapper."""
+
+import io
+import shutil
+import subprocess
+
+import pytest
+
+from secureenclave.gpg import Gpg, iter_chunks, parse_colons
+
+needs_gpg = pytest.mark.skipif(not shutil.which('gpg'), reason='gpg is not installed')
+
+
+@pytest.fixture
+def gpg(tmp_path):
+    gpg = Gpg(tmp_path)
+    yield gpg
+    subprocess.run(['gpgconf', '--kill', 'gpg-agent'], env=gpg.getenv(), capture_output=True)
+
+
+def test_iter_chunks_accepts_bytes_files_and_iterables():
+    assert list(iter_chunks(b'abcde', 2)) == [b'ab', b'cd', b'e']
+    assert list(iter_chunks(io.BytesIO(b'abcde'), 3)) == [b'abc', b'de']
+    assert list(iter_chunks(iter([b'ab', b'', b'c']))) == [b'ab', b'c']
+
+
+def test_parse_colons_keeps_every_uid_and_subkey():
+    raw = '\n'.join([
+        'tru::1:1700000000:0:3:1:5',
+        'pub:u:255:22:FFD95C0CD76BC55C:1700000000:::u:::cEC:::::ed25519:::0:',
+        'fpr:::::::::E8FD8EA72DA1CCA9BB2F3E72FFD95C0CD76BC55C:',
+        'grp:::::::::4DD62BEC2FC3A94ECEB33E5201F326303027FAF1:',
+        'uid:u::::1700000000::AA::Alice\\x3a Admin <alice@example.com>::::::::::0:',
+        'uid:u::::1700000000::BB::Alice <alice@work.example.com>::::::::::0:',
+        'sub:u:255:18:674E6506CFC77FD6:1700000000:1800000000:::::e:::::cv25519::',
+        'fpr:::::::::70E457F4BE1F5AB1EC3DA00C674E6506CFC77FD6:',
+        'pub:-:4096:1:9DE7AA55F03AD273:1700000000::::::scSC::::::23::0:',
+        'fpr:::::::::0718FC3C5271B568B26A6E6C9DE7AA55F03AD273:',
+    ])
+    alice, bare = parse_colons(raw)
+    assert alice.uid == 'Alice: Admin <alice@example.com>'
+    assert alice.uids == ['Alice: Admin <alice@example.com>', 'Alice <alice@work.example.com>']
+    assert (alice.pub, alice.trust, alice.capabilities) == ('ed25519/0xFFD95C0CD76BC55C', 'ultimate', 'cEC')
+    assert alice.keygrip == '4DD62BEC2FC3A94ECEB33E5201F326303027FAF1'
+    assert [(x.pub, x.capabilities, x.expires) for x in alice.subkeys] == [('cv25519/0x674E6506CFC77FD6', 'e', 1800000000)]
+    assert alice.subkeys[0].fingerprint == '70E457F4BE1F5AB1EC3DA00C674E6506CFC77FD6'
+    assert (bare.pub, bare.uid, bare.trust) == ('rsa4096/0x9DE7AA55F03AD273', '', 'unknown')
+
+
+@needs_gpg
+def test_stream_round_trip_through_pipes(gpg):
+    payload = bytes(range(256)) * 8192
+    armored = b''.join(gpg.stream(['--enarmor'], io.BytesIO(payload)))
+    assert armored.startswith(b'-----BEGIN PGP ARMORED FILE-----')
+    assert b''.join(gpg.stream(['--dearmor'], iter_chunks(armored, 1000))) == payload
+
+
+@needs_gpg
+def test_stream_raises_on_gpg_failure(gpg):
+    with pytest.raises(Exception, match='gpg failed'):
+        b''.join(gpg.stream(['--decrypt'], b'not an openpgp message'))
+
+
+@needs_gpg
+def test_key_index_lists_keyring_only_when_it_changes(gpg, tmp_path):
+    env = gpg.getenv()
+    listings = []
+    list_keys = gpg.list_keys
+    gpg.list_keys = lambda: listings.append(1) or list_keys()
+
+    subprocess.run([gpg.getbin(), '--batch', '--passphrase', '', '--quick-generate-key', 'Alice <alice@example.com>',
+                    'ed25519', 'cert', 'never'], env=env, capture_output=True, check=True)
+    alice = gpg.get_keys()
+    assert [x.uid for x in alice] == ['Alice <alice@example.com>']
+    assert gpg.key_index().has_pub(alice[0].pub)
+    assert len(listings) == 1
+
+    reloaded = Gpg(tmp_path)
+    assert reloaded.get_keys() == alice
+
+    subprocess.run([gpg.getbin(), '--batch', '--passphrase', '', '--quick-generate-key', 'Bob <bob@example.com>',
+                    'ed25519', 'cert', 'never'], env=env, capture_output=True, check=True)
+    assert len(gpg.key_index().find_uid('Bob <bob@example.com>')) == 1
+    assert len(listings) == 2
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""Tests for gpg-agent reuse and idle shutdown, against a real agent in a temporary home."""
+
+import shutil
+import subprocess
+import threading
+import time
+
+import psutil
+import pytest
+
+from secureenclave import gpgagent
+from secureenclave.gpg import Gpg
+
+pytestmark = pytest.mark.skipif(not (shutil.which('gpg-agent') and shutil.which('pinentry-tty')), reason='gpg-agent or pinentry-tty is not installed')
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def alive(pid):
+    """Whether pid runs. The agent daemonizes, so it may linger as a zombie where init does not reap it"""
+    try:
+        return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
+
+@pytest.fixture
+def gpg(tmp_path):
+    gpg = Gpg(tmp_path)
+    yield gpg
+    subprocess.run(['gpgconf', '--kill', 'all'], env=gpg.getenv(), capture_output=True)
+
+
+def test_running_agent_is_reused(gpg):
+    agent = gpgagent.GpgAgent(gpg)
+    agent.start()
+    again = gpgagent.GpgAgent(gpg)
+    again.start()
+    assert again.gpg_agent_pid == agent.gpg_agent_pid and alive(agent.gpg_agent_pid)
+    assert again.shutdown()
+    assert wait_until(lambda: not alive(agent.gpg_agent_pid))
+    assert not gpgagent.GpgAgent(gpg).shutdown()
+
+
+def test_release_leaves_one_reaper_that_stops_the_idle_agent(gpg):
+    agent = gpgagent.GpgAgent(gpg)
+    agent.start()
+    agent.release(1)
+    reaper_pid = gpg.gethome().joinpath('gpg-agent-reaper.pid').read_text()
+    agent.release(1)
+    assert gpg.gethome().joinpath('gpg-agent-reaper.pid').read_text() == reaper_pid
+    assert wait_until(lambda: not alive(agent.gpg_agent_pid))
+
+
+def test_held_agent_outlives_the_idle_timeout(gpg):
+    agent = gpgagent.GpgAgent(gpg)
+    agent.start()
+    agent.hold(3)
+    # gpg-agent waits for open connections before it stops
+    agent.assuan.close()
+    reaper = threading.Thread(target=gpgagent.reap, args=(agent.stamp_path().as_posix(), agent.gpg_agent_pid, 3), daemon=True)
+    reaper.start()
+    time.sleep(4)
+    assert alive(agent.gpg_agent_pid)
+    agent.release(0)
+    assert wait_until(lambda: not alive(agent.gpg_agent_pid))
+    reaper.join(5)
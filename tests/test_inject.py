@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+"""Tests for handing decrypted secrets to a child process."""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+from secureenclave import inject
+
+
+class FakeEnclave:
+    """Decryption is reversing the bytes"""
+    def decrypt_stream(self, source):
+        yield source.read()[::-1]
+
+
+def test_parse_binding():
+    assert inject.parse_binding('API_TOKEN=secrets/token.asc') == ('API_TOKEN', 'secrets/token.asc')
+    for value in ['1TOKEN=x', 'TOKEN', 'TOKEN=', 'MY-TOKEN=x']:
+        with pytest.raises(ValueError):
+            inject.parse_binding(value)
+
+
+def test_secrets_reach_the_child(tmp_path):
+    tmp_path.joinpath('token.asc').write_bytes(b'\nnekot')
+    tmp_path.joinpath('key.asc').write_bytes(bytes(range(256))[::-1] * 1024)
+    env, fds = inject.prepare(FakeEnclave(), [('TOKEN', tmp_path.joinpath('token.asc').as_posix())],
+                              [('KEY', tmp_path.joinpath('key.asc').as_posix())])
+    try:
+        assert env['TOKEN'] == 'token' and env['KEY'] == f'/dev/fd/{fds[0]}'
+        child = subprocess.run([sys.executable, '-c', 'import os, sys; sys.stdout.buffer.write(open(os.environ["KEY"], "rb").read())'],
+                               env=env, pass_fds=fds, capture_output=True, check=True)
+        assert child.stdout == bytes(range(256)) * 1024
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def test_bad_bindings(tmp_path):
+    tmp_path.joinpath('binary.asc').write_bytes(b'a\x00b')
+    with pytest.raises(Exception, match='NUL bytes'):
+        inject.prepare(FakeEnclave(), [('BINARY', tmp_path.joinpath('binary.asc').as_posix())], [])
+    with pytest.raises(Exception, match='more than once: TOKEN'):
+        inject.prepare(FakeEnclave(), [('TOKEN', 'a')], [('TOKEN', 'b')])
+    with pytest.raises(Exception, match='Command not found'):
+        inject.find_executable('no-such-command-here')
+
+
+def test_execute_replaces_the_process():
+    code = ('from secureenclave import inject; '
+            'inject.execute(inject.find_executable("sh"), ["sh", "-c", "echo $SECRET"], {"SECRET": "value"})')
+    child = subprocess.run([sys.executable, '-c', code], capture_output=True, check=True)
+    assert child.stdout == b'value\n'
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""Tests for batch key provisioning."""
+
+import shutil
+import subprocess
+
+import pytest
+
+from secureenclave import provision
+from secureenclave.secureenclave import SecureEnclave, Needs
+
+SPEC = """[defaults]
+expire = 1y
+
+[alice]
+name = Alice Example
+email = alice@example.com
+comment = laptop
+
+[bob]
+name = Bob
+type = rsa3072
+subkeys = encrypt
+passphrase-env = BOB_PASSPHRASE
+"""
+
+
+def test_load_spec_and_parameters(monkeypatch):
+    monkeypatch.setenv('BOB_PASSPHRASE', 'correct horse')
+    alice, bob = provision.load_spec(SPEC)
+    assert alice.uid == 'Alice Example (laptop) <alice@example.com>'
+    assert (alice.key_type, alice.expire, alice.subkeys, alice.passphrase) == ('ed25519', '1y', ['sign', 'encrypt', 'auth'], None)
+    assert (bob.key_type, bob.subkeys, bob.passphrase) == ('rsa3072', ['encrypt'], 'correct horse')
+    params = provision.parameters([alice, bob]).split('%commit\n')
+    assert 'Key-Curve: ed25519\nKey-Usage: cert\nSubkey-Type: eddsa\nSubkey-Curve: ed25519\nSubkey-Usage: sign\n' in params[0]
+    assert '%no-protection\nHandle: alice\n' in params[0]
+    assert 'Key-Length: 3072\nKey-Usage: cert\nSubkey-Type: rsa\nSubkey-Length: 3072\nSubkey-Usage: encrypt\n' in params[1]
+    assert 'Passphrase: correct horse\nHandle: bob\n' in params[1]
+
+
+def test_bad_specs(monkeypatch):
+    monkeypatch.delenv('BOB_PASSPHRASE', raising=False)
+    with pytest.raises(Exception, match='BOB_PASSPHRASE, which is not set'):
+        provision.load_spec(SPEC)
+    with pytest.raises(Exception, match='unknown key type'):
+        provision.load_spec('[a]\nname = A\ntype = dsa1024\n')
+    with pytest.raises(Exception, match='unknown subkey usages: certify'):
+        provision.load_spec('[a]\nname = A\nsubkeys = sign, certify\n')
+    with pytest.raises(Exception, match='has no name'):
+        provision.load_spec('[a]\nemail = a@example.com\n')
+    with pytest.raises(Exception, match='no keys'):
+        provision.load_spec('[defaults]\ntype = ed25519\n')
+
+
+def test_parse_created():
+    status = ('[GNUPG:] KEY_CONSIDERED AAAA 0\n[GNUPG:] KEY_CREATED B ' + 'A' * 40 + ' alice\n'
+              '[GNUPG:] KEY_NOT_CREATED bob\n')
+    assert provision.parse_created(status) == {'alice': 'A' * 40, 'bob': None}
+
+
+@pytest.mark.skipif(not shutil.which('gpg'), reason='gpg is not installed')
+def test_provision_with_gpg(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_DATA_HOME', tmp_path.as_posix())
+    secure_enclave = SecureEnclave(Needs.NOTHING)
+    identities = [provision.Identity(f'member{idx}', f'Member {idx}', f'member{idx}@example.com') for idx in range(3)]
+    identities[2].subkeys = ['encrypt']
+    try:
+        outcomes = secure_enclave.provision_keys(identities)
+        assert all(x.ok for x in outcomes)
+        keys = {x.fingerprint: x for x in secure_enclave.gpg.get_keys()}
+        assert set(keys) == {x.fingerprint for x in outcomes}
+        assert sorted(x.capabilities for x in keys[outcomes[0].fingerprint].subkeys) == ['a', 'e', 's']
+        assert [x.capabilities for x in keys[outcomes[2].fingerprint].subkeys] == ['e']
+    finally:
+        subprocess.run(['gpgconf', '--kill', 'all'], env=secure_enclave.gpg.getenv(), capture_output=True)
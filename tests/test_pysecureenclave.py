@@ -1,37 +1,36 @@
 #!/usr/bin/env python
 
-"""Tests for `pysecureenclave` package."""
+"""Tests for `secureenclave` package."""
 
 import pytest
 from click.testing import CliRunner
 
-from pysecureenclave import pysecureenclave
-from pysecureenclave import cli
-
+from secureenclave import cli
 
 
 @pytest.fixture
-def response():
-    """Sample pytest fixture.
-
-    See more at: http://doc.pytest.org/en/latest/fixture.html
-    """
-    # import requests
-    # return requests.get('https://github.com/audreyr/cookiecutter-pypackage')
-
-
-def test_content(response):
-    """Sample pytest test function with the pytest fixture as an argument."""
-    # from bs4 import BeautifulSoup
-    # assert 'GitHub' in BeautifulSoup(response.content).title.string
+def runner(tmp_path, monkeypatch):
+    """CLI runner with the enclave home in a temporary directory"""
+    monkeypatch.setenv('XDG_DATA_HOME', tmp_path.as_posix())
+    return CliRunner()
 
 
-def test_command_line_interface():
+def test_command_line_interface(runner):
     """Test the CLI."""
-    runner = CliRunner()
-    result = runner.invoke(cli.main)
+    result = runner.invoke(cli.cli, ['--help'])
     assert result.exit_code == 0
-    assert 'pysecureenclave.cli.main' in result.output
-    help_result = runner.invoke(cli.main, ['--help'])
-    assert help_result.exit_code == 0
-    assert '--help  Show this message and exit.' in help_result.output
+    for command in ('enc', 'dec', 'key', 'card', 'agent', 'config', 'daemon', 'purge'):
+        assert command in result.output
+    version_result = runner.invoke(cli.cli, ['--version'])
+    assert version_result.exit_code == 0
+    assert cli.__version__ in version_result.output
+
+
+def test_enc_needs_a_recipient_for_stdin_and_stdout(runner, tmp_path):
+    result = runner.invoke(cli.cli, ['enc', '-', '-'])
+    assert result.exit_code == 2
+    assert 'needs --recipient' in result.output
+    tmp_path.joinpath('plain').write_text('plain')
+    result = runner.invoke(cli.cli, ['enc', tmp_path.joinpath('plain').as_posix(), '-'])
+    assert result.exit_code == 2
+    assert 'needs --recipient' in result.output
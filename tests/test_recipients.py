@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""Tests for recipient resolution and recipient groups."""
+
+import pytest
+
+from secureenclave.gpg import GpgKey, GpgSubkey
+from secureenclave.recipients import load_groups, resolve
+
+ALICE = GpgKey('Alice <alice@example.com>', 'ed25519/0x01', 'A' * 40, 'ultimate', uids=['Alice <alice@example.com>', 'Alice <alice@ops.example.com>'],
+               capabilities='scESC', subkeys=[GpgSubkey('cv25519/0x02', 'C' * 24 + '0123456789ABCDEF', 'e')])
+BOB = GpgKey('Bob <bob@ops.example.com>', 'ed25519/0x03', 'B' * 40, 'full', uids=['Bob <bob@ops.example.com>'], capabilities='scESC')
+CAROL = GpgKey('Carol <carol@example.com>', 'ed25519/0x04', 'D' * 40, 'marginal', uids=['Carol <carol@example.com>'], capabilities='scESC')
+EVE = GpgKey('Eve <eve@example.com>', 'ed25519/0x05', 'E' * 40, 'revoked', uids=['Eve <eve@example.com>'], capabilities='scESC')
+MALLORY = GpgKey('Mallory <mallory@example.com>', 'ed25519/0x06', 'F' * 40, 'unknown', uids=['Mallory <mallory@example.com>'], capabilities='scESC')
+KEYS = [ALICE, BOB, CAROL, EVE, MALLORY]
+
+
+def test_resolves_fingerprints_key_ids_and_uid_patterns():
+    assert resolve(KEYS, ['0x' + 'B' * 40]) == [BOB.fingerprint]
+    assert resolve(KEYS, ['0123456789abcdef']) == [ALICE.fingerprint]
+    assert resolve(KEYS, ['carol@']) == [CAROL.fingerprint]
+    assert resolve(KEYS, ['*@ops.example.com>', 'alice']) == [ALICE.fingerprint, BOB.fingerprint]
+
+
+def test_a_plain_recipient_is_one_key():
+    malice = GpgKey('Malice <malice@example.com>', 'ed25519/0x08', '8' * 40, 'full', uids=['Malice <malice@example.com>'], capabilities='scESC')
+    keys = KEYS + [malice]
+    with pytest.raises(Exception, match='matches several keys: ' + 'A' * 40 + r' \(Alice <alice@example.com>\), ' + '8' * 40):
+        resolve(keys, ['alice'])
+    with pytest.raises(Exception, match='matches several keys'):
+        resolve(keys, ['example.com'])
+    assert resolve(keys, ['alice@example.com']) == [ALICE.fingerprint]
+    assert resolve(keys, ['<Malice@example.com>']) == [malice.fingerprint]
+    assert resolve(keys, ['Alice <alice@example.com>']) == [ALICE.fingerprint]
+    assert resolve(keys, ['*alice@example.com>']) == [ALICE.fingerprint, malice.fingerprint]
+
+
+def test_all_trusted_skips_untrusted_and_revoked_keys():
+    assert resolve(KEYS, [], all_trusted=True) == [ALICE.fingerprint, BOB.fingerprint]
+    assert resolve(KEYS, ['carol'], all_trusted=True) == [ALICE.fingerprint, BOB.fingerprint, CAROL.fingerprint]
+
+
+def test_unknown_or_unusable_recipients_fail():
+    with pytest.raises(Exception, match='No usable key matches'):
+        resolve(KEYS, ['eve'])
+    with pytest.raises(Exception, match='unknown validity: ' + 'F' * 40):
+        resolve(KEYS, ['mallory'])
+    with pytest.raises(Exception, match='too low validity'):
+        resolve(KEYS + [GpgKey('Mallory <mallory@example.org>', 'ed25519/0x07', '7' * 40, 'never', uids=['Mallory <mallory@example.org>'])], ['mallory*'])
+    assert resolve(KEYS, ['mallory'], usable=False) == [MALLORY.fingerprint]
+    with pytest.raises(Exception, match='No recipient group named'):
+        resolve(KEYS, ['@nobody'])
+
+
+def test_groups_from_the_enclave_config(tmp_path):
+    tmp_path.joinpath('secureenclave.ini').write_text('[groups]\nOps = bob@ops, @Admins\nadmins = Alice <alice@example.com>\n'
+                                                      '    0x' + 'D' * 16 + '\nloop = @loop\n')
+    groups = load_groups(tmp_path)
+    assert groups['admins'] == ['Alice <alice@example.com>', '0x' + 'D' * 16]
+    assert resolve(KEYS, ['@ops'], groups) == [BOB.fingerprint, ALICE.fingerprint, CAROL.fingerprint]
+    with pytest.raises(Exception, match='includes itself'):
+        resolve(KEYS, ['@loop'], groups)
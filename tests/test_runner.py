@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""Tests for the process runner behind every gpg call."""
+
+import sys
+import threading
+
+import pytest
+
+from secureenclave import runner
+
+
+def python(code):
+    return [sys.executable, '-c', code]
+
+
+def test_run_uses_pipes_and_argv():
+    result = runner.run(python('import sys; sys.stdout.write(sys.stdin.read() + sys.argv[1])') + ['"quoted $HOME"'], input=b'in:')
+    assert result.ok
+    assert result.text == 'in:"quoted $HOME"'
+
+
+def test_failures_and_timeouts():
+    with pytest.raises(runner.RunnerError, match='exit code 3: boom'):
+        runner.run(python('import sys; sys.stderr.write("boom"); sys.exit(3)'), check=True)
+    with pytest.raises(TimeoutError):
+        runner.run(python('import time; time.sleep(10)'), timeout=0.2)
+    with pytest.raises(TimeoutError):
+        b''.join(runner.stream(python('import time; time.sleep(10)'), None, [b'data'], timeout=0.2))
+
+
+def test_stream_round_trips_data():
+    payload = bytes(range(256)) * 1024
+    copy = python('import sys, shutil; shutil.copyfileobj(sys.stdin.buffer, sys.stdout.buffer)')
+    assert b''.join(runner.stream(copy, None, [payload[:1000], payload[1000:]])) == payload
+
+
+def test_concurrency_is_bounded(monkeypatch):
+    monkeypatch.setattr(runner, '_slots', threading.BoundedSemaphore(2))
+    original_run = runner.subprocess.run
+    running, peak, lock = [0], [0], threading.Lock()
+    def counting_run(*args, **kwargs):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        try:
+            return original_run(*args, **kwargs)
+        finally:
+            with lock:
+                running[0] -= 1
+    monkeypatch.setattr(runner.subprocess, 'run', counting_run)
+    threads = [threading.Thread(target=runner.run, args=(python('import time; time.sleep(0.1)'),)) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak[0] == 2
+
+
+def test_unfinished_stream_gives_its_slot_back(monkeypatch):
+    monkeypatch.setattr(runner, '_slots', threading.BoundedSemaphore(1))
+    pending = runner.stream(python('import sys; sys.stdout.write("one"); sys.stdout.flush(); sys.stdout.write("two")'), None, [], read_size=3)
+    assert next(pending) == b'one'
+    # Nobody reads the rest or closes the stream, the process is gone anyway
+    assert runner._slots.acquire(timeout=5)
+    runner._slots.release()
+    pending.close()
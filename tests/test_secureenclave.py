@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""Tests for `SecureEnclave` keyring operations against a real gpg in a temporary home."""
+
+import shutil
+import subprocess
+
+import pytest
+from click.testing import CliRunner
+
+from secureenclave import cli, openpgp
+from secureenclave.gpg import parse_colons
+from secureenclave.secureenclave import SecureEnclave, Needs
+
+pytestmark = pytest.mark.skipif(not shutil.which('gpg'), reason='gpg is not installed')
+
+__key_params__ = """%no-protection
+Key-Type: eddsa
+Key-Curve: ed25519
+Subkey-Type: ecdh
+Subkey-Curve: cv25519
+Name-Real: Member {idx}
+Name-Email: member{idx}@team.example.com
+Expire-Date: 0
+%commit
+"""
+
+
+@pytest.fixture(scope='module')
+def team_keys(tmp_path_factory):
+    """Public keys of a few team members, generated in a keyring of their own and exported"""
+    home = tmp_path_factory.mktemp('team')
+    env = {'GNUPGHOME': home.as_posix(), 'PATH': '/usr/bin:/bin'}
+    params = ''.join(__key_params__.format(idx=idx) for idx in range(3))
+    subprocess.run(['gpg', '--batch', '--generate-key'], input=params.encode('utf-8'), env=env, capture_output=True, check=True)
+    exported = subprocess.run(['gpg', '--batch', '--export'], env=env, capture_output=True, check=True).stdout
+    yield exported
+    subprocess.run(['gpgconf', '--kill', 'all'], env=env, capture_output=True)
+
+
+@pytest.fixture
+def secure_enclave(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_DATA_HOME', tmp_path.as_posix())
+    secure_enclave = SecureEnclave(Needs.NOTHING)
+    yield secure_enclave
+    subprocess.run(['gpgconf', '--kill', 'all'], env=secure_enclave.gpg.getenv(), capture_output=True)
+
+
+def test_set_ownertrust_in_one_call(secure_enclave, team_keys):
+    secure_enclave.gpg.run(['--batch', '--import'], input=team_keys, check=True)
+    keys = secure_enclave.find_keys(['*@team.example.com>'])
+    assert len(keys) == 3 and {x.trust for x in keys} == {'unknown'}
+    changes = secure_enclave.set_ownertrust([x.fingerprint for x in keys[:2]])
+    assert sorted((x.fingerprint, before, after) for x, before, after in changes) == \
+        sorted((x.fingerprint, ('unknown', 'unknown'), ('ultimate', 'ultimate')) for x in keys[:2])
+    assert secure_enclave.find_keys(['member2@'])[0].ownertrust == 'unknown'
+    changes = secure_enclave.set_ownertrust([keys[2].fingerprint], 'marginal')
+    assert [(x.fingerprint, after) for x, _, after in changes] == [(keys[2].fingerprint, ('marginal', 'unknown'))]
+
+
+def test_untrusted_recipients_are_refused_before_gpg_is(secure_enclave, team_keys):
+    secure_enclave.import_keys([team_keys])
+    fingerprint = secure_enclave.find_keys(['member0@'])[0].fingerprint
+    # gpg --batch itself will not encrypt to an imported key nobody vouched for
+    with pytest.raises(Exception):
+        b''.join(secure_enclave.encrypt_stream([b'secret'], [fingerprint]))
+    with pytest.raises(Exception, match='unknown validity'):
+        secure_enclave.resolve_recipients(['member0@'])
+    secure_enclave.set_ownertrust([fingerprint])
+    recipients = secure_enclave.resolve_recipients(['member0@'])
+    assert recipients == [fingerprint] and b''.join(secure_enclave.encrypt_stream([b'secret'], recipients))
+
+
+def test_import_keys_skips_what_the_keyring_has(secure_enclave, team_keys):
+    first, *rest = openpgp.split_keys(team_keys)
+    assert secure_enclave.import_keys([first.data]) == {'new': 1, 'updated': 0, 'unchanged': 0, 'skipped': 0, 'secret': 0}
+    armored = secure_enclave.gpg.run(['--batch', '--enarmor'], input=b''.join(x.data for x in rest)).stdout
+    armored = armored.replace(b'ARMORED FILE', b'PUBLIC KEY BLOCK')
+    summary = secure_enclave.import_keys([team_keys, armored, first.data])
+    assert summary == {'new': 2, 'updated': 0, 'unchanged': 0, 'skipped': 4, 'secret': 0}
+    assert {x.fingerprint for x in secure_enclave.gpg.get_keys()} == {x.fingerprint for x in [first] + rest}
+    assert secure_enclave.import_keys([team_keys])['skipped'] == 3
+    assert secure_enclave.import_keys([team_keys], force=True)['unchanged'] == 3
+
+
+def test_import_keys_takes_a_revoked_copy_of_a_known_key(secure_enclave, team_keys, tmp_path):
+    home = tmp_path.joinpath('owner')
+    home.mkdir()
+    env = {'GNUPGHOME': home.as_posix(), 'PATH': '/usr/bin:/bin'}
+    subprocess.run(['gpg', '--batch', '--generate-key'], input=__key_params__.format(idx=9).encode('utf-8'), env=env, capture_output=True, check=True)
+    fingerprint = parse_colons(subprocess.run(['gpg', '--batch', '--with-colons', '--list-keys'], env=env, capture_output=True).stdout.decode())[0].fingerprint
+    key = subprocess.run(['gpg', '--batch', '--export', fingerprint], env=env, capture_output=True, check=True).stdout
+    assert secure_enclave.import_keys([key])['new'] == 1
+    assert secure_enclave.import_keys([key])['skipped'] == 1
+    revocation = home.joinpath('openpgp-revocs.d', f'{fingerprint}.rev').read_bytes().replace(b':-----BEGIN', b'-----BEGIN')
+    subprocess.run(['gpg', '--batch', '--import'], input=revocation, env=env, capture_output=True, check=True)
+    revoked = subprocess.run(['gpg', '--batch', '--export', fingerprint], env=env, capture_output=True, check=True).stdout
+    subprocess.run(['gpgconf', '--kill', 'all'], env=env, capture_output=True)
+    assert secure_enclave.import_keys([revoked])['updated'] == 1
+    assert secure_enclave.find_keys([fingerprint])[0].trust == 'revoked'
+
+
+def test_key_import_skips_files_without_keys(secure_enclave, team_keys, tmp_path):
+    bundles = tmp_path.joinpath('bundles')
+    bundles.mkdir()
+    bundles.joinpath('team.gpg').write_bytes(team_keys)
+    bundles.joinpath('README').write_text('Keys of the team\n')
+    # A signature packet, framed fine but no key
+    bundles.joinpath('team.gpg.sig').write_bytes(bytes([0x88, 0x04, 4, 0, 22, 10]))
+    bundles.joinpath('broken.asc').write_text('-----BEGIN PGP PUBLIC KEY BLOCK-----\n\nnot base64!\n-----END PGP PUBLIC KEY BLOCK-----\n')
+    result = CliRunner().invoke(cli.cli, ['key', 'import', bundles.as_posix()])
+    assert result.exit_code == 0, result.output
+    assert len(secure_enclave.gpg.get_keys()) == 3
+
+
+@pytest.mark.parametrize('data', [b'\xc6', b'\xc6\xc0', b'\xc6\xff\x00\x00', b'\x99', b'\x9a\x00\x00', b'\xc6\x05ab', b'README\n'])
+def test_truncated_or_foreign_data_raises_packet_error(data):
+    with pytest.raises(openpgp.PacketError):
+        openpgp.split_keys(data)
+
+
+def test_split_keys_matches_gpg_fingerprints(secure_enclave, team_keys):
+    listed = secure_enclave.gpg.run(['--batch', '--with-colons', '--import-options', 'show-only', '--import'], input=team_keys).text
+    blocks = openpgp.split_keys(team_keys)
+    assert [x.fingerprint for x in blocks] == [x.fingerprint for x in parse_colons(listed)]
+    assert [x.subkeys for x in blocks] == [[y.fingerprint for y in x.subkeys] for x in parse_colons(listed)]
+    assert blocks[0].uids == ['Member 0 <member0@team.example.com>']
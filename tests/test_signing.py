@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""Tests for signed manifests."""
+
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+
+from secureenclave import batch, cli, signing
+from secureenclave.secureenclave import SecureEnclave, Needs
+
+__validsig__ = '[GNUPG:] VALIDSIG {sub} 2024-01-01 1704067200 0 4 0 22 10 00 {primary}\n'
+
+
+def make_files(base, count=20):
+    base.joinpath('nested').mkdir(parents=True, exist_ok=True)
+    files = [base.joinpath('nested' if idx % 2 else '', f'file{idx}') for idx in range(count)]
+    for idx, path in enumerate(files):
+        path.write_bytes(bytes([idx]) * (idx * 1000))
+    return files
+
+
+def test_manifest_round_trip_and_check(tmp_path):
+    files = make_files(tmp_path)
+    data = signing.build(files, tmp_path, workers=4)
+    entries = signing.parse(data)
+    assert len(entries) == 20 and entries[0][0] == 'file0'
+    assert dict(entries)['nested/file1'] == batch.hash_file(files[1])
+    assert signing.check(entries, tmp_path) == ([], [])
+    files[3].write_bytes(b'changed')
+    files[4].unlink()
+    assert signing.check(entries, tmp_path) == (['nested/file3'], ['file4'])
+    with pytest.raises(Exception, match='Malformed manifest line 2'):
+        signing.parse(data.splitlines(True)[0] + b'not a manifest\n')
+    for name in [b'../outside', b'/etc/passwd', b'nested/../../outside']:
+        with pytest.raises(Exception, match='outside the manifest directory'):
+            signing.parse(b'0' * 64 + b'  ' + name + b'\n')
+
+
+def test_parse_status():
+    status = '[GNUPG:] GOODSIG 0102 Alice\n' + __validsig__.format(sub='C' * 40, primary='A' * 40) + '[GNUPG:] TRUST_FULLY 0 pgp\n'
+    assert signing.parse_status(status) == ('A' * 40, 'fully')
+    with pytest.raises(Exception, match='Bad signature'):
+        signing.parse_status('[GNUPG:] BADSIG 0102 Alice\n')
+    with pytest.raises(Exception, match='No valid signature'):
+        signing.parse_status('[GNUPG:] NEWSIG\n')
+    with pytest.raises(Exception, match='never trusted'):
+        signing.parse_status(__validsig__.format(sub='A' * 40, primary='A' * 40) + '[GNUPG:] TRUST_NEVER 0 pgp\n')
+    # Any key in the keyring can make a good signature, it must be trusted or the one asked for
+    untrusted = __validsig__.format(sub='C' * 40, primary='A' * 40) + '[GNUPG:] TRUST_UNDEFINED 0 pgp\n'
+    with pytest.raises(Exception, match='undefined trust'):
+        signing.parse_status(untrusted)
+    assert signing.parse_status(untrusted, '0x' + 'a' * 40) == ('A' * 40, 'undefined')
+    assert signing.parse_status(untrusted, 'C' * 40) == ('A' * 40, 'undefined')
+    with pytest.raises(Exception, match='not by'):
+        signing.parse_status(status, 'B' * 40)
+
+
+def generate_signer(secure_enclave):
+    secure_enclave.gpg.run(['--batch', '--generate-key'], check=True, input=b'%no-protection\nKey-Type: eddsa\nKey-Curve: ed25519\n'
+                           b'Name-Real: Signer\nName-Email: signer@example.com\nExpire-Date: 0\n%commit\n')
+
+
+@pytest.mark.skipif(not shutil.which('gpg'), reason='gpg is not installed')
+def test_sign_and_verify_with_gpg(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_DATA_HOME', tmp_path.joinpath('data').as_posix())
+    secure_enclave = SecureEnclave(Needs.NOTHING)
+    try:
+        generate_signer(secure_enclave)
+        files = make_files(tmp_path.joinpath('tree'))
+        manifest = tmp_path.joinpath('tree', signing.__manifest_name__)
+        signature = secure_enclave.sign_files(files, manifest)
+        assert signature.read_text().startswith('-----BEGIN PGP SIGNATURE-----')
+        result = secure_enclave.verify_files(manifest)
+        assert result.ok and result.checked == 20 and result.trust == 'ultimate'
+        assert result.signer == secure_enclave.gpg.get_keys()[0].fingerprint
+        manifest.write_bytes(manifest.read_bytes().replace(b'file1', b'file2', 1))
+        with pytest.raises(Exception, match='Bad signature'):
+            secure_enclave.verify_files(manifest)
+    finally:
+        subprocess.run(['gpgconf', '--kill', 'all'], env=secure_enclave.gpg.getenv(), capture_output=True)
+
+
+@pytest.mark.skipif(not shutil.which('gpg'), reason='gpg is not installed')
+def test_signing_files_outside_the_current_directory(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_DATA_HOME', tmp_path.joinpath('data').as_posix())
+    tmp_path.joinpath('cwd').mkdir()
+    monkeypatch.chdir(tmp_path.joinpath('cwd'))
+    secure_enclave = SecureEnclave(Needs.NOTHING)
+    try:
+        generate_signer(secure_enclave)
+        files = make_files(tmp_path.joinpath('tree'), 4)
+        with pytest.raises(Exception, match='not under'):
+            secure_enclave.sign_files(files, Path(signing.__manifest_name__))
+        assert not Path(signing.__manifest_name__).exists()
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ['sign', tmp_path.joinpath('tree', 'file*').as_posix(), tmp_path.joinpath('tree', 'nested').as_posix()])
+        assert result.exit_code == 0, result.output
+        manifest = tmp_path.joinpath('tree', signing.__manifest_name__)
+        assert [x for x, _ in signing.parse(manifest.read_bytes())] == ['file0', 'file2', 'nested/file1', 'nested/file3']
+        result = runner.invoke(cli.cli, ['verify', manifest.as_posix()])
+        assert result.exit_code == 0, result.output
+    finally:
+        subprocess.run(['gpgconf', '--kill', 'all'], env=secure_enclave.gpg.getenv(), capture_output=True)
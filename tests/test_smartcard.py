@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+"""Tests for smart card detection, using a simulated card."""
+
+import threading
+import time
+
+import pytest
+
+from secureenclave.smartcard import SimulatedDevice, SimulatedDeviceSource, SmartCard
+
+
+class FakeAgent:
+    def __init__(self, ready_after=0):
+        self.calls = 0
+        self.ready_after = ready_after
+
+    def list_readers(self):
+        self.calls += 1
+        return ['Yubico YubiKey OTP FIDO CCID 00 00'] if self.calls > self.ready_after else []
+
+
+def test_card_already_present_returns_without_waiting():
+    card = SimulatedDevice('0123', 1)
+    smartcard = SmartCard(None, FakeAgent(), SimulatedDeviceSource([card]))
+    start = time.monotonic()
+    assert smartcard.wait_for_it(timeout=1) == [(card, None)]
+    assert time.monotonic() - start < 0.1
+
+
+def test_inserted_card_is_picked_up_from_notification_and_scdaemon():
+    source = SimulatedDeviceSource()
+    agent = FakeAgent(ready_after=2)
+    card = SimulatedDevice('0123', 1)
+    threading.Timer(0.05, source.insert, [card]).start()
+    start = time.monotonic()
+    assert SmartCard(None, agent, source).wait_for_it(timeout=5) == [(card, None)]
+    assert time.monotonic() - start < 0.5
+    assert agent.calls == 3
+
+
+def test_wait_for_it_times_out():
+    with pytest.raises(TimeoutError):
+        SmartCard(None, FakeAgent(), SimulatedDeviceSource()).wait_for_it(timeout=0.1)
+
+
+def test_unreachable_scdaemon_resets_the_agent_connection():
+    class FailingAgent:
+        class assuan:
+            closed = 0
+
+            @classmethod
+            def close(cls):
+                cls.closed += 1
+
+        def list_readers(self):
+            raise TimeoutError('timed out')
+
+    agent = FailingAgent()
+    assert not SmartCard(None, agent, SimulatedDeviceSource()).is_ready()
+    assert agent.assuan.closed == 1
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+"""Startup-time regression tests for the CLI."""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+__budget__ = 1.0
+
+__script__ = '''
+import json, sys, time
+start = time.perf_counter()
+import click_loguru
+baseline = time.perf_counter() - start
+{prelude}
+from secureenclave.cli import cli
+try:
+    cli(sys.argv[1:], standalone_mode=False)
+except SystemExit:
+    pass
+elapsed = time.perf_counter() - start
+print(json.dumps({{'overhead': elapsed - baseline, 'modules': sorted(sys.modules)}}), file=sys.stderr)
+'''
+
+
+def run_cli(tmp_path, *args, prelude=''):
+    """Runs the CLI in a fresh interpreter and reports the time spent past the logging imports"""
+    env = dict(os.environ, XDG_DATA_HOME=tmp_path.as_posix(),
+               PYTHONPATH=os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(__file__))), os.environ.get('PYTHONPATH', '')]))
+    result = subprocess.run([sys.executable, '-c', __script__.format(prelude=prelude)] + list(args), env=env,
+                            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=60)
+    return json.loads(result.stderr.decode('utf-8').strip().splitlines()[-1])
+
+
+def test_help_imports_nothing_heavy(tmp_path):
+    report = run_cli(tmp_path, '--help')
+    assert not {'ykman', 'yubikit', 'bullet', 'invoke'} & set(report['modules'])
+    assert report['overhead'] < __budget__
+
+
+@pytest.mark.skipif(not shutil.which('gpg'), reason='gpg is not installed')
+def test_key_list_skips_agent_and_card(tmp_path):
+    report = run_cli(tmp_path, 'key', 'list')
+    assert not {'ykman', 'yubikit', 'bullet'} & set(report['modules'])
+    assert report['overhead'] < __budget__
+
+
+def test_purge_only_loads_the_prompt(tmp_path):
+    report = run_cli(tmp_path, 'purge', prelude='import bullet; bullet.YesNo.launch = lambda self: False')
+    assert 'bullet' in report['modules']
+    assert not {'ykman', 'yubikit', 'invoke'} & set(report['modules'])
+    assert report['overhead'] < __budget__
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""Tests for incremental `enc --sync`."""
+
+import os
+import shutil
+
+import pytest
+
+from secureenclave import batch, sync
+from secureenclave.gpg import GpgKey, GpgSubkey
+
+ALICE = GpgKey('Alice <alice@example.com>', 'ed25519/0x01', 'A' * 40, 'ultimate', uids=['Alice <alice@example.com>'],
+               capabilities='scESC', subkeys=[GpgSubkey('cv25519/0x02', 'C' * 40, 'e')])
+BOB = GpgKey('Bob <bob@example.com>', 'ed25519/0x03', 'B' * 40, 'full', uids=['Bob <bob@example.com>'], capabilities='scESC')
+
+
+class FakeGpg:
+    def __init__(self, keys):
+        self.keys = keys
+
+    def get_keys(self):
+        return self.keys
+
+
+class FakeEnclave:
+    """Copies instead of encrypting and remembers what it was asked to encrypt"""
+    def __init__(self, keys=(ALICE, BOB)):
+        self.gpg = FakeGpg(list(keys))
+        self.encrypted = []
+
+    def encrypt_many(self, jobs, recipients, workers, use_envelope, armor, compression):
+        def operation(source, target):
+            if source.name == 'broken':
+                return False, 'broken'
+            shutil.copy(source, target)
+            return True, None
+        self.encrypted.append(sorted(x.name for x, _ in jobs))
+        return batch.run_batch(operation, jobs, workers), 0.0
+
+
+@pytest.fixture
+def tree(tmp_path):
+    source = tmp_path.joinpath('conf')
+    source.joinpath('nested').mkdir(parents=True)
+    for name in ['a.yml', 'b.yml', 'nested/c.yml']:
+        source.joinpath(name).write_text(name)
+    return source, tmp_path.joinpath('out')
+
+
+def test_only_new_and_changed_files_are_encrypted(tree):
+    source, target = tree
+    enclave = FakeEnclave()
+    result = sync.sync(enclave, source, target, [ALICE.fingerprint])
+    assert result.ok and result.full and len(result.results) == 3
+    assert target.joinpath('nested', 'c.yml.gpg').read_text() == 'nested/c.yml'
+
+    # Touched without changes, changed, new and removed
+    os.utime(source.joinpath('a.yml'), ns=(1, 1))
+    source.joinpath('b.yml').write_text('changed')
+    source.joinpath('d.yml').write_text('d')
+    source.joinpath('nested', 'c.yml').unlink()
+    result = sync.sync(enclave, source, target, [ALICE.fingerprint])
+    assert not result.full
+    assert enclave.encrypted[-1] == ['b.yml', 'd.yml']
+    assert sorted(result.unchanged) == ['a.yml']
+    assert result.deleted == ['nested/c.yml.gpg'] and not target.joinpath('nested').exists()
+
+    result = sync.sync(enclave, source, target, [ALICE.fingerprint])
+    assert not result.results and len(enclave.encrypted) == 2
+
+
+def test_recipient_or_format_changes_encrypt_everything(tree):
+    source, target = tree
+    enclave = FakeEnclave()
+    sync.sync(enclave, source, target, [ALICE.fingerprint])
+    result = sync.sync(enclave, source, target, [ALICE.fingerprint, BOB.fingerprint])
+    assert result.full and len(result.results) == 3
+
+    # A new encryption subkey on a recipient changes the ciphertexts too
+    rotated = FakeEnclave([GpgKey(ALICE.uid, ALICE.pub, ALICE.fingerprint, 'ultimate', uids=ALICE.uids, capabilities='scESC',
+                                  subkeys=[GpgSubkey('cv25519/0x06', 'F' * 40, 'e')]), BOB])
+    assert sync.sync(rotated, source, target, [ALICE.fingerprint, BOB.fingerprint]).full
+
+    result = sync.sync(enclave, source, target, [ALICE.fingerprint], use_envelope=True)
+    assert result.full and sorted(result.deleted) == ['a.yml.gpg', 'b.yml.gpg', 'nested/c.yml.gpg']
+    assert target.joinpath('a.yml.sev').exists() and not target.joinpath('a.yml.gpg').exists()
+
+
+def test_failures_are_retried_on_the_next_sync(tree):
+    source, target = tree
+    source.joinpath('broken').write_text('x')
+    enclave = FakeEnclave()
+    assert not sync.sync(enclave, source, target, [ALICE.fingerprint]).ok
+    assert 'broken' not in sync.load_manifest(target)['files']
+    result = sync.sync(enclave, source, target, [ALICE.fingerprint])
+    assert [x.input.name for x in result.results] == ['broken']
+
+
+def test_target_inside_source_is_refused(tree):
+    source, _ = tree
+    with pytest.raises(Exception, match='is inside'):
+        sync.sync(FakeEnclave(), source, source.joinpath('out'), [ALICE.fingerprint])
+
+
+def test_manifest_entries_outside_the_target_are_not_deleted(tree, tmp_path):
+    source, target = tree
+    enclave = FakeEnclave()
+    sync.sync(enclave, source, target, [ALICE.fingerprint])
+    victim = tmp_path.joinpath('home', 'id_ed25519')
+    victim.parent.mkdir()
+    victim.write_text('key')
+    manifest = sync.load_manifest(target)
+    for name, output in [('x', '../home/id_ed25519'), ('y', victim.as_posix()), ('z', 'nested/../../home/id_ed25519')]:
+        manifest['files'][name] = {'size': 1, 'mtime_ns': 1, 'sha256': 'x', 'output': output}
+    sync.save_manifest(target, manifest)
+    result = sync.sync(enclave, source, target, [ALICE.fingerprint])
+    assert result.deleted == [] and victim.read_text() == 'key'
+    assert sorted(sync.load_manifest(target)['files']) == ['a.yml', 'b.yml', 'nested/c.yml']
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+"""Tests for the tracing spans behind --profile."""
+
+import json
+
+import pytest
+
+from secureenclave import trace
+
+
+@pytest.fixture
+def tracer():
+    yield trace.enable()
+    trace.disable()
+
+
+def test_disabled_spans_record_nothing():
+    assert trace.span('gpg --decrypt', command='gpg') is trace.span('other')
+    with trace.span('gpg --decrypt') as span:
+        span.set(exit_code=0)
+
+
+def test_spans_keep_attributes_and_errors(tracer):
+    with trace.span(trace.gpg_span_name(['gpg', '--quiet', '--decrypt']), command='gpg --decrypt') as span:
+        span.set(exit_code=0, bytes_out=10)
+    with pytest.raises(ValueError):
+        with trace.span('assuan SCD SERIALNO'):
+            raise ValueError('no card')
+    first, second = tracer.spans
+    assert first['name'] == 'gpg --decrypt'
+    assert first['attrs'] == {'command': 'gpg --decrypt', 'exit_code': 0, 'bytes_out': 10}
+    assert second['attrs']['error'] == 'ValueError: no card'
+    assert 'gpg --decrypt' in tracer.summary()
+
+
+def test_chrome_trace_format(tracer, tmp_path):
+    with trace.span('get_keys', keys=3):
+        pass
+    tracer.write(tmp_path.joinpath('trace.json'))
+    event, = json.loads(tmp_path.joinpath('trace.json').read_text())['traceEvents']
+    assert (event['name'], event['ph'], event['args']) == ('get_keys', 'X', {'keys': 3})
+    assert event['dur'] >= 0